@@ -0,0 +1,226 @@
+# Run the vehicle ownership model for a batch of scenarios
+#
+# usage: python batch_run.py batch_file
+#
+# The batch file is a YAML file naming the base setup files and listing the scenarios to run.
+# Each scenario may override any setting of the base setup files, e.g. to point at alternative skims
+# or a different UrbanSim year. Scenario-invariant inputs - the block / taz split factors, the
+# intersection density extracted from the EPA smart location data and the model specification -
+# are read once and shared by every scenario that uses the same files. Scenarios are run in a pool of
+# worker processes and a manifest listing the status, stage times and outputs of each is written at the end.
+# Scenarios run at the same time, so no two scenarios may write the same file: give each its own output files
+# (and, if the va setup names a stage_manifest, its own out_folder or manifest), or the batch is rejected.
+#
+#   va_setup:      D:\Projects\veh_ownership_model_app\code\va_setup_2020.yml
+#   model_setup:   D:\Projects\veh_ownership_model_app\code\utah_poisson_setup.yml
+#   manifest_file: D:\Projects\veh_ownership_model_app\test_data\batch_manifest.json
+#   max_workers:   4
+#   scenarios:
+#     - name: base_2020
+#     - name: alt_skims_2020
+#       va_overrides:    {sov_skim_file: sov_skim_alt.omx, transit_skim_file: transit_skim_alt.omx}
+#       model_overrides: {output_disagg_file: veh_own_alt_2020.csv, output_agg_file: veh_own_alt_taz_2020.csv}
+
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import localtime, strftime, perf_counter
+import yaml
+from va_preprocessors import va_preprocess
+from veh_own_model import VehModel
+from poisson_veh_model import read_model_spec
+from va_pipeline import VAPipeline
+from instrumentation import EXIT_OK, EXIT_FAILED
+
+#scenario-invariant inputs, set in each worker process by init_worker
+shared_inputs = {}
+
+class BatchRun:
+    """
+    Runs the preprocessing stages and vehicle ownership model for each scenario listed in a batch file,
+    sharing the scenario-invariant inputs between scenarios
+
+    Args:
+        batch_file (str): name of YAML file listing the base setup files, the scenarios and their
+        setup overrides, the manifest file name and the number of worker processes
+    """
+
+    def __init__(self,
+                 batch_file: str):
+        try:
+            with open(batch_file, 'r') as stream:
+                batch = yaml.load(stream, Loader=yaml.FullLoader)
+        except Exception as err:
+            msg = "Error reading batch file (" + batch_file + ").\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        try:
+            self.va_setup_file = batch['va_setup']
+            self.model_setup_file = batch['model_setup']
+            self.manifest_file = batch['manifest_file']
+            self.scenarios = batch['scenarios']
+            self.max_workers = batch.get('max_workers')
+        except Exception as err:
+            msg = "Required batch parameter(s) were not found in file '" + batch_file + "'.\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        for scenario in self.scenarios:
+            scenario.setdefault('va_overrides', {})
+            scenario.setdefault('model_overrides', {})
+
+    # method load_shared_inputs:
+    # read each distinct block split factor file, smart location file and model specification file
+    # used by the scenarios once, returning them in dicts keyed by file path
+    def load_shared_inputs(self):
+        shared = {'blk_fct': {}, 'int_den': {}, 'specs': {}}
+        for scenario in self.scenarios:
+            pre = va_preprocess(self.va_setup_file, overrides=scenario['va_overrides'])
+            if pre_blk_fct_key(pre) not in shared['blk_fct']:
+                shared['blk_fct'][pre_blk_fct_key(pre)] = pre.load_blk_factors()
+            if int_den_key(pre) not in shared['int_den']:
+                shared['int_den'][int_den_key(pre)] = pre.int_den_by_bg(write_output=False)
+
+            #the base model class reads the setup file without parsing the model specification
+            model = VehModel(self.model_setup_file, overrides=scenario['model_overrides'])
+            if model_blk_fct_key(model) not in shared['blk_fct']:
+                shared['blk_fct'][model_blk_fct_key(model)] = model.load_blk_factors()
+            if model.model_spec_file not in shared['specs']:
+                shared['specs'][model.model_spec_file] = read_model_spec(model.model_spec_file)
+        return shared
+
+    # method check_outputs:
+    # raise an error if two scenarios would write the same file (see VAPipeline.output_files), before any is run
+    # paths are compared once resolved, so a file named through different folders or links is found too
+    def check_outputs(self, shared):
+        writers = {}
+        for i, scenario in enumerate(self.scenarios):
+            try:
+                model_spec_file = VehModel(self.model_setup_file, overrides=scenario['model_overrides']).model_spec_file
+                pipeline = VAPipeline(self.va_setup_file, self.model_setup_file,
+                                      va_overrides=scenario['va_overrides'],
+                                      model_overrides=scenario['model_overrides'],
+                                      specs=shared['specs'].get(model_spec_file))
+                output_files = pipeline.output_files()
+            except Exception as err:
+                msg = "Error setting up scenario " + str(scenario.get('name')) + ".\n" + str(err)
+                raise RuntimeError(msg) from err
+
+            for output_file in output_files:
+                key = os.path.normcase(os.path.realpath(output_file))
+                if writers.get(key, i) != i:
+                    msg = ("Error: scenarios " + str(self.scenarios[writers[key]].get('name')) + " and " +
+                           str(scenario.get('name')) + " both write " + output_file + ". Give each scenario its own output files.")
+                    raise RuntimeError(msg)
+                writers[key] = i
+
+    # method run:
+    # check that no two scenarios write the same file, run every scenario in a pool of worker processes
+    # and write the results manifest
+    def run(self):
+        start = perf_counter()
+        print("Loading shared inputs: " + strftime("%H:%M:%S", localtime()))
+        shared = self.load_shared_inputs()
+        load_secs = perf_counter() - start
+        self.check_outputs(shared)
+
+        print("Running " + str(len(self.scenarios)) + " scenarios: " + strftime("%H:%M:%S", localtime()))
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_worker, initargs=(shared,)) as pool:
+            results = list(pool.map(run_scenario, [self.va_setup_file] * len(self.scenarios),
+                                    [self.model_setup_file] * len(self.scenarios), self.scenarios))
+
+        manifest = {'va_setup': self.va_setup_file,
+                    'model_setup': self.model_setup_file,
+                    'finished': strftime("%Y-%m-%d %H:%M:%S", localtime()),
+                    'shared_input_seconds': load_secs,
+                    'total_seconds': perf_counter() - start,
+                    'scenarios': results}
+        try:
+            with open(self.manifest_file, 'w') as stream:
+                json.dump(manifest, stream, indent=2)
+        except Exception as err:
+            msg = "Error writing batch manifest " + self.manifest_file + ".\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        print("End batch: " + strftime("%H:%M:%S", localtime()))
+        return manifest
+
+
+# function pre_blk_fct_path:
+# the path of the block split factor file used by a va_preprocess instance
+def pre_blk_fct_path(pre):
+    return os.path.abspath(os.path.join(pre.in_folder, pre.blk_fct_file))
+
+# function model_blk_fct_path:
+# the path of the block split factor file used by a VehModel instance
+def model_blk_fct_path(model):
+    return os.path.abspath(os.path.join(model.data_path, model.blk_fct_file))
+
+# function pre_blk_fct_key:
+# the key of the block split factor table read by a va_preprocess instance: the file and the factor column read
+def pre_blk_fct_key(pre):
+    return pre_blk_fct_path(pre) + "|area_fct"
+
+# function model_blk_fct_key:
+# the key of the block split factor table read by a VehModel instance: the file and the factor column read
+# (the model and the preprocessors may read different factor columns of the same file)
+def model_blk_fct_key(model):
+    return model_blk_fct_path(model) + "|" + model.split_factor
+
+# function int_den_key:
+# the path of the smart location file used by a va_preprocess instance, with the state it selects
+def int_den_key(pre):
+    return os.path.abspath(os.path.join(pre.in_folder, pre.smart_loc_file)) + "|SFIPS=" + str(pre.state_fips)
+
+# function init_worker:
+# store the scenario-invariant inputs in a worker process
+def init_worker(shared):
+    shared_inputs.update(shared)
+
+# function run_scenario:
+# run the preprocessing stages and model for one scenario in a worker process, using the shared inputs
+# returns a manifest entry with the scenario status, stage times and output files
+def run_scenario(va_setup_file, model_setup_file, scenario):
+    entry = {'name': scenario.get('name'), 'status': 'ok', 'error': None, 'seconds': None, 'stage_times': {}}
+    start = perf_counter()
+    try:
+        model_spec_file = VehModel(model_setup_file, overrides=scenario['model_overrides']).model_spec_file
+        pipeline = VAPipeline(va_setup_file, model_setup_file,
+                              va_overrides=scenario['va_overrides'],
+                              model_overrides=scenario['model_overrides'],
+                              specs=shared_inputs['specs'].get(model_spec_file))
+
+        pipeline.preprocess.df_blk_fct = shared_inputs['blk_fct'].get(pre_blk_fct_key(pipeline.preprocess))
+        pipeline.model.df_factors = shared_inputs['blk_fct'].get(model_blk_fct_key(pipeline.model))
+
+        int_den_df = shared_inputs['int_den'].get(int_den_key(pipeline.preprocess))
+        precomputed = {'int_den_by_bg': int_den_df} if int_den_df is not None else None
+
+        pipeline.run(precomputed=precomputed)
+
+        entry['stage_times'] = pipeline.stage_times
+        entry['outputs'] = [os.path.join(pipeline.model.data_path, pipeline.model.output_file)]
+        if pipeline.model.aggregate:
+            entry['outputs'].append(os.path.join(pipeline.model.data_path, pipeline.model.output_agg_file))
+    except Exception as err:
+        entry['status'] = 'failed'
+        entry['error'] = str(err)
+
+    entry['seconds'] = perf_counter() - start
+    return entry
+
+
+if __name__ == "__main__":
+    #exit code 0: every scenario ran, 1: the batch or any scenario failed
+    status = EXIT_FAILED
+    try:
+        manifest = BatchRun(sys.argv[1]).run()
+        failed = [s['name'] for s in manifest['scenarios'] if s['status'] != 'ok']
+        if failed:
+            print("Failed scenarios: " + ", ".join(str(name) for name in failed))
+        else:
+            status = EXIT_OK
+    except Exception as err:
+        print(err)
+
+    sys.exit(status)
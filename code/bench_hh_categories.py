@@ -0,0 +1,68 @@
+# Benchmark of the household dummy variable expansion used by va_preprocess.assemble_va_inputs
+# Compares the row-wise DataFrame.apply implementation the preprocessor used previously with the
+# vectorized va_preprocess.encode_hh_categories method on a synthetic household table.
+# The row-wise version is timed on a sample of the table and its run time extrapolated to the full table.
+#
+# usage: python bench_hh_categories.py [setup_file] [n_households] [n_sample]
+
+import sys
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from va_preprocessors import va_preprocess
+
+def synthetic_households(n, seed=0):
+    #return a dataframe of n households with plausible size, worker and income distributions
+    rng = np.random.default_rng(seed)
+    persons = rng.choice(np.arange(1, 9), size=n, p=[0.28, 0.34, 0.16, 0.13, 0.05, 0.02, 0.01, 0.01])
+    workers = np.minimum(rng.binomial(persons, 0.5), 5)
+    hh_inc = np.round(rng.lognormal(mean=11.2, sigma=0.8, size=n), 0)
+    return pd.DataFrame({'persons': persons, 'workers': workers, 'hh_inc': hh_inc})
+
+def rowwise_categories(pre, df_usim):
+    #the row-wise apply implementation previously used by assemble_va_inputs
+    df_usim = df_usim.copy()
+    for i in range(len(pre.hhsize_fields)):
+        if i < len(pre.hhsize_fields) - 1:
+            df_usim[pre.hhsize_fields[i]] = df_usim.apply(lambda row: 1 if row.persons == i+1 else 0, axis = 1)
+        else:
+            df_usim[pre.hhsize_fields[i]] = df_usim.apply(lambda row: 1 if row.persons >= i+1 else 0, axis = 1)
+    for i in range(len(pre.numwrk_fields)):
+        if i < len(pre.numwrk_fields) - 1:
+            df_usim[pre.numwrk_fields[i]] = df_usim.apply(lambda row: 1 if row.workers == i else 0, axis = 1)
+        else:
+            df_usim[pre.numwrk_fields[i]] = df_usim.apply(lambda row: 1 if row.workers >= i else 0, axis = 1)
+    df_usim[pre.dum_income_field] = df_usim.apply(lambda row: 1 if row[pre.inc_col] < pre.dum_income_break else 0, axis = 1)
+    for i in range(len(pre.hhinc_fields)):
+        high = pre.hhinc_breaks[i]
+        low = 0 if i == 0 else pre.hhinc_breaks[i-1]
+        df_usim[pre.hhinc_fields[i]] = df_usim.apply(lambda row: 1 if row[pre.inc_col] >= low and row[pre.inc_col] < high else 0, axis = 1)
+    return df_usim
+
+if __name__ == "__main__":
+    setup_file = sys.argv[1] if len(sys.argv) > 1 else "va_setup_2020.yml"
+    n_hh = int(sys.argv[2]) if len(sys.argv) > 2 else 2000000
+    n_sample = int(sys.argv[3]) if len(sys.argv) > 3 else 50000
+
+    pre = va_preprocess(setup_file)
+    df_hh = synthetic_households(n_hh)
+    df_hh = df_hh.rename(columns={'hh_inc': pre.inc_col})
+
+    start = perf_counter()
+    df_dummies = pre.encode_hh_categories(df_hh)
+    vec_secs = perf_counter() - start
+
+    df_sample = df_hh.iloc[:n_sample]
+    start = perf_counter()
+    df_rowwise = rowwise_categories(pre, df_sample)
+    row_secs = perf_counter() - start
+
+    #the vectorized columns must match the row-wise columns exactly
+    pd.testing.assert_frame_equal(df_dummies.iloc[:n_sample], df_rowwise[df_dummies.columns])
+
+    row_secs_full = row_secs * n_hh / n_sample
+    print("households:            " + str(n_hh))
+    print("dummy columns:         " + str(len(df_dummies.columns)))
+    print("vectorized:            %.3f s" % vec_secs)
+    print("row-wise (%d rows):  %.3f s, extrapolated %.1f s" % (n_sample, row_secs, row_secs_full))
+    print("speedup:               %.0fx" % (row_secs_full / vec_secs))
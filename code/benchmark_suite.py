@@ -0,0 +1,198 @@
+# Benchmark suite for the preprocessing stages and the vehicle ownership model
+#
+# usage: python benchmark_suite.py [--zones 500 2500 10000] [--households N] [--data-folder folder]
+#                                  [--history benchmark_history.jsonl] [--threshold 1.25]
+#
+# By default the synthetic inputs and the history file are kept in a veh_model_benchmark folder in the system
+# temporary folder, outside the repository; pass --data-folder and --history to keep them elsewhere.
+#
+# For each scale, synthetic inputs are written by synthetic_data.py (and reused on later runs), then every
+# va_preprocess stage and PoissonModel method is timed on its own in a freshly spawned process, so that the
+# peak resident memory of each case is measured independently of the others. Model methods that depend on
+# earlier methods (e.g. split_hh_to_taz on run_model) run those first, outside the timed section.
+#
+# One JSON line per scale is appended to the history file, recording the wall time, CPU time and peak RSS of
+# every case together with the code version and host. Each case is compared with the last history record for
+# the same scale and host; the suite exits with code 1 if any case is slower than that by more than threshold,
+# and with code 2 if any case fails.
+# Runs on Linux without TransCAD. Peak RSS is read with the resource module, which is not available on Windows.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import localtime, strftime, perf_counter, process_time
+import numpy as np
+import pandas as pd
+from synthetic_data import write_synthetic_inputs, CODE_PATH
+
+try:
+    import resource
+except ImportError:
+    #peak memory is not recorded where the resource module is unavailable (Windows)
+    resource = None
+
+#default folder for the synthetic inputs and the history file
+BENCHMARK_FOLDER = os.path.join(tempfile.gettempdir(), "veh_model_benchmark")
+
+#benchmark cases in the order they are run
+#target: 'va' for va_preprocess stages, 'model' for PoissonModel methods
+#setup: methods run before the timed method, outside the timed section
+#the preprocessing stages write their output files, which assemble_va_inputs and load_data then read
+BENCHMARK_CASES = {
+    'emp_accessibility_by_taz': {'target': 'va', 'setup': []},
+    'activity_den_by_taz':      {'target': 'va', 'setup': []},
+    'int_den_by_bg':            {'target': 'va', 'setup': []},
+    'assemble_va_inputs':       {'target': 'va', 'setup': []},
+    'load_data':                {'target': 'model', 'setup': []},
+    'run_model':                {'target': 'model', 'setup': ['load_data']},
+    'split_hh_to_taz':          {'target': 'model', 'setup': ['load_data', 'run_model']},
+    'save_results':             {'target': 'model', 'setup': ['load_data', 'run_model', 'split_hh_to_taz']},
+    'aggregate_results':        {'target': 'model', 'setup': ['load_data', 'run_model', 'split_hh_to_taz']},
+    'aggregate_sparse':         {'target': 'model', 'setup': ['load_data', 'run_model']}
+    }
+
+# function peak_rss_mb:
+# peak resident memory of the current process in MB, or None if it can't be measured
+def peak_rss_mb():
+    if resource is None:
+        return None
+    #ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+# function run_case:
+# run one benchmark case in the current (freshly spawned) process
+# returns the wall and CPU seconds of the timed method, the process peak RSS before it started and the
+# process peak RSS after it finished, in MB
+def run_case(case, setup_files):
+    from va_preprocessors import va_preprocess
+    from poisson_veh_model import PoissonModel
+
+    if BENCHMARK_CASES[case]['target'] == 'va':
+        target = va_preprocess(setup_files['va_setup'])
+    else:
+        target = PoissonModel(setup_files['model_setup'])
+    for method in BENCHMARK_CASES[case]['setup']:
+        getattr(target, method)()
+
+    rss_before = peak_rss_mb()
+    wall_start = perf_counter()
+    cpu_start = process_time()
+    getattr(target, case)()
+    return {'wall_s': perf_counter() - wall_start,
+            'cpu_s': process_time() - cpu_start,
+            'setup_peak_rss_mb': rss_before,
+            'peak_rss_mb': peak_rss_mb()}
+
+# function run_suite:
+# run every benchmark case for one set of synthetic inputs, each in its own spawned process
+# repeat runs of a case keep the fastest wall time; a case that fails is recorded with its error
+def run_suite(setup_files, repeat=1):
+    results = {}
+    for case in BENCHMARK_CASES:
+        runs = []
+        try:
+            for i in range(repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                    runs.append(pool.submit(run_case, case, setup_files).result())
+        except Exception as err:
+            #record the failure and go on with the other cases (e.g. aggregate_sparse without scipy)
+            results[case] = {'error': str(err)}
+            print("  {0:<28}failed: {1}".format(case, str(err).splitlines()[0] if str(err) else type(err).__name__))
+            continue
+        results[case] = min(runs, key=lambda run: run['wall_s'])
+        print("  {0:<28}{1:10.2f} s{2:>12} MB".format(case, results[case]['wall_s'],
+              "-" if results[case]['peak_rss_mb'] is None else "%.0f" % results[case]['peak_rss_mb']))
+    return results
+
+# function code_version:
+# the git commit of the code folder, or None if it isn't a git checkout
+def code_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=CODE_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+# function read_history:
+# return the records of a benchmark history file, oldest first
+def read_history(history_file):
+    if not os.path.exists(history_file):
+        return []
+    try:
+        with open(history_file, 'r') as stream:
+            return [json.loads(line) for line in stream if line.strip()]
+    except Exception as err:
+        msg = "Error reading benchmark history file " + history_file + ".\n" + str(err)
+        raise RuntimeError(msg) from err
+
+# function find_regressions:
+# compare the cases of a record with the last earlier record for the same scale and host
+# returns a list of (case, previous wall seconds, wall seconds) for cases slower by more than threshold
+def find_regressions(record, history, threshold):
+    previous = [rec for rec in history if rec['scale'] == record['scale'] and rec['host'] == record['host']]
+    if not previous:
+        return []
+    last = previous[-1]['cases']
+    return [(case, last[case]['wall_s'], result['wall_s']) for case, result in record['cases'].items()
+            if 'wall_s' in result and 'wall_s' in last.get(case, {}) and result['wall_s'] > threshold * last[case]['wall_s']]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing stages and vehicle ownership model")
+    parser.add_argument('--zones', type=int, nargs='+', default=[500], help="number of zones of each scale to run")
+    parser.add_argument('--households', type=int, default=None, help="number of households (default 200 per zone)")
+    parser.add_argument('--data-folder', default=os.path.join(BENCHMARK_FOLDER, "data"),
+                        help="folder for the synthetic inputs (one subfolder per scale)")
+    parser.add_argument('--history', default=os.path.join(BENCHMARK_FOLDER, "benchmark_history.jsonl"),
+                        help="JSON lines file the results are appended to")
+    parser.add_argument('--repeat', type=int, default=1, help="runs of each case; the fastest is kept")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="slowdown relative to the previous run reported as a regression")
+    args = parser.parse_args()
+
+    exit_code = 0
+    try:
+        history = read_history(args.history)
+        for n_zones in args.zones:
+            n_households = args.households if args.households is not None else 200 * n_zones
+            folder = os.path.abspath(os.path.join(args.data_folder, "z%d_h%d" % (n_zones, n_households)))
+            print("Writing synthetic inputs (" + str(n_zones) + " zones, " + str(n_households) + " households): " +
+                  strftime("%H:%M:%S", localtime()))
+            setup_files = write_synthetic_inputs(folder, n_zones, n_households)
+
+            print("Running benchmarks: " + strftime("%H:%M:%S", localtime()))
+            record = {'timestamp': strftime("%Y-%m-%d %H:%M:%S", localtime()),
+                      'commit': code_version(),
+                      'host': platform.node(),
+                      'python': platform.python_version(),
+                      'numpy': np.__version__,
+                      'pandas': pd.__version__,
+                      'scale': {'n_zones': n_zones, 'n_households': n_households},
+                      'cases': run_suite(setup_files, args.repeat)}
+
+            for case, previous_s, current_s in find_regressions(record, history, args.threshold):
+                print("Regression: " + case + " took %.2f s, previously %.2f s" % (current_s, previous_s))
+                exit_code = 1
+            if any('error' in result for result in record['cases'].values()):
+                exit_code = 2
+
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+                with open(args.history, 'a') as stream:
+                    stream.write(json.dumps(record) + "\n")
+            except Exception as err:
+                msg = "Error writing benchmark history file " + args.history + ".\n" + str(err)
+                raise RuntimeError(msg) from err
+            history.append(record)
+    except Exception as err:
+        print(err)
+        exit_code = 2
+
+    sys.exit(exit_code)
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    #sparse aggregation (count_matrix) is unavailable if scipy is not installed
+    sparse = None
+
+class BlockSplitIndex:
+    """
+    A block to (taz, split factor) lookup built once from the block / taz split factor table.
+    The table is sorted by block and stored as CSR-style arrays: the splits of block_ids[i] are
+    taz[offsets[i]:offsets[i+1]] with factors factors[offsets[i]:offsets[i+1]], in the order they
+    appear in the split factor table.
+
+    Args:
+        df_factors (DataFrame): block split factor table with block_id, taz and split factor columns
+        factor_col (str): name of the split factor column
+    """
+
+    def __init__(self,
+                 df_factors,
+                 factor_col: str = 'area_fct'):
+        #block ids are held as float64 so that household tables with missing (NaN) block ids can be looked up
+        #census block ids have 15 digits and are represented exactly
+        blocks = df_factors['block_id'].to_numpy(dtype=np.float64)
+        order = np.argsort(blocks, kind='stable')
+        sorted_blocks = blocks[order]
+
+        self.block_ids, starts = np.unique(sorted_blocks, return_index=True)
+        self.offsets = np.append(starts, len(sorted_blocks))
+        #hash lookup of the positions of blocks in block_ids, much faster than a binary search for millions of households
+        self.block_index = pd.Index(self.block_ids)
+        self.taz = df_factors['taz'].to_numpy()[order]
+        self.factors = df_factors[factor_col].to_numpy(dtype=np.float64)[order]
+
+    # method expand:
+    # look up the splits of each block in block_ids (e.g. the block of each household)
+    # returns two arrays with one element per split: the position in block_ids the split belongs to,
+    # and the position of the split in the taz and factors arrays
+    # blocks are expanded in the order given, so the result matches an inner merge on block_id;
+    # blocks that are missing from the split factor table have no splits
+    def expand(self, block_ids):
+        block_ids = np.asarray(block_ids, dtype=np.float64)
+        if len(self.block_ids) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        pos = self.block_index.get_indexer(block_ids)
+        #missing (NaN) block ids never match
+        found = (pos >= 0) & ~np.isnan(block_ids)
+        pos = np.where(found, pos, 0)
+        starts = self.offsets[pos]
+        counts = np.where(found, self.offsets[pos + 1] - starts, 0)
+
+        #each split's position in the split arrays is its block's first split plus its rank within the block
+        row_idx = np.repeat(np.arange(len(block_ids)), counts)
+        first_of_row = np.cumsum(counts) - counts
+        split_idx = np.arange(counts.sum()) - np.repeat(first_of_row, counts) + np.repeat(starts, counts)
+        return row_idx, split_idx
+
+    # method split_counts:
+    # sum the rows of values (one row per household of block_ids, one column per field of columns) by aggregate
+    # geography and block split: row (g, s) of the result is the sum of the values of the households of the block
+    # of split s whose geography is g. geo gives the geography of each household, or None for the taz of each split
+    # returns a dataframe of the sums indexed by (geography, split) (see group_splits)
+    def split_counts(self, block_ids, values, columns, geo=None):
+        row_idx, split_idx = self.expand(block_ids)
+        split_geo = self.taz[split_idx] if geo is None else np.asarray(geo)[row_idx]
+        return group_splits(split_geo, split_idx, count_values(values)[row_idx], columns)
+
+    # method count_matrix:
+    # build a sparse matrix of ones with a row per (geography, split) and a column per household of block_ids
+    # (geo as in split_counts); its product with a household x field array of count_values is the array of
+    # split_counts of the fields, without the household x block split table being built
+    # returns the matrix and the (geography, split) index of its rows
+    def count_matrix(self, block_ids, geo=None):
+        if sparse is None:
+            msg = "Error: sparse aggregation requires scipy, which is not installed."
+            raise RuntimeError(msg)
+
+        row_idx, split_idx = self.expand(block_ids)
+        split_geo = self.taz[split_idx] if geo is None else np.asarray(geo)[row_idx]
+        #splits without a geography are left out, as they are by a groupby
+        keep = pd.notna(split_geo)
+        row_idx, split_idx, split_geo = row_idx[keep], split_idx[keep], split_geo[keep]
+
+        keys = pd.MultiIndex.from_arrays([split_geo, split_idx], names=['geo', 'split'])
+        key_codes, key_index = keys.factorize(sort=True)
+        matrix = sparse.csr_matrix((np.ones(len(row_idx), dtype=np.int64), (key_codes, row_idx)),
+                                   shape=(len(key_index), len(block_ids)))
+        return matrix, key_index.set_names(['geo', 'split'])
+
+    # method split_totals:
+    # the split factored sums by geography of split counts (see split_counts): each sum of a (geography, split)
+    # is multiplied by the split factor and the products are added by geography in the order of the sorted
+    # counts, so equal counts always give bit-identical totals
+    # returns an (n geographies x n fields) array of totals and the geographies, in sorted order
+    def split_totals(self, counts):
+        counts = counts.sort_index()
+        splits = counts.index.get_level_values(1).to_numpy(dtype=np.int64)
+        weighted = counts.to_numpy(dtype=np.float64) * self.factors[splits][:, np.newaxis]
+
+        geo_codes, geo_ids = pd.factorize(counts.index.get_level_values(0), sort=True)
+        totals = np.empty((len(geo_ids), weighted.shape[1]))
+        for j in range(weighted.shape[1]):
+            totals[:, j] = np.bincount(geo_codes, weights=weighted[:, j], minlength=len(geo_ids))
+        return totals, geo_ids
+
+
+# function count_values:
+# return an array of household field values as int64 if they are all whole numbers (e.g. 0 / 1 flags and
+# counts), so that their sums are exact whatever the order they are added in, otherwise as float64
+def count_values(values):
+    values = np.asarray(values)
+    if values.dtype.kind in 'biu':
+        return values.astype(np.int64)
+    values = values.astype(np.float64)
+    if np.all(np.abs(values) < 2**53) and np.array_equal(values, np.floor(values)):
+        return values.astype(np.int64)
+    return values
+
+# function group_splits:
+# sum rows of values by (geography, split), one row per household split, into a dataframe with one column
+# per field of columns, indexed by (geography, split) and sorted by its index
+# splits without a geography are left out
+def group_splits(split_geo, split_idx, values, columns):
+    index = pd.MultiIndex.from_arrays([split_geo, split_idx], names=['geo', 'split'])
+    return pd.DataFrame(values, index=index, columns=columns).groupby(level=[0, 1]).sum()
+
+# function add_split_counts:
+# add two dataframes of split counts (either may be None), e.g. those of two batches of households
+# integer counts are added exactly, so the result doesn't depend on how the households were batched
+def add_split_counts(counts, more):
+    if counts is None:
+        return more
+    if more is None:
+        return counts
+    return pd.concat([counts, more]).groupby(level=[0, 1]).sum()
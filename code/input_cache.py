@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import time
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    #the cache is disabled if pyarrow is not installed
+    feather = None
+
+class InputCache:
+    """
+    A disk cache of parsed input tables. The first time a table is read it is converted
+    to an uncompressed Feather (Arrow IPC) file, which later runs memory-map instead of
+    parsing the source CSV again.
+
+    Cached tables are keyed by the content hash of the source file and a tag describing
+    how the table was read (columns, filters). The hash is only recomputed when the
+    path, size or modification time of the source file changes. When the total size of
+    the cache exceeds max_mb, the least recently used tables are removed.
+
+    Args:
+        cache_folder (str): folder holding the cached tables and the cache index
+        max_mb (float): size limit of the cache in megabytes, or None for no limit
+    """
+
+    index_name = "cache_index.json"
+
+    def __init__(self,
+                 cache_folder: str,
+                 max_mb: float = None):
+        self.cache_folder = cache_folder
+        self.max_bytes = None if max_mb is None else int(max_mb * 1024 * 1024)
+        self.enabled = feather is not None
+
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+        except Exception as err:
+            msg = "Error creating input cache folder " + self.cache_folder + ".\n" + str(err)
+            raise RuntimeError(msg) from err
+
+    # method load:
+    # return the dataframe produced by reader() for infile, from the cache if a current copy exists
+    # otherwise call reader, store its result in the cache and return it
+    # tag must identify everything about the read that changes the result (columns, filters, dtypes)
+    def load(self, infile, reader, tag=""):
+        if not self.enabled:
+            return reader()
+
+        index = self.read_index()
+        content_hash = self.content_hash(infile, index)
+        key = hashlib.sha1((content_hash + "|" + tag).encode("utf-8")).hexdigest()
+        cache_file = os.path.join(self.cache_folder, key + ".feather")
+
+        if os.path.exists(cache_file):
+            try:
+                df = feather.read_table(cache_file, memory_map=True).to_pandas(split_blocks=True)
+                index['entries'][key] = {'source': os.path.abspath(infile), 'tag': tag, 'last_used': time.time()}
+                self.write_index(index)
+                return df
+            except Exception:
+                #a damaged cache file is rebuilt below
+                pass
+
+        df = reader()
+
+        #tables that can't be stored in Feather format are returned uncached
+        tmp_file = cache_file + "." + str(os.getpid()) + ".tmp"
+        try:
+            feather.write_feather(df.reset_index(drop=True), tmp_file, compression="uncompressed")
+            os.replace(tmp_file, cache_file)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return df
+
+        index['entries'][key] = {'source': os.path.abspath(infile), 'tag': tag, 'last_used': time.time()}
+        self.evict(index)
+        self.write_index(index)
+        return df
+
+    # method content_hash:
+    # return the content hash of infile, reusing the hash recorded in the index if the path, size
+    # and modification time of the file are unchanged
+    def content_hash(self, infile, index):
+        fingerprint = file_fingerprint(infile, index['files'].get(os.path.abspath(infile)))
+        index['files'][fingerprint['path']] = fingerprint
+        return fingerprint['hash']
+
+    # method evict:
+    # remove the least recently used cached tables until the cache is within its size limit
+    def evict(self, index):
+        if self.max_bytes is None:
+            return
+
+        cached = []
+        for name in os.listdir(self.cache_folder):
+            if name.endswith(".feather"):
+                path = os.path.join(self.cache_folder, name)
+                key = name[:-len(".feather")]
+                last_used = index['entries'].get(key, {}).get('last_used', os.path.getmtime(path))
+                cached.append((last_used, key, path, os.path.getsize(path)))
+
+        total_bytes = sum(c[3] for c in cached)
+        for last_used, key, path, size in sorted(cached):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            index['entries'].pop(key, None)
+            total_bytes -= size
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.cache_folder, self.index_name), 'r') as stream:
+                index = json.load(stream)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault('files', {})
+        index.setdefault('entries', {})
+        return index
+
+    def write_index(self, index):
+        #write to a temporary file and rename, so concurrent runs never see a partial index
+        index_file = os.path.join(self.cache_folder, self.index_name)
+        tmp_file = index_file + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_file, 'w') as stream:
+            json.dump(index, stream, indent=1)
+        os.replace(tmp_file, index_file)
+
+
+# function file_fingerprint:
+# return a dict with the absolute path, size, modification time and content hash of a file
+# if previous (a fingerprint recorded earlier) has the same path, size and modification time,
+# its content hash is reused instead of reading the file again
+def file_fingerprint(infile, previous=None):
+    path = os.path.abspath(infile)
+    stat = os.stat(path)
+    if previous is not None and previous.get('path') == path and previous.get('size') == stat.st_size \
+            and previous.get('mtime') == stat.st_mtime_ns:
+        return previous
+
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as stream:
+        for block in iter(lambda: stream.read(1 << 22), b""):
+            hasher.update(block)
+
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': hasher.hexdigest()}
@@ -0,0 +1,236 @@
+import cProfile
+import functools
+import json
+import os
+import threading
+from time import localtime, strftime, perf_counter, process_time
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    #without psutil, memory and I/O are read from /proc where available (Linux) and not recorded elsewhere
+    psutil = None
+
+#exit codes of the driver scripts
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_SLOW = 2
+
+class StageRecorder:
+    """
+    Records metrics for each stage method of a VehModel or va_preprocess instance: wall and CPU time,
+    peak resident memory, rows in and out and bytes read and written. Each record is kept in records
+    and, if a metrics file is given, appended to it as a JSON line. Stage methods are instrumented with
+    the instrumented decorator, which finds the recorder in the instance's recorder attribute.
+
+    Args:
+        metrics_file (str): optional JSON lines file the stage records are appended to
+        profile_folder (str): optional folder; if given, each stage is run under cProfile and its
+        statistics are written to <class>.<stage>.<process id>.prof in the folder
+        slow_seconds (float): optional wall time above which a stage is flagged as slow
+    """
+
+    def __init__(self,
+                 metrics_file: str = None,
+                 profile_folder: str = None,
+                 slow_seconds: float = None):
+        self.metrics_file = metrics_file
+        self.profile_folder = profile_folder
+        self.slow_seconds = slow_seconds
+        self.records = []
+        #number of instrumented stages currently running; only the outermost stage is profiled
+        self.depth = 0
+
+    # method from_setup:
+    # build a recorder from the optional metrics_file, profile_folder and slow_stage_seconds setup parameters
+    @classmethod
+    def from_setup(cls, setup):
+        return cls(metrics_file=setup.get('metrics_file'),
+                   profile_folder=setup.get('profile_folder'),
+                   slow_seconds=setup.get('slow_stage_seconds'))
+
+    # method record:
+    # keep a stage record and append it to the metrics file
+    def record(self, entry):
+        self.records.append(entry)
+        if self.metrics_file is not None:
+            try:
+                with open(self.metrics_file, 'a') as stream:
+                    stream.write(json.dumps(entry) + "\n")
+            except Exception as err:
+                msg = "Error writing metrics file " + self.metrics_file + ".\n" + str(err)
+                raise RuntimeError(msg) from err
+
+    # method failed_stages:
+    # names of the recorded stages that raised an exception
+    def failed_stages(self):
+        return [entry['stage'] for entry in self.records if entry['status'] == 'failed']
+
+    # method slow_stages:
+    # names of the recorded stages whose wall time exceeded slow_seconds
+    def slow_stages(self):
+        return [entry['stage'] for entry in self.records if entry['slow']]
+
+
+class MemorySampler:
+    """
+    Samples the resident memory of the process in a background thread while a stage runs,
+    keeping the peak. Used as a context manager; peak_mb is None if memory can't be read.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_mb = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def __enter__(self):
+        self.update()
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_event.set()
+        self.thread.join()
+        self.update()
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            self.update()
+
+    def update(self):
+        rss = rss_mb()
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+
+# function rss_mb:
+# current resident memory of the process in MB, or None if it can't be read
+def rss_mb():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    try:
+        with open("/proc/self/statm", 'r') as stream:
+            return int(stream.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except Exception:
+        return None
+
+# function io_bytes:
+# bytes read and written by the process so far (including reads served from the file cache),
+# or (None, None) if they can't be read
+def io_bytes():
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+            return (getattr(counters, 'read_chars', counters.read_bytes),
+                    getattr(counters, 'write_chars', counters.write_bytes))
+        except Exception:
+            return None, None
+    try:
+        with open("/proc/self/io", 'r') as stream:
+            fields = dict(line.split(':') for line in stream.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except Exception:
+        return None, None
+
+# function row_count:
+# number of rows of a dataframe or array, or None
+def row_count(obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series)) or hasattr(obj, 'shape'):
+        return len(obj)
+    return None
+
+# function difference:
+# end - start for counters that may be unavailable (None)
+def difference(start, end):
+    return None if start is None or end is None else end - start
+
+# function instrumented:
+# decorator recording the metrics of a stage method in the instance's recorder (see StageRecorder)
+# rows_in is an optional function of the instance and the stage's arguments giving the number of input rows, called
+# after the stage so that it can count a table the stage reads on first use (e.g. va_preprocess.df_hh); it must not
+# count what the stage produces. By default rows in is the number of rows of the instance's df on entry (None if it
+# has none). Rows out is the number of rows of
+# the dataframe returned by the stage, or of the instance's df after the stage
+# a stage that raises an exception is recorded as failed and the exception is passed on; if the failed stage
+# can't be recorded, a warning is printed instead so the stage's own exception is not replaced
+def instrumented(rows_in=None):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            recorder = getattr(self, 'recorder', None)
+            if recorder is None:
+                return method(self, *args, **kwargs)
+
+            entry = {'time': strftime("%Y-%m-%d %H:%M:%S", localtime()), 'pid': os.getpid(),
+                     'class': type(self).__name__, 'stage': method.__name__, 'status': 'ok', 'error': None}
+            df_in = getattr(self, 'df', None)
+            rows_before = row_count(df_in) if rows_in is None else None
+            profiler = cProfile.Profile() if recorder.profile_folder is not None and recorder.depth == 0 else None
+            sampler = MemorySampler()
+
+            read_start, written_start = io_bytes()
+            wall_start = perf_counter()
+            cpu_start = process_time()
+            recorder.depth += 1
+            result = None
+            try:
+                with sampler:
+                    if profiler is not None:
+                        profiler.enable()
+                    try:
+                        result = method(self, *args, **kwargs)
+                    finally:
+                        if profiler is not None:
+                            profiler.disable()
+            except Exception as err:
+                entry['status'] = 'failed'
+                entry['error'] = str(err)
+                raise
+            finally:
+                recorder.depth -= 1
+                read_end, written_end = io_bytes()
+                entry['wall_s'] = perf_counter() - wall_start
+                entry['cpu_s'] = process_time() - cpu_start
+                entry['peak_rss_mb'] = sampler.peak_mb
+                entry['rows_in'] = rows_before if rows_in is None else rows_in(self, *args, **kwargs)
+                entry['rows_out'] = row_count(result) if row_count(result) is not None else row_count(getattr(self, 'df', None))
+                entry['bytes_read'] = difference(read_start, read_end)
+                entry['bytes_written'] = difference(written_start, written_end)
+                entry['slow'] = recorder.slow_seconds is not None and entry['wall_s'] > recorder.slow_seconds
+                try:
+                    if profiler is not None:
+                        entry['profile'] = write_profile(profiler, recorder.profile_folder, entry)
+                    recorder.record(entry)
+                except Exception as err:
+                    #an error recording a failed stage must not hide the stage's own exception
+                    if entry['status'] != 'failed':
+                        raise
+                    print("Warning: metrics of failed stage " + entry['stage'] + " not recorded.\n" + str(err))
+            return result
+        return wrapper
+    return decorator
+
+# function write_profile:
+# write the cProfile statistics of a stage to the profile folder, returning the file name
+def write_profile(profiler, profile_folder, entry):
+    try:
+        os.makedirs(profile_folder, exist_ok=True)
+        profile_file = os.path.join(profile_folder, "%s.%s.%d.prof" % (entry['class'], entry['stage'], entry['pid']))
+        profiler.dump_stats(profile_file)
+    except Exception as err:
+        msg = "Error writing profile for stage " + entry['stage'] + ".\n" + str(err)
+        raise RuntimeError(msg) from err
+    return profile_file
+
+# function exit_code:
+# the exit code for a run given the recorders of its instances: EXIT_FAILED if any stage failed,
+# EXIT_SLOW if any stage was slower than its recorder's slow_seconds, otherwise EXIT_OK
+def exit_code(recorders):
+    recorders = [recorder for recorder in recorders if recorder is not None]
+    if any(recorder.failed_stages() for recorder in recorders):
+        return EXIT_FAILED
+    if any(recorder.slow_stages() for recorder in recorders):
+        return EXIT_SLOW
+    return EXIT_OK
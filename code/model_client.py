@@ -0,0 +1,97 @@
+# Send a request to the warm VA model server (model_server.py) and wait for its response
+#
+# usage: python model_client.py [--port PORT] run [pipeline|preprocess|model] [--parallel]
+#                               [--va KEY=VALUE ...] [--model KEY=VALUE ...]
+#        python model_client.py [--port PORT] ping [--wait SECONDS]
+#        python model_client.py [--port PORT] shutdown
+#
+# --va and --model override a setting of the va or model setup file for this run only; values are read as
+# JSON if possible (numbers, true / false, lists) and as text otherwise, e.g.
+#   python model_client.py run model --model output_disagg_file=veh_own_iter2.csv --model n_workers=4
+# ping --wait retries until the server answers or SECONDS have passed, e.g. while it is starting.
+#
+# The exit code is that of the run (0: success, 1: failed, 2: completed with stages slower than
+# slow_stage_seconds), or 1 if the server can't be reached. The client only uses the standard library,
+# so it starts in a fraction of the time of a model run script and any Python 3 interpreter can run it.
+
+import argparse
+import json
+import socket
+import sys
+import time
+
+#as in model_server.py and instrumentation.py, which are not imported to keep the client light
+DEFAULT_PORT = 50517
+EXIT_OK = 0
+EXIT_FAILED = 1
+
+# function send_request:
+# send a request to the server on port and return its response; waits for the run to complete
+def send_request(request, port=DEFAULT_PORT, connect_timeout=5.0):
+    with socket.create_connection(('127.0.0.1', port), timeout=connect_timeout) as conn:
+        #a run may take many minutes
+        conn.settimeout(None)
+        conn.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        line = conn.makefile('r', encoding='utf-8').readline()
+    if not line:
+        raise ConnectionError("The server closed the connection without a response.")
+    return json.loads(line)
+
+# function parse_overrides:
+# convert a list of KEY=VALUE strings to a dict of setup overrides
+def parse_overrides(items):
+    overrides = {}
+    for item in items or []:
+        key, sep, value = item.partition('=')
+        if not sep:
+            raise ValueError("Override '" + item + "' is not of the form KEY=VALUE.")
+        try:
+            overrides[key.strip()] = json.loads(value)
+        except ValueError:
+            overrides[key.strip()] = value
+    return overrides
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send a request to the warm VA model server.")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('command', choices=['run', 'ping', 'shutdown'])
+    parser.add_argument('target', nargs='?', default='pipeline', choices=['pipeline', 'preprocess', 'model'])
+    parser.add_argument('--parallel', action='store_true', help="run independent preprocessing stages in parallel")
+    parser.add_argument('--va', action='append', metavar='KEY=VALUE', help="va setup override")
+    parser.add_argument('--model', action='append', metavar='KEY=VALUE', help="model setup override")
+    parser.add_argument('--wait', type=float, default=0, metavar='SECONDS', help="ping: wait for the server to start")
+    args = parser.parse_args()
+
+    status = EXIT_FAILED
+    try:
+        request = {'command': args.command}
+        if args.command == 'run':
+            request.update({'target': args.target, 'parallel': args.parallel,
+                            'va_overrides': parse_overrides(args.va), 'model_overrides': parse_overrides(args.model)})
+
+        deadline = time.monotonic() + args.wait
+        while True:
+            try:
+                response = send_request(request, port=args.port)
+                break
+            except ConnectionRefusedError:
+                if args.command != 'ping' or time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.5)
+
+        if response.get('error'):
+            print(response['error'])
+        for stage, seconds in (response.get('stage_times') or {}).items():
+            print("  {0:<28}{1:10.2f} s".format(stage, seconds))
+        if response.get('skipped'):
+            print("Stages up to date (not run): " + ", ".join(response['skipped']))
+        if response.get('seconds') is not None:
+            print("Run " + response['status'] + " in {0:.2f} s (exit code {1})".format(response['seconds'], response['exit_code']))
+        elif args.command == 'ping':
+            print("Server running: " + str(response.get('runs')) + " runs in {0:.0f} s".format(response.get('uptime_seconds', 0)))
+        status = response.get('exit_code', EXIT_FAILED)
+    except (OSError, ValueError) as err:
+        print("Error contacting VA model server on port " + str(args.port) + ".\n" + str(err))
+
+    sys.exit(status)
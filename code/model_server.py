@@ -0,0 +1,291 @@
+# Keep the vehicle ownership model warm between runs
+#
+# usage: python model_server.py va_setup_file model_setup_file [port]
+#
+# The server listens on a local socket (127.0.0.1, port DEFAULT_PORT unless given) and runs the preprocessing
+# stages and / or the model each time it receives a run request, e.g. from model_client.py. Python, pandas and
+# the other libraries are imported once, and the model specification, block split factor tables and indexes
+# and the intersection density by block group are kept in memory between runs, so a run in a feedback loop
+# only pays for the stages themselves. A kept table is read again if the size or modification time of its
+# file changes. Requests are run one at a time, in the order they are received.
+#
+# Each request and response is one line of JSON. A run request names the target - pipeline (preprocessing
+# and model, the default), preprocess (preprocessing only, writing each stage's output file, as
+# preprocess_test.py does) or model (the model only, reading the va model input file, as test_run.py does) -
+# and optional setup overrides for this run:
+#   {"command": "run", "target": "model", "model_overrides": {"output_disagg_file": "veh_own_iter2.csv"}}
+#   {"command": "run", "target": "pipeline", "parallel": true, "va_overrides": {"sov_skim_file": "sov_iter2.omx"}}
+# The response, sent when the run is complete, gives its status, exit code (as for the driver scripts) and times:
+#   {"status": "ok", "exit_code": 0, "error": null, "seconds": 41.2, "stage_times": {...}, "skipped": [...]}
+# {"command": "ping"} returns the server status and {"command": "shutdown"} stops the server.
+#
+# Overrides can't change the folders of the setup files (keys ending in _folder or _path), the metrics file or the
+# stage manifest, and no override value can hold a folder separator, so a run only reads and writes files in those
+# folders. The worker counts and batch size of a run are kept within BOUNDED_KEYS.
+
+import json
+import os
+import socket
+import sys
+from time import localtime, strftime, perf_counter
+from va_pipeline import VAPipeline
+from poisson_veh_model import read_model_spec
+from batch_run import pre_blk_fct_path, model_blk_fct_path, int_den_key
+from instrumentation import EXIT_OK, EXIT_FAILED
+
+DEFAULT_PORT = 50517
+TARGETS = ['pipeline', 'preprocess', 'model']
+#setup keys a run request can't override: they name folders or full paths
+FIXED_KEY_SUFFIXES = ('_folder', '_path')
+FIXED_KEYS = ['metrics_file', 'stage_manifest']
+#(minimum, maximum) of the numeric settings a run request can change: worker counts up to the number of CPUs,
+#and batches large enough not to be dominated by per-batch overhead and small enough to bound memory
+BOUNDED_KEYS = {'n_workers': (1, os.cpu_count() or 1),
+                'csv_workers': (1, os.cpu_count() or 1),
+                'max_workers': (1, os.cpu_count() or 1),
+                'chunk_rows': (1000, 10000000)}
+
+class ModelServer:
+    """
+    Runs the preprocessing stages and vehicle ownership model on request, keeping the imported libraries,
+    the model specification and the static lookup tables in memory between runs
+
+    Args:
+        va_setup_file (str): name of the YAML setup file for the va_preprocess stages
+        model_setup_file (str): name of the YAML setup file for the vehicle ownership model
+        port (int): port of the local socket the server listens on
+    """
+
+    def __init__(self,
+                 va_setup_file: str,
+                 model_setup_file: str,
+                 port: int = DEFAULT_PORT):
+        self.va_setup_file = va_setup_file
+        self.model_setup_file = model_setup_file
+        self.port = port
+
+        #tables kept between runs, keyed by (table name, file size and modification time)
+        self.tables = {}
+        self.started = perf_counter()
+        self.runs = 0
+
+    # method serve:
+    # accept requests until a shutdown request is received
+    def serve(self):
+        try:
+            server = socket.create_server(('127.0.0.1', self.port))
+        except OSError as err:
+            msg = "Error listening on port " + str(self.port) + " (is a server already running?).\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        print("VA model server listening on port " + str(self.port) + ": " + strftime("%H:%M:%S", localtime()))
+        with server:
+            running = True
+            while running:
+                conn, _ = server.accept()
+                with conn:
+                    try:
+                        running = self.serve_connection(conn)
+                    except Exception as err:
+                        #a bad request or a client that went away must not stop the server
+                        print("Error handling request.\n" + str(err))
+        print("VA model server stopped: " + strftime("%H:%M:%S", localtime()))
+
+    # method serve_connection:
+    # read a request from a connection and send its response, returning False if the server is to stop
+    def serve_connection(self, conn):
+        try:
+            request = json.loads(conn.makefile('r', encoding='utf-8').readline())
+        except ValueError as err:
+            send_message(conn, {'status': 'failed', 'exit_code': EXIT_FAILED, 'error': "Invalid request.\n" + str(err)})
+            return True
+        if not isinstance(request, dict):
+            send_message(conn, {'status': 'failed', 'exit_code': EXIT_FAILED, 'error': "Invalid request: not a JSON object."})
+            return True
+
+        response = self.handle(request)
+        try:
+            send_message(conn, response)
+        except OSError as err:
+            #the client went away; the run is complete regardless
+            print("Error sending response.\n" + str(err))
+        return request.get('command') != 'shutdown'
+
+    # method handle:
+    # return the response to a request
+    def handle(self, request):
+        command = request.get('command', 'run')
+        if command == 'ping':
+            return {'status': 'ok', 'exit_code': EXIT_OK, 'va_setup': self.va_setup_file,
+                    'model_setup': self.model_setup_file, 'runs': self.runs,
+                    'uptime_seconds': perf_counter() - self.started, 'tables': [key[0] for key in self.tables]}
+        if command == 'shutdown':
+            return {'status': 'ok', 'exit_code': EXIT_OK}
+        if command == 'run':
+            return self.run(request)
+        return {'status': 'failed', 'exit_code': EXIT_FAILED, 'error': "Unknown command '" + str(command) + "'."}
+
+    # method run:
+    # run the target of a run request with its setup overrides, returning the status, exit code and stage times
+    def run(self, request):
+        response = {'status': 'ok', 'exit_code': EXIT_FAILED, 'error': None, 'seconds': None,
+                    'stage_times': {}, 'skipped': []}
+        start = perf_counter()
+        self.runs += 1
+        pipeline = None
+        try:
+            target = request.get('target', 'pipeline')
+            if target not in TARGETS:
+                msg = "Unknown target '" + str(target) + "'; use one of " + ", ".join(TARGETS) + "."
+                raise RuntimeError(msg)
+            print("Run " + str(self.runs) + " (" + target + "): " + strftime("%H:%M:%S", localtime()))
+
+            va_overrides = check_overrides(request.get('va_overrides') or {}, 'va_overrides')
+            model_overrides = check_overrides(request.get('model_overrides') or {}, 'model_overrides')
+            max_workers = request.get('max_workers')
+            if max_workers is not None:
+                check_bounds('max_workers', max_workers)
+            pipeline = self.build_pipeline(target, va_overrides, model_overrides)
+            if target == 'model':
+                self.run_model(pipeline)
+            else:
+                #the intersection density is kept between runs unless the stage's output file is wanted
+                #(preprocess target) or the pipeline tracks its stages, which skips the stage if it is up to date
+                precomputed = None
+                if target == 'pipeline' and pipeline.tracker is None:
+                    pre = pipeline.preprocess
+                    precomputed = {'int_den_by_bg': self.table(('int_den', int_den_key(pre)),
+                                                               os.path.join(pre.in_folder, pre.smart_loc_file),
+                                                               lambda: pre.int_den_by_bg(write_output=False))}
+                pipeline.run(parallel=request.get('parallel', False), max_workers=max_workers,
+                             precomputed=precomputed)
+            response['exit_code'] = pipeline.exit_code()
+        except Exception as err:
+            print(err)
+            response['status'] = 'failed'
+            response['exit_code'] = EXIT_FAILED
+            response['error'] = str(err)
+
+        if pipeline is not None:
+            response['stage_times'] = pipeline.stage_times
+            response['skipped'] = pipeline.skipped
+        response['seconds'] = perf_counter() - start
+        return response
+
+    # method build_pipeline:
+    # create the pipeline for a run, giving its instances the tables kept from earlier runs
+    def build_pipeline(self, target, va_overrides, model_overrides):
+        model_setup_file = self.model_setup_file if target != 'preprocess' else None
+        pipeline = VAPipeline(self.va_setup_file, model_setup_file,
+                              write_intermediates=(target == 'preprocess'),
+                              va_overrides=va_overrides,
+                              model_overrides=model_overrides,
+                              specs=self.model_specs(model_setup_file, model_overrides))
+
+        pre = pipeline.preprocess
+        blk_fct_file = pre_blk_fct_path(pre)
+        pre.df_blk_fct = self.table(('pre_blk_fct', blk_fct_file), blk_fct_file, pre.load_blk_factors)
+        pre.split_index = self.table(('pre_split_index', blk_fct_file), blk_fct_file, pre.load_split_index)
+
+        model = pipeline.model
+        if model is not None:
+            blk_fct_file = model_blk_fct_path(model)
+            model.df_factors = self.table(('model_blk_fct', blk_fct_file, model.split_factor), blk_fct_file,
+                                          model.load_blk_factors)
+            model.split_index = self.table(('model_split_index', blk_fct_file, model.split_factor), blk_fct_file,
+                                           model.load_split_index)
+        return pipeline
+
+    # method model_specs:
+    # the parsed model specification file named by the model setup, kept between runs
+    def model_specs(self, model_setup_file, model_overrides):
+        if model_setup_file is None:
+            return None
+        #the base model class reads the setup file without parsing the model specification
+        from veh_own_model import VehModel
+        spec_file = VehModel(model_setup_file, overrides=model_overrides).model_spec_file
+        return self.table(('specs', os.path.abspath(spec_file)), spec_file, lambda: read_model_spec(spec_file))
+
+    # method run_model:
+    # run the model on the va model input file, as test_run.py does
+    def run_model(self, pipeline):
+        model = pipeline.model
+        pipeline.stage_times = {}
+        if model.chunk_rows:
+            pipeline.time_stage('run_chunked', model.run_chunked)
+        else:
+            pipeline.run_model_stages(None)
+        pipeline.report_stage_times()
+
+    # method table:
+    # return the table kept under name, calling loader to (re)read it if it is not kept
+    # or its file has changed size or modification time since it was read
+    def table(self, name, infile, loader):
+        try:
+            stat = os.stat(infile)
+        except OSError as err:
+            msg = "Error reading input file " + str(infile) + ".\n" + str(err)
+            raise RuntimeError(msg) from err
+        key = (name, stat.st_size, stat.st_mtime_ns)
+        if key not in self.tables:
+            #drop the version read from an earlier state of the file
+            self.tables = {kept: value for kept, value in self.tables.items() if kept[0] != name}
+            self.tables[key] = loader()
+        return self.tables[key]
+
+
+# function check_overrides:
+# return the setup overrides of a run request, raising an error if they aren't a JSON object, change a fixed
+# key (see FIXED_KEYS), hold a folder separator in any value (which could point the run outside the setup's
+# folders), give an empty file name or set a bounded key (see BOUNDED_KEYS) out of its bounds
+def check_overrides(overrides, name):
+    if not isinstance(overrides, dict):
+        msg = "Invalid " + name + ": not a JSON object."
+        raise RuntimeError(msg)
+    for key, value in overrides.items():
+        if key in FIXED_KEYS or key.endswith(FIXED_KEY_SUFFIXES):
+            msg = "Setting " + key + " can't be overridden by a run request."
+            raise RuntimeError(msg)
+        if any('/' in text or '\\' in text for text in string_values(value)):
+            msg = "Setting " + key + " can't name a folder: " + str(value) + "."
+            raise RuntimeError(msg)
+        if key.endswith('_file') and (not isinstance(value, str) or value in ('', '.', '..')):
+            msg = "Setting " + key + " must be a file name: " + str(value) + "."
+            raise RuntimeError(msg)
+        if key in BOUNDED_KEYS and value is not None:
+            check_bounds(key, value)
+    return overrides
+
+# function string_values:
+# the strings of an override value, including those in lists and objects
+def string_values(value):
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        value = list(value.keys()) + list(value.values())
+    if isinstance(value, list):
+        return [text for item in value for text in string_values(item)]
+    return []
+
+# function check_bounds:
+# raise an error unless value is an integer within the bounds of key in BOUNDED_KEYS
+def check_bounds(key, value):
+    low, high = BOUNDED_KEYS[key]
+    if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+        msg = "Setting " + key + " must be a whole number from " + str(low) + " to " + str(high) + ": " + str(value) + "."
+        raise RuntimeError(msg)
+
+# function send_message:
+# send a message as one line of JSON
+def send_message(conn, message):
+    conn.sendall((json.dumps(message, default=str) + "\n").encode('utf-8'))
+
+
+if __name__ == "__main__":
+    try:
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_PORT
+        ModelServer(sys.argv[1], sys.argv[2], port=port).serve()
+    except Exception as err:
+        print(err)
+        sys.exit(EXIT_FAILED)
+    sys.exit(EXIT_OK)
@@ -0,0 +1,154 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    #only csv output is available if pyarrow is not installed
+    pa = None
+
+OUTPUT_FORMATS = ['csv', 'parquet', 'feather']
+
+class TableWriter:
+    """
+    Writes a dataframe, or a sequence of dataframes appended one after the other (e.g. the batches of
+    VehModel.run_chunked), to an output file in csv, Parquet or Feather (Arrow IPC) format.
+
+    CSV output is byte-identical to DataFrame.to_csv. With csv_workers > 1, blocks of block_rows rows are
+    formatted by a pool of worker processes and streamed to the file in order as they are finished.
+    Parquet and Feather output is written with the given compression (e.g. 'zstd', 'lz4' or 'snappy'
+    for Parquet); each dataframe written becomes one or more row groups / record batches of the file.
+
+    Args:
+        out_file_path (str): path of the output file, replaced if it exists
+        output_format (str): 'csv', 'parquet' or 'feather'
+        columns (list): optional list of the columns to write, in order; by default all columns are written
+        index (bool): if True, the index of the dataframe is written as its first column(s)
+        compression (str): optional compression of Parquet and Feather files
+        csv_workers (int): number of processes formatting csv output
+        block_rows (int): rows formatted by a csv worker at a time
+    """
+
+    def __init__(self,
+                 out_file_path: str,
+                 output_format: str = 'csv',
+                 columns: list = None,
+                 index: bool = False,
+                 compression: str = None,
+                 csv_workers: int = 1,
+                 block_rows: int = 100000):
+        if output_format not in OUTPUT_FORMATS:
+            msg = "Unknown output format '" + str(output_format) + "'; use one of " + ", ".join(OUTPUT_FORMATS) + "."
+            raise RuntimeError(msg)
+        if output_format != 'csv' and pa is None:
+            msg = "Error: " + output_format + " output requires pyarrow, which is not installed."
+            raise RuntimeError(msg)
+
+        self.out_file_path = out_file_path
+        self.output_format = output_format
+        self.columns = columns
+        self.index = index
+        self.compression = compression
+        self.csv_workers = csv_workers
+        self.block_rows = block_rows
+
+        self.stream = None
+        self.arrow_writer = None
+        self.schema = None
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # method write:
+    # append the (projected) rows of df to the output file
+    def write(self, df):
+        if self.columns is not None:
+            missing = [col for col in self.columns if col not in df.columns]
+            if missing:
+                msg = "Output column(s) " + ", ".join(missing) + " are not in the results."
+                raise RuntimeError(msg)
+            df = df[self.columns]
+
+        if self.output_format == 'csv':
+            self.write_csv(df)
+        else:
+            self.write_arrow(df)
+
+    # method write_csv:
+    # format df as csv, in blocks formatted in parallel if csv_workers > 1
+    def write_csv(self, df):
+        header = self.stream is None
+        if self.stream is None:
+            #newline='' leaves the line endings chosen by to_csv untranslated, and utf-8 is the encoding
+            #to_csv uses, whatever the locale, as when to_csv writes the file
+            self.stream = open(self.out_file_path, 'w', newline='', encoding='utf-8')
+
+        if self.csv_workers <= 1 or len(df) <= self.block_rows:
+            self.stream.write(df.to_csv(index=self.index, header=header))
+            return
+
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.csv_workers)
+        blocks = [df.iloc[row_start:row_start + self.block_rows] for row_start in range(0, len(df), self.block_rows)]
+        headers = [header] + [False] * (len(blocks) - 1)
+        #map returns the formatted blocks in order, each as soon as it and those before it are done
+        for text in self.pool.map(format_csv_block, blocks, headers, [self.index] * len(blocks)):
+            self.stream.write(text)
+
+    # method write_arrow:
+    # append df to a Parquet or Feather file as Arrow record batches
+    def write_arrow(self, df):
+        #categorical columns are written as their values, so that every batch has the same column types
+        df = df.copy(deep=False)
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = np.asarray(df[col])
+        table = pa.Table.from_pandas(df, preserve_index=self.index)
+
+        if self.arrow_writer is None:
+            self.schema = table.schema
+            if self.output_format == 'parquet':
+                self.arrow_writer = pq.ParquetWriter(self.out_file_path, self.schema, compression=self.compression or 'snappy')
+            else:
+                options = ipc.IpcWriteOptions(compression=self.compression) if self.compression else None
+                self.arrow_writer = ipc.new_file(self.out_file_path, self.schema, options=options)
+        else:
+            table = table.cast(self.schema)
+
+        if self.output_format == 'parquet':
+            self.arrow_writer.write_table(table)
+        else:
+            for batch in table.to_batches():
+                self.arrow_writer.write_batch(batch)
+
+    # method close:
+    # finish the output file
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if self.arrow_writer is not None:
+            self.arrow_writer.close()
+            self.arrow_writer = None
+
+
+# function format_csv_block:
+# format a block of rows as csv text (run in a csv worker process)
+def format_csv_block(df_block, header, index):
+    return df_block.to_csv(index=index, header=header)
+
+# function write_table:
+# write df to out_file_path with a TableWriter (see TableWriter for the arguments)
+def write_table(df, out_file_path, **kwargs):
+    with TableWriter(out_file_path, **kwargs) as writer:
+        writer.write(df)
@@ -2,7 +2,16 @@ import pandas as pd
 import yaml
 import os
 import math
-from veh_own_model import VehModel
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from veh_own_model import VehModel, apply_dtypes
+from block_split import count_values, group_splits, add_split_counts
+from instrumentation import instrumented, row_count
+from shared_arrays import share_array, attach_array, release_arrays
+from spec_plan import compile_spec
+
+#shared arrays and model parameters of a scoring worker process, set by init_scoring_worker
+scoring_worker = {}
 
 class PoissonModel(VehModel):
     """
@@ -12,20 +21,22 @@ class PoissonModel(VehModel):
         setup (str): name of YAML file listing the folder path of the working directory,
         names of input and output files,the name of the model specification file,
         lists of required fields for output files and the name of the model specification yaml file
+        overrides (dict): optional setup parameters that replace those read from the setup file
+        specs (dict): optional, already parsed contents of the model specification file
     """
 
     def __init__(self,
-                 setup_file):
+                 setup_file,
+                 overrides=None,
+                 specs=None):
         #print("initializing...")
-        super().__init__(setup_file=setup_file)
+        super().__init__(setup_file=setup_file, overrides=overrides)
 
         #parse the model specification file
-        try:
-            with open(self.model_spec_file, 'r') as stream:
-                self.specs = yaml.load(stream, Loader=yaml.FullLoader)
-        except Exception as err:
-            msg = "Error reading model specification file (" + self.model_spec_file + ").\n" + str(err)
-            raise RuntimeError(msg) from err
+        if specs is not None:
+            self.specs = specs
+        else:
+            self.specs = read_model_spec(self.model_spec_file)
 
         try:
             self.field_map = self.specs['field_map']
@@ -34,99 +45,498 @@ class PoissonModel(VehModel):
             msg = "Required model specification parameter(s) were not found in file '" + self.model_spec_file + "'.\n" + str(err)
             raise RuntimeError(msg) from err
 
+        #compile the term (column or expression, see spec_plan.py) of each coefficient into an evaluation plan
+        self.plan = compile_spec(self.coeffs, self.field_map)
+
+        #optional: number of worker processes used by run_model; 1 scores the households in the main process
+        self.n_workers = self.setup.get('n_workers') or 1
+        #optional: if set, run_model scores each distinct covariate pattern once (see score_patterns)
+        self.compress_patterns = self.setup.get('compress_patterns', False)
+        #households, distinct covariate patterns and their ratio in the last compressed run_model
+        self.pattern_stats = None
+        #worker pool and shared arrays of score_parallel, kept for all the batches of run_chunked (see close_scoring)
+        self.scoring_pool = None
+        self.scoring_blocks = {}
+        self.keep_scoring = False
+
+        #optional: Monte Carlo simulation of household vehicle counts (see simulate)
+        self.sim_replications = self.setup.get('sim_replications')
+        self.sim_seed = self.setup.get('sim_seed', 0)
+        self.sim_shard_rows = self.setup.get('sim_shard_rows', 50000)
+        if self.sim_replications:
+            try:
+                self.output_sim_file = self.setup['output_sim_file']
+            except Exception as err:
+                msg = "Required setup parameter output_sim_file was not found for sim_replications.\n" + str(err)
+                raise RuntimeError(msg) from err
+
     # method load_data:
-    # read input data file into a pandas dataframe
+    # read input data file into a pandas dataframe, or use the dataframe passed in as df
+    # (e.g. the output of va_preprocess.assemble_va_inputs) instead of reading the file
     # verify that required model inputs are present in the dataframe
     # test1: keep just the first 1000 rows
-    def load_data(self):
+    # rows in are those of the dataframe passed in (None when the file is read); rows out those loaded
+    @instrumented(rows_in=lambda self, df=None: row_count(df))
+    def load_data(self, df=None):
         #read the csv file into a dataframe and capture the column names in a list
         #print("loading input data...")
         try:
-            infile  = self.data_path + "\\" + self.input_file
-            self.df = pd.read_csv(infile)
+            if df is None:
+                infile  = os.path.join(self.data_path, self.input_file)
+                self.df = pd.read_csv(infile, dtype=self.read_dtypes())
+            else:
+                self.df = df
             cols    = self.df.columns
             self.df = self.df.fillna(0)
         except Exception as err:
             msg = "Error reading input file " + self.input_file + " into dataframe.\n" + str(err)
             raise RuntimeError(msg) from err
 
-        #ensure that all model coefficients map to columns in the input dataframe
-        #the first dependent variable is the intercept / constant - ignore it
+        #convert the columns to the compact types of the input schema in the setup file
+        self.df = apply_dtypes(self.df, self.input_dtypes)
+        self.split_counts = None
 
-        keys = list(self.coeffs.keys())
-
-        #require that first coefficient is named 'intercept'
-        #then test here to make sure it exists
-        for i in range (1,len(self.coeffs)):
-            key = keys[i]
-            if len(self.field_map) == 0:
-                #field map is empty: the column names and coefficient names should be equivalent
-                if key not in cols:
-                    msg = "Coefficient '" + key + "' is not associated with a column in " + self.input_file + ".\n"
-                    raise RuntimeError(msg)
+        #ensure that every column used by the model terms is in the input dataframe
+        #the first dependent variable is the intercept / constant and uses no column
+        for key, term, col in self.plan.missing_columns(cols):
+            if term == col:
+                msg = "Coefficient '" + key + "' is not associated with a column in " + self.input_file + ".\n"
             else:
-                #get the column name associated with the coefficient from the field map
-                try:
-                    col  = self.field_map[key]
-                except Exception as err:
-                    msg = "Key '"  + key + "' not found in field map.\n" + str(err)
-                    raise RuntimeError(msg) from err
+                msg = "Column '" + col + "' of term '" + term + "' (coefficient '" + key + "') is not in " + self.input_file + ".\n"
+            raise RuntimeError(msg)
+
+    # method design_matrix:
+    # evaluate the model terms (columns or expressions of columns) into a single 2-D float array
+    # rows are households, columns follow the order of the coefficients in the model spec
+    def design_matrix(self, df):
+        return self.plan.design_matrix(df)
 
-                if col not in cols:
-                    msg = "Coefficient '" + key + "' is not associated with a column in " + self.input_file + ".\n" 
-                    raise RuntimeError(msg)
+    # method linear_predictor:
+    # apply the coefficients in the model spec to a design matrix, returning the log of the vehicle count
+    # the terms are accumulated in coefficient order so that the result is bit-identical to adding
+    # the coefficient / column products one column at a time
+    def linear_predictor(self, x_arr):
+        return linear_predictor(x_arr, np.array(list(self.coeffs.values()), dtype=np.float64))
 
     # method run_model:
     # add a column named 'log_veh' to the dataframe created by the load_data method
     # populate the new column by applying the coefficients in the model spec to the appropriate columns
+    # then derive the predicted vehicle count and the household vehicle flags with array operations
+    # with compress_patterns, each distinct covariate pattern is scored once (see score_patterns);
+    # otherwise, with n_workers > 1 the households are scored in a pool of worker processes (see score_parallel)
+    @instrumented()
     def run_model(self):
-
         try:
-            #convert the coefficient keys from a dictionary view to a list so that we can reference them by position
-            coeff_names = list(self.coeffs.keys())
-
-            #set the log of the vehicle count equal to the first coefficient, which should be the intercept
-            int_term = coeff_names[0]
-            self.df['log_veh'] = self.coeffs[int_term]
-        except Exception as err:
+            if self.compress_patterns or self.n_workers > 1:
+                x_arr = self.design_matrix(self.df)
+            else:
+                #calculate the log of the vehicle count block by block, without building the design matrix
+                log_veh = self.plan.evaluate(self.df)
+        except AttributeError as err:
             #failure here is most likely because the load_data method has not been run and the dataframe doesn't exist
             msg = "Unable to add a column to the input dataframe. Confirm that the load_data method is being executed before run_model.\n" + str(err)
             raise RuntimeError(msg) from err
+        except Exception as err:
+            msg = "Error applying model coefficients.\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        #sums pre-aggregated by an earlier run don't apply to this dataframe
+        self.split_counts = None
+        if self.compress_patterns:
+            log_veh, vehicles, flags = self.score_patterns(x_arr)
+        elif self.n_workers > 1:
+            log_veh, vehicles, flags = self.score_parallel(x_arr)
+        else:
+            #calculate the predicted household vehicle count
+            try:
+                vehicles = predict_vehicles(log_veh)
+            except Exception as err:
+                msg = "Error applying model coefficients.\n" + str(err)
+                raise RuntimeError(msg) from err
+
+            #set the household vehicle flags
+            try:
+                flags = vehicle_flags(vehicles, len(self.veh_fields))
+            except Exception as err:
+                msg = "Error setting household vehicle flags.\n" + str(err)
+                raise RuntimeError(msg) from err
+
+        self.df['log_veh'] = log_veh
+        self.df['vehicles'] = vehicles
+        for i in range(len(self.veh_fields)):
+            self.df[self.veh_fields[i]] = flags[:, i]
+
+        #convert the added columns to the types of the output schema in the setup file
+        apply_dtypes(self.df, self.output_dtypes)
+
+    # method score_patterns:
+    # score the households of the design matrix x_arr by distinct covariate pattern, returning the log vehicle
+    # counts, vehicle counts and vehicle flags of the households. The model terms are household dummies and zonal
+    # attributes, so many households share a row of the design matrix: each distinct row is scored once and the
+    # results are copied to the households with that row. As every household's result is computed by the same
+    # arithmetic on the same values, the output is identical to scoring each household.
+    # With aggregate output, the output_agg_fields are also summed by geography and block split from the patterns
+    # (see summarize_patterns). The number of households and patterns and their ratio are kept in pattern_stats
+    def score_patterns(self, x_arr):
+        try:
+            codes, first = pattern_codes([x_arr[:, j] for j in range(x_arr.shape[1])])
+            log_veh = self.linear_predictor(x_arr[first])
+            vehicles = predict_vehicles(log_veh)
+            flags = vehicle_flags(vehicles, len(self.veh_fields))
+        except Exception as err:
+            msg = "Error applying model coefficients to covariate patterns.\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        self.pattern_stats = {'households': len(codes), 'patterns': len(first),
+                              'ratio': len(codes) / len(first) if len(first) > 0 else None}
+        if self.aggregate:
+            self.split_counts = self.summarize_patterns(codes, flags)
+        return log_veh[codes], vehicles[codes], flags[codes]
+
+    # method summarize_patterns:
+    # sum the output_agg_fields by geography and block split (see BlockSplitIndex.split_counts) from the covariate
+    # patterns of the households (codes) and the vehicle flags of each pattern. Households are grouped by pattern,
+    # block, the other aggregate fields and their geography, and each group is counted once, weighted by its number
+    # of households. Whole number fields are counted exactly, so the counts equal those of split_hh_to_taz
+    def summarize_patterns(self, codes, pattern_flags):
+        flag_fields = self.agg_fields[1:]
+        in_fields = [field for field in flag_fields if field not in self.veh_fields]
+        in_values = count_values(self.df[in_fields])
 
-        #iterate over the remaining coefficients
-        #add the product of the coefficient and its corresponding column value to the log of the vehicle count
+        split_index = self.load_split_index()
         try:
-            for i in range (1, len(coeff_names)):
-                coeff_name = coeff_names[i]
-                #if the field_map is empty, the data column names and coefficient names should match
-                if len(self.field_map) == 0:
-                    col_name = coeff_name
+            #aggregate fields that are model terms on their own are part of the pattern already
+            block_ids = self.df['block_id'].to_numpy(dtype=np.float64)
+            geo = self.household_geo(self.df)
+            plain_columns = self.plan.plain_columns
+            group_keys = [in_values[:, j] for j in range(len(in_fields)) if in_fields[j] not in plain_columns]
+            if geo is not None:
+                group_keys.append(geo)
+            group_codes, group_first = pattern_codes([codes, block_ids] + group_keys)
+            counts = np.bincount(group_codes, minlength=len(group_first))
+
+            values = np.empty((len(group_first), len(flag_fields)), dtype=in_values.dtype)
+            for p, field in enumerate(flag_fields):
+                if field in self.veh_fields:
+                    values[:, p] = pattern_flags[codes[group_first], self.veh_fields.index(field)]
                 else:
-                    col_name = self.field_map[coeff_name]
-                
-                self.df['log_veh'] = self.df['log_veh'] + self.df[col_name] * self.coeffs[coeff_name]
+                    values[:, p] = in_values[group_first, in_fields.index(field)]
+            values *= counts[:, np.newaxis]
 
-            #calculate the predicted household vehicle count
-            self.df['vehicles'] = self.df.apply(lambda row: int(round(math.exp(row.log_veh),0)), axis=1)
+            return split_index.split_counts(block_ids[group_first], values, flag_fields,
+                                            None if geo is None else geo[group_first])
         except Exception as err:
-            msg = "Error applying model coefficients.\n" + str(err)
+            msg = "Error aggregating results by covariate pattern.\n" + str(err)
             raise RuntimeError(msg) from err
 
-        #set the household vehicle flags
+    # method simulate:
+    # draw the vehicle count of each household sim_replications times from the Poisson distribution with mean
+    # exp(log_veh), and return (and, if write_output is True, write to output_sim_file) the mean and variance
+    # across replications of the split factored vehicle count flags and vehicles by taz: the household's own taz,
+    # or the taz of each block split if split_taz is set (as in split_hh_to_taz)
+    # must be run after run_model and before split_hh_to_taz, on the dataframe of households
+    # households are simulated in shards of sim_shard_rows rows, all replications of a shard in one array,
+    # so memory depends on sim_shard_rows x sim_replications. Each shard draws from its own random stream,
+    # spawned from sim_seed, so results are reproducible for a given sim_seed and sim_shard_rows
+    @instrumented()
+    def simulate(self, write_output=True):
+        split_index = self.load_split_index()
+        n_veh = len(self.veh_fields)
+        fields = self.veh_fields + ['vehicles']
+
         try:
-            for i in range(len(self.veh_fields)):
-                veh_fld = self.veh_fields[i]
-
-                #initialize new column to zero
-                self.df[veh_fld] = 0
-
-                #check to make sure at least one household has a vehicle count of i
-                #python is apparently unhappy when asked to run lambda functions on an empty dataframe
-                if not(self.df.loc[self.df['vehicles'] == i].empty):
-                    if i < len(self.veh_fields) - 1:
-                        self.df[veh_fld] = self.df.apply(lambda row: 1 if row.vehicles == i else 0, axis=1)
-                    else:
-                        self.df[veh_fld] = self.df.apply(lambda row: 1 if row.vehicles >= i else 0, axis=1)
+            if self.split_taz:
+                geo_codes, geo_ids = pd.factorize(split_index.taz, sort=True)
+                household_codes = None
+            else:
+                household_codes, geo_ids = pd.factorize(self.df['taz'], sort=True)
+                geo_codes = None
+            totals = np.zeros((len(geo_ids), len(fields), self.sim_replications))
+            geo_used = np.zeros(len(geo_ids), dtype=bool)
+
+            shard_starts = range(0, len(self.df), self.sim_shard_rows)
+            streams = np.random.SeedSequence(self.sim_seed).spawn(len(shard_starts))
+            for row_start, stream in zip(shard_starts, streams):
+                df_shard = self.df.iloc[row_start:row_start + self.sim_shard_rows]
+                log_veh = self.plan.evaluate(df_shard)
+                shard_codes = None if household_codes is None else household_codes[row_start:row_start + self.sim_shard_rows]
+                shard_totals, shard_used = simulate_shard(log_veh, df_shard['block_id'], split_index, geo_codes,
+                                                          len(geo_ids), n_veh, self.sim_replications, stream,
+                                                          household_codes=shard_codes)
+                totals += shard_totals
+                geo_used |= shard_used
+        except Exception as err:
+            msg = "Error simulating household vehicles.\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        totals = totals[geo_used]
+        ddof = 1 if self.sim_replications > 1 else 0
+        df_sim = pd.DataFrame(index=pd.Index(geo_ids[geo_used], name='taz'))
+        for j, field in enumerate(fields):
+            df_sim[field + '_mean'] = totals[:, j].mean(axis=1)
+            df_sim[field + '_var'] = totals[:, j].var(axis=1, ddof=ddof)
+
+        if write_output:
+            try:
+                with self.output_writer(self.output_sim_file, index=True) as writer:
+                    writer.write(df_sim)
+            except Exception as err:
+                msg = "Error writing simulation output to file.\n" + str(err)
+                raise RuntimeError(msg) from err
+        return df_sim
+
+    # method score_parallel:
+    # score the households of the design matrix x_arr in a pool of n_workers processes, returning the log vehicle
+    # counts, vehicle counts and vehicle flags. The design matrix and the results are held in shared memory, so
+    # workers read and write their shards of the households without copies being passed between processes.
+    # If aggregate output is requested, each worker also counts the output_agg_fields of its shard by geography
+    # and block split (see BlockSplitIndex.split_counts); the counts of the shards are added in split_counts, from
+    # which summarize_results computes the sums. The scores are bit-identical to those of the serial path, and so
+    # are the sums: whole number counts are added exactly, whatever the shards and the order they finish in.
+    # Within run_chunked, the pool and the shared arrays are kept for all the batches (see shared_buffer)
+    def score_parallel(self, x_arr):
+        n_hh = x_arr.shape[0]
+        n_veh = len(self.veh_fields)
+        coeff_vals = np.array(list(self.coeffs.values()), dtype=np.float64)
+
+        arrays = {'x': x_arr}
+        agg_setup = None
+        if self.aggregate:
+            split_index = self.load_split_index()
+            #each aggregate field is either a vehicle flag set by the workers or a column of the input
+            flag_fields = self.agg_fields[1:]
+            in_fields = [field for field in flag_fields if field not in self.veh_fields]
+            sources = [('veh', self.veh_fields.index(field)) if field in self.veh_fields else ('in', in_fields.index(field))
+                       for field in flag_fields]
+            arrays['agg_in'] = count_values(self.df[in_fields])
+            arrays['block_id'] = self.df['block_id'].to_numpy(dtype=np.float64)
+            #households are counted by the codes of their own geography, unless each split takes its taz
+            geo = self.household_geo(self.df)
+            if geo is not None:
+                arrays['geo'], geo_ids = pd.factorize(geo, sort=True)
+            agg_setup = (split_index, flag_fields, sources, geo is not None)
+
+        specs = {}
+        views = {}
+        try:
+            for name, arr in arrays.items():
+                views[name], specs[name] = self.shared_buffer(name, arr.shape, arr.dtype)
+                views[name][...] = arr
+            for name, shape, dtype in [('log_veh', (n_hh,), np.float64), ('vehicles', (n_hh,), np.int64),
+                                       ('flags', (n_hh, n_veh), np.int64)]:
+                views[name], specs[name] = self.shared_buffer(name, shape, dtype)
+
+            if self.scoring_pool is None:
+                self.scoring_pool = ProcessPoolExecutor(max_workers=self.n_workers, initializer=init_scoring_worker,
+                                                        initargs=(coeff_vals, n_veh, agg_setup))
+            #several shards per worker, so that workers finishing early pick up more work
+            shard_rows = max(1, -(-n_hh // (4 * self.n_workers)))
+            shards = [(specs, row_start, min(row_start + shard_rows, n_hh)) for row_start in range(0, n_hh, shard_rows)]
+            shard_counts = list(self.scoring_pool.map(score_shard, shards))
+
+            results = [np.array(views[name]) for name in ['log_veh', 'vehicles', 'flags']]
         except Exception as err:
-            msg = "Error setting household vehicle flags.\n" + str(err)
+            msg = "Error scoring households in parallel.\n" + str(err)
             raise RuntimeError(msg) from err
+        finally:
+            views.clear()
+            if not self.keep_scoring:
+                self.close_scoring()
+
+        if self.aggregate:
+            counts = None
+            for more in shard_counts:
+                counts = add_split_counts(counts, more)
+            if geo is not None and counts is not None:
+                #replace the geography codes by the geographies, which are sorted in the same order
+                counts.index = counts.index.set_levels(geo_ids[counts.index.levels[0]], level=0)
+            self.split_counts = counts
+        return results
+
+    # method shared_buffer:
+    # return a view of the first rows of the shared array name of score_parallel and its spec, (re)creating the
+    # array if it doesn't exist or can't hold them; arrays are kept between calls until close_scoring
+    def shared_buffer(self, name, shape, dtype):
+        kept = self.scoring_blocks.get(name)
+        if kept is not None:
+            spec = kept[2]
+            if spec['shape'][0] < shape[0] or spec['shape'][1:] != tuple(shape[1:]) or spec['dtype'] != np.dtype(dtype).str:
+                #the view of the array must be dropped before its block can be closed
+                shm = self.scoring_blocks.pop(name)[0]
+                kept = None
+                release_arrays([shm])
+        if kept is None:
+            kept = share_array(shape=shape, dtype=dtype)
+            self.scoring_blocks[name] = kept
+        shm, view, spec = kept
+        return view[:shape[0]], spec
+
+    # method close_scoring:
+    # shut down the worker pool of score_parallel and release its shared arrays
+    def close_scoring(self):
+        if self.scoring_pool is not None:
+            self.scoring_pool.shutdown()
+            self.scoring_pool = None
+        blocks = [kept[0] for kept in self.scoring_blocks.values()]
+        self.scoring_blocks = {}
+        release_arrays(blocks)
+
+    # method run_chunked:
+    # stream the households through the model in batches as VehModel.run_chunked does, scoring every batch
+    # in the same worker pool and shared arrays (see score_parallel), which are released once all batches are done
+    def run_chunked(self, chunk_rows=None):
+        self.keep_scoring = True
+        try:
+            super().run_chunked(chunk_rows)
+        finally:
+            self.keep_scoring = False
+            self.close_scoring()
+
+
+# function read_model_spec:
+# parse a model specification file
+def read_model_spec(model_spec_file):
+    try:
+        with open(model_spec_file, 'r') as stream:
+            return yaml.load(stream, Loader=yaml.FullLoader)
+    except Exception as err:
+        msg = "Error reading model specification file (" + model_spec_file + ").\n" + str(err)
+        raise RuntimeError(msg) from err
+
+# function predict_vehicles:
+# convert an array of log vehicle counts into integer vehicle counts
+# matches int(round(math.exp(x), 0)) exactly, including round-half-to-even: np.rint rounds half to even,
+# and the few values whose exponential lies within rounding distance of a .5 boundary are recomputed with
+# math.exp so that a last-bit difference between the numpy and libm exponentials cannot flip the result
+def predict_vehicles(log_veh):
+    veh = np.exp(log_veh)
+    frac = veh - np.floor(veh)
+    near_half = np.flatnonzero(np.abs(frac - 0.5) <= 4 * np.spacing(veh))
+    for j in near_half:
+        veh[j] = math.exp(log_veh[j])
+    return np.rint(veh).astype(np.int64)
+
+# function vehicle_flags:
+# return an (n households x n_fields) array of 0 / 1 vehicle count flags
+# column i flags households with exactly i vehicles; the final column flags households with i or more vehicles
+def vehicle_flags(vehicles, n_fields):
+    codes = np.minimum(vehicles, n_fields - 1)
+    flags = np.zeros((len(vehicles), n_fields), dtype=np.int64)
+    flags[np.arange(len(vehicles)), codes] = 1
+    return flags
+
+# function linear_predictor:
+# apply the coefficient values (intercept first) to a design matrix, returning the log of the vehicle count
+# the terms are accumulated in coefficient order so that the result is bit-identical to adding
+# the coefficient / column products one column at a time
+def linear_predictor(x_arr, coeff_vals):
+    log_veh = np.full(x_arr.shape[0], coeff_vals[0])
+    for i in range(1, len(coeff_vals)):
+        log_veh += x_arr[:, i-1] * coeff_vals[i]
+    return log_veh
+
+# function init_scoring_worker:
+# store the model parameters in a scoring worker process
+def init_scoring_worker(coeff_vals, n_veh, agg_setup):
+    scoring_worker['specs'] = {}
+    scoring_worker['blocks'] = []
+    scoring_worker['coeff_vals'] = coeff_vals
+    scoring_worker['n_veh'] = n_veh
+    scoring_worker['agg_setup'] = agg_setup
+
+# function attach_scoring_arrays:
+# attach a scoring worker process to the shared arrays described by specs, unless it is already attached to them
+# the arrays of an earlier batch that were replaced (e.g. by larger ones) are closed
+def attach_scoring_arrays(specs):
+    if specs == scoring_worker['specs']:
+        return
+    for name in scoring_worker['specs']:
+        del scoring_worker[name]
+    for shm in scoring_worker['blocks']:
+        shm.close()
+    scoring_worker['blocks'] = []
+    for name, spec in specs.items():
+        shm, scoring_worker[name] = attach_array(spec)
+        scoring_worker['blocks'].append(shm)
+    scoring_worker['specs'] = specs
+
+# function score_shard:
+# score households row_start to row_end-1 in a worker process, writing the results to the shared arrays of specs
+# returns the split_counts of the aggregate fields of the shard's households by geography (the taz of each
+# split, or the household geography codes) and block split, or None if no aggregate output is requested
+def score_shard(shard):
+    specs, row_start, row_end = shard
+    attach_scoring_arrays(specs)
+    log_veh = linear_predictor(scoring_worker['x'][row_start:row_end], scoring_worker['coeff_vals'])
+    vehicles = predict_vehicles(log_veh)
+    flags = vehicle_flags(vehicles, scoring_worker['n_veh'])
+    scoring_worker['log_veh'][row_start:row_end] = log_veh
+    scoring_worker['vehicles'][row_start:row_end] = vehicles
+    scoring_worker['flags'][row_start:row_end] = flags
+
+    if scoring_worker['agg_setup'] is None:
+        return None
+    split_index, flag_fields, sources, household_geo = scoring_worker['agg_setup']
+
+    #the same values as the split_hh_to_taz columns before the split factors are applied
+    agg_in = scoring_worker['agg_in'][row_start:row_end]
+    values = np.empty((row_end - row_start, len(sources)), dtype=agg_in.dtype)
+    for p, (source, j) in enumerate(sources):
+        values[:, p] = flags[:, j] if source == 'veh' else agg_in[:, j]
+    hh_rows, split_rows = split_index.expand(scoring_worker['block_id'][row_start:row_end])
+    if household_geo:
+        #households without a geography (code -1) are left out, as they are by a groupby
+        split_geo = scoring_worker['geo'][row_start:row_end][hh_rows]
+        keep = split_geo >= 0
+        hh_rows, split_rows, split_geo = hh_rows[keep], split_rows[keep], split_geo[keep]
+    else:
+        split_geo = split_index.taz[split_rows]
+    return group_splits(split_geo, split_rows, values[hh_rows], flag_fields)
+
+# function pattern_codes:
+# number the distinct rows of a set of equal length key arrays in order of first appearance
+# returns the number of each row's pattern and the position of the first row of each pattern
+# the codes of the keys are combined as the digits of a mixed-radix number, which is renumbered
+# whenever another key could overflow it, so any number of keys can be combined
+def pattern_codes(keys):
+    codes = np.zeros(len(keys[0]) if keys else 0, dtype=np.int64)
+    n_codes = 1
+    for key in keys:
+        key_codes, key_values = pd.factorize(key, use_na_sentinel=False)
+        if n_codes * len(key_values) >= 2**62:
+            codes, uniques = pd.factorize(codes)
+            n_codes = len(uniques)
+        codes = codes * len(key_values) + key_codes
+        n_codes *= len(key_values)
+    codes = pd.factorize(codes)[0]
+    #patterns are numbered in order of appearance, so a pattern's first row is where the running maximum code rises
+    if len(codes) == 0:
+        return codes, codes
+    first = np.flatnonzero(np.diff(np.maximum.accumulate(codes), prepend=-1) > 0)
+    return codes, first
+
+# function simulate_shard:
+# draw n_rep Poisson vehicle counts for each household of a shard, from a random stream seeded by seed_seq,
+# and sum the split factored vehicle count flags and vehicles by taz and replication
+# geo_codes gives the taz code of each block split, unless household_codes gives the taz code of each household
+# returns an (n_geo x n_veh + 1 x n_rep) array of sums and a flag for each taz the shard's households are split to
+def simulate_shard(log_veh, block_ids, split_index, geo_codes, n_geo, n_veh, n_rep, seed_seq, household_codes=None):
+    rng = np.random.default_rng(seed_seq)
+    draws = rng.poisson(np.exp(log_veh)[:, np.newaxis], size=(len(log_veh), n_rep))
+
+    hh_rows, split_rows = split_index.expand(block_ids)
+    split_geo = geo_codes[split_rows] if household_codes is None else household_codes[hh_rows]
+    keep = split_geo >= 0
+    hh_rows, split_geo, factors = hh_rows[keep], split_geo[keep], split_index.factors[split_rows[keep]]
+
+    #one bincount cell per (taz, replication)
+    cells = (split_geo[:, np.newaxis] * n_rep + np.arange(n_rep)).ravel()
+    split_draws = draws[hh_rows]
+    split_codes = np.minimum(split_draws, n_veh - 1)
+    totals = np.empty((n_geo, n_veh + 1, n_rep))
+    for k in range(n_veh):
+        weights = ((split_codes == k) * factors[:, np.newaxis]).ravel()
+        totals[:, k] = np.bincount(cells, weights=weights, minlength=n_geo * n_rep).reshape(n_geo, n_rep)
+    weights = (split_draws * factors[:, np.newaxis]).ravel()
+    totals[:, n_veh] = np.bincount(cells, weights=weights, minlength=n_geo * n_rep).reshape(n_geo, n_rep)
+    return totals, np.bincount(split_geo, minlength=n_geo) > 0
@@ -1,49 +1,26 @@
-from va_preprocessors import va_preprocess
-from poisson_veh_model import PoissonModel
+import sys
+from va_pipeline import VAPipeline
+from instrumentation import EXIT_FAILED
 from time import localtime, strftime
 
-try:
-    print("Start pre-processor: " + strftime("%H:%M:%S", localtime()))
-    preprocess = va_preprocess("D:\\Projects\\veh_ownership_model_app\\code\\va_setup_2020.yml")
+#the main module guard is required for the worker processes used to run preprocessing stages in parallel
+if __name__ == "__main__":
+    #exit code 0: success, 1: failed, 2: completed with stages slower than slow_stage_seconds
+    status = EXIT_FAILED
+    try:
+        print("Start pre-processor: " + strftime("%H:%M:%S", localtime()))
 
-    print("Calculating employment accessibility: " + strftime("%H:%M:%S", localtime()))
-    preprocess.emp_accessibility_by_taz()
+        #Note: in order to execute model application from a TransCAD macro, the full path to the setup files must be specified
+        #Intermediate files are passed between stages in memory. Set write_intermediates to True to also write them to disk
+        pipeline = VAPipeline("D:\\Projects\\veh_ownership_model_app\\code\\va_setup_2020.yml",
+                              "D:\\Projects\\veh_ownership_model_app\\code\\utah_poisson_setup.yml",
+                              write_intermediates=False)
 
-    print("Calculating activity density: " + strftime("%H:%M:%S", localtime()))
-    preprocess.activity_den_by_taz()
+        #Independent preprocessing stages run in parallel
+        pipeline.run(parallel=True)
+        status = pipeline.exit_code()
 
-    print("Calculating intersection density: " + strftime("%H:%M:%S", localtime()))
-    preprocess.int_den_by_bg()
+    except Exception as err:
+        print(err)
 
-    print("Assembling VA model inputs: " + strftime("%H:%M:%S", localtime()))
-    preprocess.assemble_va_inputs()
-    
-    print("Start model: " + strftime("%H:%M:%S", localtime()))
-    
-    #Note: in order to execute model application from a TransCAD macro, the full path to the setup file must be specified
-    my_model = PoissonModel("D:\\Projects\\veh_ownership_model_app\\code\\utah_poisson_setup.yml")
-
-    print("Loading data: " + strftime("%H:%M:%S", localtime()))
-
-    my_model.load_data()
-
-    print("Running model: " + strftime("%H:%M:%S", localtime()))
-
-    my_model.run_model()
-
-    print("Factoring block data to taz: " + strftime("%H:%M:%S", localtime()))
-
-    my_model.split_hh_to_taz()
-
-    print("Saving disaggregate data: " + strftime("%H:%M:%S", localtime()))
-
-    my_model.save_results()
-
-    if my_model.aggregate:
-        print("Aggregating results: " + strftime("%H:%M:%S", localtime()))
-        my_model.aggregate_results()
-
-    print("End model: " + strftime("%H:%M:%S", localtime()))
-
-except Exception as err:
-    print(err)
+    sys.exit(status)
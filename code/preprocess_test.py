@@ -1,26 +1,24 @@
-from va_preprocessors import va_preprocess
+import sys
+from va_pipeline import VAPipeline
+from instrumentation import EXIT_FAILED
 from time import localtime, strftime
 
-try:
-    print("Start pre-processor: " + strftime("%H:%M:%S", localtime()))
-    preprocess = va_preprocess("D:\\Projects\\veh_ownership_model_app\\code\\va_setup_2020.yml")
+#the main module guard is required for the worker processes used to run preprocessing stages in parallel
+if __name__ == "__main__":
+    #exit code 0: success, 1: failed, 2: completed with stages slower than slow_stage_seconds
+    status = EXIT_FAILED
+    try:
+        print("Start pre-processor: " + strftime("%H:%M:%S", localtime()))
 
-    print("Calculating employment accessibility: " + strftime("%H:%M:%S", localtime()))
-    preprocess.emp_accessibility_by_taz()
+        #Independent stages (employment accessibility, activity density, intersection density) run in parallel
+        #Each stage writes its output file, as the model reads the assembled va input file from disk
+        pipeline = VAPipeline("D:\\Projects\\veh_ownership_model_app\\code\\va_setup_2020.yml",
+                              write_intermediates=True)
 
-    print("Calculating activity density: " + strftime("%H:%M:%S", localtime()))
-    preprocess.activity_den_by_taz()
+        pipeline.run(parallel=True)
+        status = pipeline.exit_code()
 
-    print("Calculating intersection density: " + strftime("%H:%M:%S", localtime()))
-    preprocess.int_den_by_bg()
+    except Exception as err:
+        print(err)
 
-    print("Assembling VA model inputs: " + strftime("%H:%M:%S", localtime()))
-    preprocess.assemble_va_inputs()
-
-    print("End pre-processor: " + strftime("%H:%M:%S", localtime()))
-
-except Exception as err:
-    print(err)
-
-
-                           
+    sys.exit(status)
@@ -0,0 +1,34 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+#numpy arrays held in shared memory blocks, so that worker processes can read and write them without
+#each receiving a pickled copy. The creating process passes the array's spec (block name, shape and type)
+#to the workers, which attach to the block, and closes and unlinks the block when they are done
+
+# function share_array:
+# copy arr into a new shared memory block, or create an uninitialized block of shape and dtype if arr is None
+# returns the SharedMemory object, a numpy view of the block and the spec used by attach_array
+def share_array(arr=None, shape=None, dtype=None):
+    if arr is not None:
+        shape, dtype = arr.shape, arr.dtype
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    #a block can't be empty
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if arr is not None:
+        view[...] = arr
+    return shm, view, {'name': shm.name, 'shape': tuple(shape), 'dtype': dtype.str}
+
+# function attach_array:
+# attach to the shared memory block described by spec, returning the SharedMemory object and a numpy view
+def attach_array(spec):
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    return shm, np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=shm.buf)
+
+# function release_arrays:
+# close and unlink shared memory blocks created by share_array
+def release_arrays(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
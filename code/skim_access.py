@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import numpy as np
+import openmatrix as omx
+from input_cache import file_fingerprint
+
+class SkimAccessor:
+    """
+    Row-sliced access to one core of an OMX skim file. Rows are read from the file on demand,
+    in blocks aligned with the HDF5 chunk layout of the core, so a whole skim is never held in memory.
+
+    If a cache folder is given, the core is also copied once to an uncompressed .npy file that later
+    runs memory-map instead of decompressing the OMX file again. The copy is stored as float32 when
+    that represents every value exactly (travel times exported by TransCAD do), and otherwise in the
+    core's own type, so results never depend on whether the cache is used. The copy is rebuilt when the
+    content of the OMX file changes, and skim files of the same name in different folders (e.g. scenarios)
+    get copies of their own.
+
+    Args:
+        skim_file (str): path of the OMX file
+        core_name (str): name of the matrix core
+        index_name (str): name of the zone mapping of the file
+        cache_folder (str): optional folder for the memory-mapped copies of skim cores
+    """
+
+    def __init__(self,
+                 skim_file: str,
+                 core_name: str,
+                 index_name: str,
+                 cache_folder: str = None):
+        self.skim_file = skim_file
+        self.core_name = core_name
+        self.omx_file = omx.open_file(skim_file, 'r')
+        #the file is closed if the core, its zones or its cached copy can't be read, as the caller gets no accessor to close
+        try:
+            self.core = self.omx_file[core_name]
+            #zone numbers in skim row / column order
+            self.zones = np.asarray(self.omx_file.mapentries(index_name), dtype=np.int64)
+
+            self.shape = tuple(int(n) for n in self.core.shape)
+            chunkshape = self.core.chunkshape
+            self.chunk_rows = chunkshape[0] if chunkshape is not None else 1
+
+            self.cached = None
+            if cache_folder is not None:
+                self.cached = self.load_cache(cache_folder)
+        except Exception:
+            self.omx_file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.omx_file.close()
+
+    def __getitem__(self, rows):
+        #rows is a slice of origin rows
+        if self.cached is not None:
+            return self.cached[rows]
+        return self.core[rows]
+
+    # method aligned_rows:
+    # round a number of rows up to a whole number of HDF5 chunks
+    def aligned_rows(self, block_rows):
+        return max(1, -(-block_rows // self.chunk_rows)) * self.chunk_rows
+
+    # method row_blocks:
+    # yield (first row, end row, rows) for consecutive blocks of about block_rows origin rows
+    # block boundaries are aligned with the HDF5 chunks so that each chunk is decompressed once
+    def row_blocks(self, block_rows):
+        block_rows = self.aligned_rows(block_rows)
+        for row_start in range(0, self.shape[0], block_rows):
+            row_end = min(row_start + block_rows, self.shape[0])
+            yield row_start, row_end, np.asarray(self[row_start:row_end])
+
+    # method load_cache:
+    # return a read-only memory map of the cached copy of the core, building the copy if it is missing
+    # or was made from a different version of the OMX file
+    # the copy is named by the content hash of the OMX file, so a file of that name always holds that content
+    # and a copy being built by another run is never mixed with a different one; the meta file, named by
+    # the absolute path of the OMX file, records the hash so that it is only recomputed when the file changes
+    def load_cache(self, cache_folder):
+        path_key = hashlib.sha1((os.path.abspath(self.skim_file) + "|" + self.core_name).encode("utf-8")).hexdigest()
+        base = os.path.join(cache_folder, os.path.basename(self.skim_file) + "." + self.core_name + "." + path_key[:16])
+        meta_file = base + ".json"
+
+        meta = None
+        try:
+            with open(meta_file, 'r') as stream:
+                meta = json.load(stream)
+        except (OSError, ValueError):
+            pass
+
+        fingerprint = file_fingerprint(self.skim_file, meta['source'] if meta is not None else None)
+        npy_file = base + "." + fingerprint['hash'][:16] + ".npy"
+        if os.path.exists(npy_file):
+            cached = np.load(npy_file, mmap_mode='r')
+            if meta is None or meta['source'] != fingerprint:
+                #the file was touched but not changed (or the meta file is missing): record its fingerprint
+                self.write_meta(meta_file, fingerprint, npy_file, str(cached.dtype))
+            return cached
+
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            dtype = self.build_cache(npy_file, np.float32)
+            if dtype is None:
+                dtype = self.build_cache(npy_file, self.core.dtype)
+            cached = np.load(npy_file, mmap_mode='r')
+            self.write_meta(meta_file, fingerprint, npy_file, str(np.dtype(dtype)))
+        except Exception as err:
+            msg = "Error caching skim " + self.skim_file + " core " + self.core_name + ".\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        #remove the copy of the previous version of the file (it may still be mapped by another run)
+        if meta is not None and meta.get('npy_file') not in (None, os.path.basename(npy_file)):
+            try:
+                os.remove(os.path.join(cache_folder, meta['npy_file']))
+            except OSError:
+                pass
+        return cached
+
+    # method build_cache:
+    # copy the core to npy_file as dtype, one row block at a time
+    # returns dtype, or None (leaving no file) if a value can't be represented exactly in dtype
+    def build_cache(self, npy_file, dtype):
+        tmp_file = npy_file + "." + str(os.getpid()) + ".tmp"
+        out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=self.shape)
+        try:
+            for row_start, row_end, rows in self.row_blocks(self.aligned_rows(500)):
+                out[row_start:row_end] = rows
+                if not np.array_equal(out[row_start:row_end], rows, equal_nan=True):
+                    del out
+                    os.remove(tmp_file)
+                    return None
+            out.flush()
+            del out
+            os.replace(tmp_file, npy_file)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        return dtype
+
+    def write_meta(self, meta_file, fingerprint, npy_file, dtype):
+        tmp_file = meta_file + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_file, 'w') as stream:
+            json.dump({'source': fingerprint, 'core': self.core_name, 'npy_file': os.path.basename(npy_file),
+                       'dtype': dtype}, stream, indent=1)
+        os.replace(tmp_file, meta_file)
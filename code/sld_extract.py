@@ -0,0 +1,120 @@
+# Build a state-partitioned extract of the EPA Smart Location Database
+#
+# usage: python sld_extract.py va_setup_file
+#
+# The national smart location file (smart_loc_file in the va setup file) is scanned once and the block group
+# intersection density metrics used by va_preprocess.int_den_by_bg - intden and pct4way - are written to a
+# Parquet dataset in sld_extract_folder, partitioned by state (SFIPS=<state fips>/part-0.parquet). Each partition
+# holds the GEOID10, intden and pct4way columns of one state's block groups, in the order of the national file
+# (which is ordered by GEOID10), so int_den_by_bg reads a single small file instead of scanning the national one.
+#
+# The extract records the fingerprint of the file it was built from (sld_extract.json); int_den_by_bg rebuilds
+# it if the smart location file changes. Building it with this script ahead of time keeps that scan out of
+# model runs.
+
+import json
+import os
+import shutil
+import sys
+import pandas as pd
+import yaml
+from input_cache import file_fingerprint
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    #without pyarrow, int_den_by_bg scans the smart location file
+    pa = None
+    pq = None
+
+#smart location database columns read by the extract
+SLD_COLUMNS = ['SFIPS', 'GEOID10', 'D3b', 'D3bao', 'D3bmm3', 'D3bmm4', 'D3bpo3', 'D3bpo4']
+META_NAME = "sld_extract.json"
+
+# function intersection_density:
+# derive the intersection density and percentage of 4-way intersections from smart location records,
+# returning a dataframe with blockgroup_id, intden and pct4way columns
+def intersection_density(df_sld):
+    df_int_den_bg = pd.DataFrame({'blockgroup_id': df_sld['GEOID10']})
+    df_int_den_bg['intden'] = df_sld['D3bao'] + df_sld['D3bmm3'] + df_sld['D3bmm4'] + df_sld['D3bpo3'] + df_sld['D3bpo4']
+    df_int_den_bg['pct4way'] = df_sld['D3bmm4'] + df_sld['D3bpo4']
+    return df_int_den_bg
+
+# function extract_sld:
+# scan the smart location file sld_file in chunks of chunk_rows records and write the intersection
+# density of each state's block groups to a partition of extract_folder, replacing any earlier extract
+def extract_sld(sld_file, extract_folder, chunk_rows=200000):
+    if pq is None:
+        msg = "Error: the smart location extract requires pyarrow, which is not installed."
+        raise RuntimeError(msg)
+
+    try:
+        fingerprint = file_fingerprint(sld_file)
+        states = {}
+        for chunk in pd.read_csv(sld_file, iterator=True, chunksize=chunk_rows, usecols=SLD_COLUMNS):
+            for state_fips, df_state in chunk.groupby('SFIPS', sort=False):
+                states.setdefault(int(state_fips), []).append(intersection_density(df_state))
+    except Exception as err:
+        msg = "Error reading EPA smart location file " + sld_file + ".\n" + str(err)
+        raise RuntimeError(msg) from err
+
+    #build the extract next to the old one and swap it in once complete
+    tmp_folder = extract_folder.rstrip("\\/") + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(tmp_folder, exist_ok=True)
+        for state_fips, frames in states.items():
+            df_state = pd.concat(frames, ignore_index=True)
+            partition = os.path.join(tmp_folder, "SFIPS=%d" % state_fips)
+            os.makedirs(partition, exist_ok=True)
+            pq.write_table(pa.Table.from_pandas(df_state, preserve_index=False), os.path.join(partition, "part-0.parquet"))
+        with open(os.path.join(tmp_folder, META_NAME), 'w') as stream:
+            json.dump({'source': fingerprint, 'states': sorted(states)}, stream, indent=1)
+
+        if os.path.exists(extract_folder):
+            shutil.rmtree(extract_folder)
+        os.replace(tmp_folder, extract_folder)
+    except Exception as err:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        msg = "Error writing smart location extract to " + extract_folder + ".\n" + str(err)
+        raise RuntimeError(msg) from err
+    return sorted(states)
+
+# function extract_is_current:
+# True if extract_folder holds an extract built from the current content of sld_file
+# the smart location file is only hashed again if its size or modification time changed
+def extract_is_current(sld_file, extract_folder):
+    try:
+        with open(os.path.join(extract_folder, META_NAME), 'r') as stream:
+            meta = json.load(stream)
+    except (OSError, ValueError):
+        return False
+    return file_fingerprint(sld_file, meta['source'])['hash'] == meta['source']['hash']
+
+# function read_state:
+# read the intersection density of one state's block groups from the extract
+# a state without block groups in the smart location file gives an empty dataframe
+def read_state(extract_folder, state_fips):
+    partition = os.path.join(extract_folder, "SFIPS=%d" % state_fips, "part-0.parquet")
+    if not os.path.exists(partition):
+        return pd.DataFrame({'blockgroup_id': pd.Series(dtype='int64'), 'intden': pd.Series(dtype='float64'),
+                             'pct4way': pd.Series(dtype='float64')})
+    return pq.read_table(partition).to_pandas()
+
+
+if __name__ == "__main__":
+    try:
+        with open(sys.argv[1], 'r') as stream:
+            setup = yaml.load(stream, Loader=yaml.FullLoader)
+        sld_file = os.path.join(setup['in_folder'], setup['smart_loc_file'])
+        extract_folder = setup['sld_extract_folder']
+    except Exception as err:
+        print("Error reading setup file.\n" + str(err))
+        sys.exit(1)
+
+    try:
+        states = extract_sld(sld_file, extract_folder)
+        print("Extracted " + str(len(states)) + " states to " + extract_folder)
+    except Exception as err:
+        print(err)
+        sys.exit(1)
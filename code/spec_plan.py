@@ -0,0 +1,179 @@
+import ast
+import json
+import numpy as np
+
+#Model term expressions
+#
+#Each coefficient of the model specification applies to a term: the input column named by the field map (or by
+#the coefficient itself if the field map is empty), or an expression of input columns, e.g.
+#    "log1p(actden)", "hhsize_cat1 * dum_income", "clip(intden, 0, 500)", "(workers > 1) * pct4way"
+#Expressions may use numeric constants, + - * / ** and unary -, a single comparison (giving 0 / 1) and the
+#functions in FUNCTIONS. They are parsed and checked once, compiled to Python code objects and evaluated with
+#NumPy on blocks of rows, so transformed and interaction terms don't need to be stored as input columns.
+
+#functions that may be called in term expressions
+FUNCTIONS = {'log': np.log, 'log1p': np.log1p, 'exp': np.exp, 'sqrt': np.sqrt, 'abs': np.abs,
+             'floor': np.floor, 'ceil': np.ceil, 'clip': np.clip, 'minimum': np.minimum,
+             'maximum': np.maximum, 'where': np.where}
+BINARY_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow)
+UNARY_OPS = (ast.UAdd, ast.USub)
+COMPARE_OPS = (ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+#plans already compiled in this process, keyed by the coefficients and field map they were compiled from
+compiled_plans = {}
+
+class ModelTerm:
+    """
+    One term of the linear predictor: a plain input column or a compiled expression of input columns
+
+    Args:
+        expr (str): column name or expression
+    """
+
+    def __init__(self, expr: str):
+        self.expr = expr.strip()
+        self.code = None
+        if self.expr.isidentifier():
+            #a plain column is used as is
+            self.columns = [self.expr]
+            return
+
+        try:
+            tree = ast.parse(self.expr, mode='eval')
+        except SyntaxError:
+            #not an expression: a column name that isn't a Python identifier (e.g. containing spaces)
+            self.columns = [self.expr]
+            return
+        self.columns = list(dict.fromkeys(check_node(tree.body)))
+        self.code = compile(tree, "<term " + self.expr + ">", 'eval')
+
+    @property
+    def plain(self):
+        return self.code is None
+
+    # method values:
+    # the values of the term for a block of rows, given the float64 column arrays of the block
+    def values(self, arrays, n_rows):
+        if self.code is None:
+            return arrays[self.expr]
+        namespace = dict(FUNCTIONS)
+        namespace.update({col: arrays[col] for col in self.columns})
+        result = eval(self.code, {'__builtins__': {}}, namespace)
+        return np.broadcast_to(np.asarray(result, dtype=np.float64), (n_rows,))
+
+
+class EvaluationPlan:
+    """
+    The linear predictor of a model specification, compiled once: the intercept, the term of each other
+    coefficient and the input columns the terms use. The predictor is evaluated in blocks of rows, fetching
+    each input column block once and accumulating the coefficient x term products in coefficient order, so
+    no full-length column is allocated per term and the result is bit-identical to adding the products of
+    the columns of a design matrix one at a time.
+
+    Args:
+        coeffs (dict): model coefficients, the intercept first
+        field_map (dict): column name or expression of each coefficient's term; if empty, the coefficient
+        names are the terms
+    """
+
+    def __init__(self,
+                 coeffs: dict,
+                 field_map: dict):
+        coeff_names = list(coeffs.keys())
+        self.coeff_names = coeff_names
+        self.coeff_vals = np.array(list(coeffs.values()), dtype=np.float64)
+
+        self.terms = []
+        for coeff_name in coeff_names[1:]:
+            if len(field_map) == 0:
+                expr = coeff_name
+            else:
+                try:
+                    expr = field_map[coeff_name]
+                except KeyError as err:
+                    msg = "Key '" + coeff_name + "' not found in field map.\n" + str(err)
+                    raise RuntimeError(msg) from err
+            try:
+                self.terms.append(ModelTerm(str(expr)))
+            except Exception as err:
+                msg = "Error compiling term '" + str(expr) + "' of coefficient '" + coeff_name + "'.\n" + str(err)
+                raise RuntimeError(msg) from err
+
+        #input columns used by the terms, in order of first use
+        self.columns = list(dict.fromkeys(col for term in self.terms for col in term.columns))
+        #columns that are terms on their own
+        self.plain_columns = [term.expr for term in self.terms if term.plain]
+
+    # method missing_columns:
+    # (coefficient, term, column) for each column used by a term that is not in columns
+    def missing_columns(self, columns):
+        columns = set(columns)
+        return [(self.coeff_names[i + 1], term.expr, col) for i, term in enumerate(self.terms)
+                for col in term.columns if col not in columns]
+
+    # method blocks:
+    # yield (first row, end row, float64 column arrays) for consecutive blocks of block_rows rows of df
+    def blocks(self, df, block_rows):
+        columns = {col: df[col].to_numpy() for col in self.columns}
+        for row_start in range(0, len(df), block_rows):
+            row_end = min(row_start + block_rows, len(df))
+            yield row_start, row_end, {col: np.asarray(arr[row_start:row_end], dtype=np.float64) for col, arr in columns.items()}
+
+    # method evaluate:
+    # return the linear predictor (log of the vehicle count) of each row of df
+    def evaluate(self, df, block_rows=65536):
+        log_veh = np.empty(len(df))
+        product = np.empty(min(block_rows, len(df)))
+        for row_start, row_end, arrays in self.blocks(df, block_rows):
+            out = log_veh[row_start:row_end]
+            out[:] = self.coeff_vals[0]
+            block_product = product[:row_end - row_start]
+            for i, term in enumerate(self.terms):
+                np.multiply(term.values(arrays, row_end - row_start), self.coeff_vals[i + 1], out=block_product)
+                out += block_product
+        return log_veh
+
+    # method design_matrix:
+    # return the values of the terms as a 2-D float array: rows of df by terms in coefficient order
+    def design_matrix(self, df, block_rows=65536):
+        x_arr = np.empty((len(df), len(self.terms)))
+        for row_start, row_end, arrays in self.blocks(df, block_rows):
+            for i, term in enumerate(self.terms):
+                x_arr[row_start:row_end, i] = term.values(arrays, row_end - row_start)
+        return x_arr
+
+
+# function compile_spec:
+# return the evaluation plan of the coefficients and field map of a model specification,
+# compiling it only the first time a specification is seen in the process
+def compile_spec(coeffs, field_map):
+    key = json.dumps([list(coeffs.items()), sorted((str(k), str(v)) for k, v in field_map.items())], default=str)
+    if key not in compiled_plans:
+        compiled_plans[key] = EvaluationPlan(coeffs, field_map)
+    return compiled_plans[key]
+
+# function check_node:
+# check that an expression node uses only the supported syntax, returning the column names it uses
+def check_node(node):
+    if isinstance(node, ast.Name):
+        #in an expression, the name would be the function rather than the column
+        if node.id in FUNCTIONS:
+            raise ValueError("Column '" + node.id + "' has the name of a function and can't be used in an expression")
+        return [node.id]
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ValueError("Unsupported constant " + repr(node.value))
+        return []
+    if isinstance(node, ast.BinOp) and isinstance(node.op, BINARY_OPS):
+        return check_node(node.left) + check_node(node.right)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, UNARY_OPS):
+        return check_node(node.operand)
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], COMPARE_OPS):
+        return check_node(node.left) + check_node(node.comparators[0])
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+            raise ValueError("Unsupported function " + ast.unparse(node.func) + "; available: " + ", ".join(FUNCTIONS))
+        if node.keywords:
+            raise ValueError("Keyword arguments are not supported in " + ast.unparse(node))
+        return [col for arg in node.args for col in check_node(arg)]
+    raise ValueError("Unsupported expression " + ast.unparse(node))
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+from input_cache import file_fingerprint
+
+class StageTracker:
+    """
+    Tracks the inputs and outputs of pipeline stages in a manifest file, so that a stage is only
+    rerun when something it depends on has changed. The state of a stage is the content hashes of
+    its input files and a hash of the setup values it uses; a stage is current if its state matches
+    the one recorded when it last ran and its output files are unchanged since then.
+
+    File contents are only hashed again when the size or modification time of a file differs from
+    the fingerprint in the manifest, so checking an unchanged stage costs a few stat calls.
+
+    Args:
+        manifest_file (str): JSON file recording the state and outputs of each stage
+    """
+
+    def __init__(self, manifest_file: str):
+        self.manifest_file = manifest_file
+        try:
+            with open(manifest_file, 'r') as stream:
+                self.manifest = json.load(stream)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    # method stage_state:
+    # return the state of a stage from its input files and a dict of the setup values it uses
+    # (values must be JSON serializable; other objects are compared by their str)
+    def stage_state(self, stage, input_files, config):
+        previous = self.manifest.get(stage, {})
+        try:
+            inputs = [self.fingerprint(infile, previous.get('inputs')) for infile in input_files]
+        except OSError as err:
+            msg = "Error reading input file of stage " + stage + ".\n" + str(err)
+            raise RuntimeError(msg) from err
+        config_text = json.dumps(config, sort_keys=True, default=str)
+        return {'inputs': inputs, 'config': hashlib.blake2b(config_text.encode("utf-8"), digest_size=20).hexdigest()}
+
+    # method is_current:
+    # True if the stage was recorded with the same state and its output files still exist unchanged
+    def is_current(self, stage, state, output_files):
+        entry = self.manifest.get(stage)
+        if entry is None or entry['config'] != state['config']:
+            return False
+        if content_hashes(entry['inputs']) != content_hashes(state['inputs']):
+            return False
+        if sorted(os.path.abspath(outfile) for outfile in output_files) != sorted(fp['path'] for fp in entry['outputs']):
+            return False
+        try:
+            outputs = [self.fingerprint(outfile, entry['outputs']) for outfile in output_files]
+        except OSError:
+            #an output file was removed
+            return False
+        return content_hashes(outputs) == content_hashes(entry['outputs'])
+
+    # method record:
+    # record the state a stage was run with and fingerprints of the output files it wrote
+    def record(self, stage, state, output_files):
+        try:
+            outputs = [file_fingerprint(outfile) for outfile in output_files]
+        except OSError as err:
+            msg = "Stage " + stage + " did not write its output file.\n" + str(err)
+            raise RuntimeError(msg) from err
+        self.manifest[stage] = {'inputs': state['inputs'], 'config': state['config'], 'outputs': outputs}
+        self.write_manifest()
+
+    # method fingerprint:
+    # fingerprint a file, reusing a matching fingerprint from a list recorded in the manifest
+    def fingerprint(self, infile, recorded):
+        path = os.path.abspath(infile)
+        previous = next((fp for fp in recorded or [] if fp['path'] == path), None)
+        return file_fingerprint(path, previous)
+
+    def write_manifest(self):
+        #write to a temporary file and rename, so an interrupted run never leaves a partial manifest
+        folder = os.path.dirname(os.path.abspath(self.manifest_file))
+        try:
+            os.makedirs(folder, exist_ok=True)
+            tmp_file = self.manifest_file + "." + str(os.getpid()) + ".tmp"
+            with open(tmp_file, 'w') as stream:
+                json.dump(self.manifest, stream, indent=1)
+            os.replace(tmp_file, self.manifest_file)
+        except Exception as err:
+            msg = "Error writing stage manifest " + self.manifest_file + ".\n" + str(err)
+            raise RuntimeError(msg) from err
+
+
+# function content_hashes:
+# (path, content hash) pairs of a list of file fingerprints, ignoring sizes and modification times
+def content_hashes(fingerprints):
+    return sorted((fp['path'], fp['hash']) for fp in fingerprints)
@@ -0,0 +1,19 @@
+rem start_model_server_trnscd06.bat
+rem
+rem start the warm VA model server (model_server.py) in its own console window, unless it is already running,
+rem and wait until it answers. The server keeps Python, the libraries, the model specification and the static
+rem lookup tables loaded between runs; runs are requested with va_client_trnscd06.bat.
+rem Stop it with: va_client_trnscd06.bat shutdown
+
+rem trnscd06
+rem In order to execute this script from a TransCAD macro, the full paths to the Python scripts and setup files must be specified
+rem The client only uses the standard library, so it is run with the environment's python without activating it
+set va_python=c:\ProgramData\Anaconda3\envs\va_model\python.exe
+set va_code=D:\Projects\veh_ownership_model_app\code
+
+%va_python% %va_code%\model_client.py ping
+if %errorlevel% equ 0 exit 0
+
+start "VA model server" cmd /k "call c:\ProgramData\Anaconda3\condabin\activate va_model && python %va_code%\model_server.py %va_code%\va_setup_2020.yml %va_code%\utah_poisson_setup.yml"
+%va_python% %va_code%\model_client.py ping --wait 120
+exit %errorlevel%
@@ -0,0 +1,198 @@
+# Synthetic inputs for the vehicle ownership model preprocessors and model
+#
+# usage: python synthetic_data.py folder [n_zones] [n_households]
+#
+# Writes a complete, self-consistent set of model inputs at a chosen scale - OMX skims, zonal employment,
+# group quarters and land area tables, block / taz lookups, UrbanSim person records and EPA smart location
+# rows - together with va and model setup files pointing at them. The files follow the layouts of the
+# real inputs named in va_setup_2020.yml and utah_poisson_setup.yml, so every preprocessing stage and model
+# method can be run against them (e.g. by benchmark_suite.py) on a machine without TransCAD or the MAPC data.
+
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+import openmatrix as omx
+import tables
+import yaml
+
+CODE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+#census block ids: state and county prefix, blocks numbered in steps of BLOCK_STEP so that
+#block_id // 1000 (the block group id) groups BLOCKS_PER_BG consecutive blocks
+BLOCK_BASE = 250250000000000
+BLOCK_STEP = 100
+BLOCKS_PER_BG = 1000 // BLOCK_STEP
+
+MANIFEST_NAME = "synthetic_manifest.json"
+
+# function zone_coordinates:
+# return the taz numbers and (x, y) coordinates in km of n_zones zones scattered over a square region
+def zone_coordinates(n_zones, rng, region_km=80.0):
+    taz = np.arange(1, n_zones + 1)
+    xy = rng.random((n_zones, 2)) * region_km
+    return taz, xy
+
+# function write_skims:
+# write sov and transit travel time skims (minutes, float32) for the zones to OMX files
+# times grow with distance; intrazonal times and transit pairs without service are 0, as in the TransCAD skims
+# rows are generated and written block_rows at a time, so 10,000 zone skims can be written in modest memory
+def write_skims(folder, setup, taz, xy, rng, block_rows=500):
+    n_zones = len(taz)
+    skims = [(setup['sov_skim_file'], setup['sov_skim_name'], 0.8, 2.0, 0.0),
+             (setup['transit_skim_file'], setup['transit_skim_name'], 0.35, 12.0, 0.3)]
+    for file_name, skim_name, km_per_min, base_min, no_service in skims:
+        skim_file = omx.open_file(os.path.join(folder, file_name), 'w')
+        try:
+            mtx = skim_file.create_matrix(skim_name, atom=tables.Float32Atom(), shape=(n_zones, n_zones))
+            for row_start in range(0, n_zones, block_rows):
+                row_end = min(row_start + block_rows, n_zones)
+                dist = np.hypot(xy[row_start:row_end, np.newaxis, 0] - xy[np.newaxis, :, 0],
+                                xy[row_start:row_end, np.newaxis, 1] - xy[np.newaxis, :, 1])
+                times = base_min + dist / km_per_min * rng.uniform(0.9, 1.3, size=dist.shape)
+                times[rng.random(dist.shape) < no_service] = 0
+                times[np.arange(row_end - row_start), np.arange(row_start, row_end)] = 0
+                mtx[row_start:row_end] = times.astype(np.float32)
+            skim_file.create_mapping(setup['skim_index'], taz)
+        finally:
+            skim_file.close()
+
+# function zone_tables:
+# return the employment, group quarters population and land area tables by taz
+def zone_tables(setup, taz, rng):
+    n_zones = len(taz)
+    emp = rng.lognormal(mean=5.5, sigma=1.2, size=(n_zones, 3)).round()
+    emp_cols = setup['emp_cols']
+    df_emp = pd.DataFrame({emp_cols[0]: taz, emp_cols[1]: emp.sum(axis=1)})
+    for i, col in enumerate(emp_cols[2:5]):
+        df_emp[col] = emp[:, i]
+    df_gq = pd.DataFrame({'taz': taz, 'gq_pop': np.where(rng.random(n_zones) < 0.1, rng.integers(1, 800, n_zones), 0)})
+    df_area = pd.DataFrame({'taz': taz, 'land_area': rng.uniform(0.05, 6.0, n_zones).round(4)})
+    return df_emp, df_gq, df_area
+
+# function block_tables:
+# return the whole block / taz lookup and the block / taz split factor table
+# each zone holds blocks_per_zone blocks; split_share of the blocks are split between their own taz and a
+# neighbouring one, with area factors that sum to 1
+def block_tables(taz, rng, blocks_per_zone=20, split_share=0.05):
+    n_blocks = len(taz) * blocks_per_zone
+    block_ids = BLOCK_BASE + np.arange(n_blocks, dtype=np.int64) * BLOCK_STEP
+    block_taz = np.repeat(taz, blocks_per_zone)
+    df_whole = pd.DataFrame({'block_id': block_ids, 'taz': block_taz})
+
+    split = rng.random(n_blocks) < split_share
+    factors = np.where(split, rng.uniform(0.05, 0.95, n_blocks).round(4), 1.0)
+    other_taz = taz[np.minimum(np.searchsorted(taz, block_taz) + 1, len(taz) - 1)]
+    df_split = pd.concat([pd.DataFrame({'block_id': block_ids, 'taz': block_taz, 'area_fct': factors}),
+                          pd.DataFrame({'block_id': block_ids[split], 'taz': other_taz[split],
+                                        'area_fct': (1.0 - factors[split]).round(4)})])
+    df_split = df_split.sort_values('block_id', kind='stable')
+    return df_whole, df_split
+
+# function person_records:
+# return UrbanSim style person records (one row per person, numbered by person_num within each household)
+# for n_households households placed in the given blocks
+def person_records(n_households, block_ids, rng):
+    persons = rng.choice(np.arange(1, 9), size=n_households, p=[0.28, 0.34, 0.16, 0.13, 0.05, 0.02, 0.01, 0.01])
+    workers = np.minimum(rng.binomial(persons, 0.5), 5)
+    hh_inc = np.round(rng.lognormal(mean=11.2, sigma=0.8, size=n_households), 0)
+    hh_block = rng.choice(block_ids, size=n_households)
+
+    hh_idx = np.repeat(np.arange(n_households), persons)
+    person_num = np.arange(len(hh_idx)) - np.repeat(np.cumsum(persons) - persons, persons) + 1
+    return pd.DataFrame({'hid': hh_idx + 1,
+                         'blockgroup_id': hh_block[hh_idx] // 1000,
+                         'block_id': hh_block[hh_idx],
+                         'persons': persons[hh_idx],
+                         'workers': workers[hh_idx],
+                         'hh_inc': hh_inc[hh_idx],
+                         'person_num': person_num,
+                         'age': rng.integers(0, 95, len(hh_idx))})
+
+# function smart_location_rows:
+# return EPA smart location database rows for the block groups, plus other_states times as many rows
+# for block groups outside Massachusetts (which int_den_by_bg filters out)
+def smart_location_rows(blockgroup_ids, rng, other_states=4):
+    n_ma = len(blockgroup_ids)
+    n_all = n_ma * (other_states + 1)
+    geoid = np.concatenate([blockgroup_ids, 330000000000 + np.arange(n_all - n_ma)])
+    df_sld = pd.DataFrame({'SFIPS': np.repeat([25, 33], [n_ma, n_all - n_ma]), 'GEOID10': geoid})
+    for col in ['D3b', 'D3bao', 'D3bmm3', 'D3bmm4', 'D3bpo3', 'D3bpo4']:
+        df_sld[col] = rng.gamma(1.5, 20.0, n_all).round(4)
+    return df_sld
+
+# function write_synthetic_inputs:
+# write every input file and a va and model setup file for n_zones zones and n_households households to folder
+# the setup files are based on va_setup_2020.yml and utah_poisson_setup.yml in the code folder, with the data
+# folders pointed at folder. If folder already holds inputs written with the same arguments they are reused
+# returns a dict with the paths of the va and model setup files
+def write_synthetic_inputs(folder, n_zones, n_households, seed=0, blocks_per_zone=20, split_share=0.05):
+    params = {'n_zones': n_zones, 'n_households': n_households, 'seed': seed,
+              'blocks_per_zone': blocks_per_zone, 'split_share': split_share}
+    setup_files = {'va_setup': os.path.join(folder, "va_setup.yml"),
+                   'model_setup': os.path.join(folder, "model_setup.yml")}
+
+    manifest_file = os.path.join(folder, MANIFEST_NAME)
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as stream:
+            if json.load(stream) == params:
+                return setup_files
+
+    try:
+        with open(os.path.join(CODE_PATH, "va_setup_2020.yml"), 'r') as stream:
+            va_setup = yaml.load(stream, Loader=yaml.FullLoader)
+        with open(os.path.join(CODE_PATH, "utah_poisson_setup.yml"), 'r') as stream:
+            model_setup = yaml.load(stream, Loader=yaml.FullLoader)
+    except Exception as err:
+        msg = "Error reading template setup files in " + CODE_PATH + ".\n" + str(err)
+        raise RuntimeError(msg) from err
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    path = lambda name: os.path.join(folder, name)
+
+    taz, xy = zone_coordinates(n_zones, rng)
+    write_skims(folder, va_setup, taz, xy, rng)
+
+    df_emp, df_gq, df_area = zone_tables(va_setup, taz, rng)
+    df_emp.to_csv(path(va_setup['taz_emp_file']), index=False)
+    df_gq.to_csv(path(va_setup['gq_pop_file']), index=False)
+    df_area.to_csv(path(va_setup['landarea_file']), index=False)
+
+    df_whole, df_split = block_tables(taz, rng, blocks_per_zone, split_share)
+    df_whole.to_csv(path(va_setup['blk_lut_file']), index=False)
+    df_split.to_csv(path(va_setup['blk_fct_file']), index=False)
+
+    df_persons = person_records(n_households, df_whole['block_id'].to_numpy(), rng)
+    df_persons.to_csv(path(va_setup['urbansim_file']), index=False)
+
+    blockgroup_ids = np.unique(df_whole['block_id'].to_numpy() // 1000)
+    smart_location_rows(blockgroup_ids, rng).to_csv(path(va_setup['smart_loc_file']), index=False)
+
+    va_setup['in_folder'] = folder
+    va_setup['out_folder'] = folder
+    model_setup['code_path'] = CODE_PATH
+    model_setup['data_file_path'] = folder
+    model_setup['input_data_file'] = va_setup['va_input_file']
+    model_setup['blk_fct_file'] = va_setup['blk_fct_file']
+    with open(setup_files['va_setup'], 'w') as stream:
+        yaml.safe_dump(va_setup, stream)
+    with open(setup_files['model_setup'], 'w') as stream:
+        yaml.safe_dump(model_setup, stream)
+
+    with open(manifest_file, 'w') as stream:
+        json.dump(params, stream)
+    return setup_files
+
+
+if __name__ == "__main__":
+    try:
+        folder = os.path.abspath(sys.argv[1])
+        n_zones = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+        n_households = int(sys.argv[3]) if len(sys.argv) > 3 else 200 * n_zones
+        setup_files = write_synthetic_inputs(folder, n_zones, n_households)
+        print("va setup:    " + setup_files['va_setup'])
+        print("model setup: " + setup_files['model_setup'])
+    except Exception as err:
+        print(err)
@@ -1,33 +1,65 @@
+import sys
 from poisson_veh_model import PoissonModel
+from instrumentation import exit_code, EXIT_FAILED
 from time import localtime, strftime
 
-try:
-    print("Start: " + strftime("%H:%M:%S", localtime()))
+#the main guard keeps worker processes started by run_model (n_workers) from re-running the script
+if __name__ == "__main__":
+    #exit code 0: success, 1: failed, 2: completed with stages slower than slow_stage_seconds
+    status = EXIT_FAILED
+    try:
+        print("Start: " + strftime("%H:%M:%S", localtime()))
     
-    #Note: in order to execute model application from a TransCAD macro, the full path to the setup file must be specified
-    my_model = PoissonModel("D:\\Projects\\veh_ownership_model_app\\code\\utah_poisson_setup.yml")
+        #Note: in order to execute model application from a TransCAD macro, the full path to the setup file must be specified
+        my_model = PoissonModel("D:\\Projects\\veh_ownership_model_app\\code\\utah_poisson_setup.yml")
 
-    print("Loading data: " + strftime("%H:%M:%S", localtime()))
+        if my_model.chunk_rows:
+            #stream households through the model in batches of chunk_rows rows
+            print("Running model in batches of " + str(my_model.chunk_rows) + " households: " + strftime("%H:%M:%S", localtime()))
 
-    my_model.load_data()
+            my_model.run_chunked()
 
-    print("Running model: " + strftime("%H:%M:%S", localtime()))
+        else:
+            print("Loading data: " + strftime("%H:%M:%S", localtime()))
 
-    my_model.run_model()
+            my_model.load_data()
 
-    print("Factoring block data to taz: " + strftime("%H:%M:%S", localtime()))
+            print("Running model: " + strftime("%H:%M:%S", localtime()))
 
-    my_model.split_hh_to_taz()
+            my_model.run_model()
+            if my_model.pattern_stats is not None:
+                print("Scored " + str(my_model.pattern_stats['patterns']) + " covariate patterns for " +
+                      str(my_model.pattern_stats['households']) + " households")
 
-    print("Saving disaggregate data: " + strftime("%H:%M:%S", localtime()))
+            if my_model.sim_replications:
+                print("Simulating vehicles: " + strftime("%H:%M:%S", localtime()))
+                my_model.simulate()
 
-    my_model.save_results()
+            if my_model.sparse_aggregate and my_model.aggregate:
+                #aggregate the household results directly with a sparse household -> taz matrix
+                print("Aggregating results: " + strftime("%H:%M:%S", localtime()))
+                my_model.aggregate_sparse()
 
-    if my_model.aggregate:
-        print("Aggregating results: " + strftime("%H:%M:%S", localtime()))
-        my_model.aggregate_results()
+            if my_model.split_output or not my_model.sparse_aggregate:
+                print("Factoring block data to taz: " + strftime("%H:%M:%S", localtime()))
 
-    print("End: " + strftime("%H:%M:%S", localtime()))
+                my_model.split_hh_to_taz()
 
-except Exception as err:
-    print(err)
+            print("Saving disaggregate data: " + strftime("%H:%M:%S", localtime()))
+
+            my_model.save_results()
+
+            if my_model.aggregate and not my_model.sparse_aggregate:
+                print("Aggregating results: " + strftime("%H:%M:%S", localtime()))
+                my_model.aggregate_results()
+
+        print("End: " + strftime("%H:%M:%S", localtime()))
+
+        if my_model.recorder.slow_stages():
+            print("Stages slower than slow_stage_seconds: " + ", ".join(my_model.recorder.slow_stages()))
+        status = exit_code([my_model.recorder])
+
+    except Exception as err:
+        print(err)
+
+    sys.exit(status)
@@ -8,4 +8,10 @@ rem c:\users\paul\AppData\Local\Continuum\anaconda3\condabin\activate va_model &
 
 rem trnscd06
 rem In order to execute this script from a TransCAD macro, the full path to the Python script must be specified
-c:\ProgramData\Anaconda3\condabin\activate va_model && python D:\Projects\veh_ownership_model_app\code\test_run.py & timeout /t 15
+rem The exit code of the Python script (0: success, 1: failed, 2: stages slower than slow_stage_seconds)
+rem is passed back to the calling macro
+call c:\ProgramData\Anaconda3\condabin\activate va_model
+python D:\Projects\veh_ownership_model_app\code\test_run.py
+set rc=%errorlevel%
+timeout /t 15
+exit %rc%
@@ -0,0 +1,175 @@
+# The preprocessing stages and Poisson model as first written, used as the reference for the tests
+#
+# The code follows the original va_preprocessors.py, veh_own_model.py and poisson_veh_model.py, with the row by row
+# apply and the merges they used, so that the rewritten stages can be checked against it. Only the paths are joined
+# with os.path.join instead of a Windows separator, so that it runs on any platform.
+
+import math
+import os
+import numpy as np
+import openmatrix as omx
+import pandas as pd
+
+# function emp_accessibility_by_taz:
+# the employment accessibility metrics by taz, as written to emp_access_file
+def emp_accessibility_by_taz(setup):
+    path = lambda name: os.path.join(setup['in_folder'], name)
+    with omx.open_file(path(setup['sov_skim_file']), 'r') as sov_file:
+        sov_arr = np.array(sov_file[setup['sov_skim_name']])
+        taz_map = sov_file.mapping(setup['skim_index'])
+        taz_keys = list(taz_map.keys())
+        taz_vals = list(taz_map.values())
+    with omx.open_file(path(setup['transit_skim_file']), 'r') as transit_file:
+        transit_arr = np.array(transit_file[setup['transit_skim_name']])
+
+    taz_map_df = pd.DataFrame(taz_keys, index=taz_vals, columns=['ID'])
+    emp_df = pd.read_csv(path(setup['taz_emp_file']), header=0, index_col=None, usecols=[0, 1])
+    emp_df2 = pd.merge(taz_map_df, emp_df, how="left", left_on="ID", right_on=setup['emp_cols'][0])
+    emp_arr = emp_df2[setup['emp_cols'][1]].to_numpy()
+    tot_emp = np.sum(emp_arr)
+
+    emp_access_df = taz_map_df
+    for arr, times, suffix in [(sov_arr, setup['sov_times'], 'a'), (transit_arr, setup['transit_times'], 't')]:
+        for time in times:
+            flag_arr = np.where(arr == 0, 0, (np.where(arr <= time, 1, 0)))
+            od_emp_arr = ((flag_arr.T) * emp_arr).T
+            o_emp_arr2 = np.sum(od_emp_arr, 0) / tot_emp
+            o_emp_df = pd.DataFrame(np.array([taz_keys, o_emp_arr2]).T, columns=['ID', 'pctemp' + str(time) + suffix])
+            emp_access_df = pd.merge(emp_access_df, o_emp_df, how="left", left_on="ID", right_on="ID")
+    return emp_access_df.rename(columns={"ID": "taz"})
+
+# function read_households:
+# the first person record of each UrbanSim household
+def read_households(setup):
+    iter_csv = pd.read_csv(os.path.join(setup['in_folder'], setup['urbansim_file']), iterator=True, chunksize=1000)
+    return pd.concat([chunk[chunk['person_num'] == 1] for chunk in iter_csv])
+
+# function jp_bal:
+# job / population balance metric of one taz
+def jp_bal(emp, hhpop, gqpop):
+    if emp == 0 and hhpop == 0 and gqpop == 0:
+        return 0
+    return 1 - (abs(emp - 0.2 * (hhpop + gqpop)) / (emp + 0.2 * (hhpop + gqpop)))
+
+# function activity_den_by_taz:
+# the activity density and job / population balance by taz, as written to act_den_file
+def activity_den_by_taz(setup):
+    path = lambda name: os.path.join(setup['in_folder'], name)
+    df_usim = read_households(setup)[['block_id', 'persons']]
+    df_blk_taz_lut = pd.read_csv(path(setup['blk_fct_file']), header=0, index_col=None)[['block_id', 'taz', 'area_fct']]
+    df_usim = pd.merge(df_usim, df_blk_taz_lut, left_on="block_id", right_on="block_id")
+    df_usim['hh_pop'] = df_usim['persons'] * df_usim['area_fct']
+    df_hh_pop_taz = df_usim[['taz', 'hh_pop']].groupby('taz').sum()
+
+    df_gq_pop_taz = pd.read_csv(path(setup['gq_pop_file']), header=0, index_col=None, usecols=[0, 1])
+    df_gq_pop_taz.columns = ['taz', 'gq_pop']
+    df_emp_taz = pd.read_csv(path(setup['taz_emp_file']), header=0, index_col=None, usecols=[0, 1])
+    df_emp_taz.columns = ['taz', 'emp']
+    df_area_taz = pd.read_csv(path(setup['landarea_file']), header=0, index_col=None, usecols=[0, 1])
+    df_area_taz.columns = ['taz', 'land_area']
+
+    df = pd.merge(df_hh_pop_taz, df_gq_pop_taz, left_on="taz", right_on="taz")
+    df = pd.merge(df, df_emp_taz, left_on="taz", right_on="taz")
+    df = pd.merge(df, df_area_taz, left_on="taz", right_on="taz")
+    df["actden"] = ((df["hh_pop"] + df["gq_pop"] + df["emp"]) / 1000) / df["land_area"]
+    df["jobpop"] = df.apply(lambda row: jp_bal(row['emp'], row['hh_pop'], row['gq_pop']), axis=1)
+    return df[['taz', 'actden', 'jobpop']]
+
+# function int_den_by_bg:
+# the intersection density metrics by block group of the state, as written to int_den_file
+def int_den_by_bg(setup, state_fips=25):
+    iter_csv = pd.read_csv(os.path.join(setup['in_folder'], setup['smart_loc_file']), iterator=True, chunksize=1000,
+                           usecols=['SFIPS', 'GEOID10', 'D3b', 'D3bao', 'D3bmm3', 'D3bmm4', 'D3bpo3', 'D3bpo4'])
+    df = pd.concat([chunk[chunk['SFIPS'] == state_fips] for chunk in iter_csv])
+    df['intden'] = df['D3bao'] + df['D3bmm3'] + df['D3bmm4'] + df['D3bpo3'] + df['D3bpo4']
+    df['pct4way'] = df['D3bmm4'] + df['D3bpo4']
+    df = df[['GEOID10', 'intden', 'pct4way']]
+    df.columns = ['blockgroup_id', 'intden', 'pct4way']
+    return df
+
+# function inc_flag:
+# 1 if inc is in [lo, hi), 0 otherwise
+def inc_flag(inc, lo, hi):
+    return 1 if inc >= lo and inc < hi else 0
+
+# function assemble_va_inputs:
+# the va model input table, as written to va_input_file, from the stage outputs in the out folder
+def assemble_va_inputs(setup):
+    path = lambda name: os.path.join(setup['out_folder'], name)
+    df_usim = read_households(setup)[setup['usim_fields']]
+    blk_taz_lut = pd.read_csv(os.path.join(setup['in_folder'], setup['blk_lut_file']), header=0, index_col=None,
+                              usecols=['block_id', 'taz'])
+    df_usim = pd.merge(df_usim, blk_taz_lut, how='left', left_on='block_id', right_on='block_id')
+
+    for fields, col, first in [(setup['hhsize_fields'], 'persons', 1), (setup['numwrk_fields'], 'workers', 0)]:
+        for i, fld in enumerate(fields):
+            if not (df_usim.loc[df_usim[col] == i + first].empty):
+                if i < len(fields) - 1:
+                    df_usim[fld] = df_usim.apply(lambda row: 1 if row[col] == i + first else 0, axis=1)
+                else:
+                    df_usim[fld] = df_usim.apply(lambda row: 1 if row[col] >= i + first else 0, axis=1)
+    df_usim['dum_income'] = df_usim.apply(lambda row: 1 if row.hh_inc < 35000 else 0, axis=1)
+    for i, inc_fld in enumerate(setup['hhinc_fields']):
+        high = setup['hhinc_breaks'][i]
+        low = 0 if i == 0 else setup['hhinc_breaks'][i - 1]
+        df_usim[inc_fld] = df_usim.apply(lambda row: inc_flag(row.hh_inc, low, high), axis=1)
+
+    df_intden = pd.read_csv(path(setup['int_den_file']), header=0, index_col=None)
+    df_usim = pd.merge(df_usim, df_intden, how='left', left_on='blockgroup_id', right_on='blockgroup_id')
+    df_empden = pd.read_csv(path(setup['emp_access_file']), header=0, index_col=None)
+    df_usim = pd.merge(df_usim, df_empden, how='right', left_on='taz', right_on='taz')
+    df_actden = pd.read_csv(path(setup['act_den_file']), header=0, index_col=None)
+    return pd.merge(df_usim, df_actden, how='left', left_on='taz', right_on='taz')
+
+# function run_model:
+# the household results of the Poisson model (before the block split) for the model input file
+def run_model(setup, specs):
+    df = pd.read_csv(os.path.join(setup['data_file_path'], setup['input_data_file'])).fillna(0)
+    coeffs, field_map = specs['coeffs'], specs['field_map']
+    coeff_names = list(coeffs.keys())
+    df['log_veh'] = coeffs[coeff_names[0]]
+    for coeff_name in coeff_names[1:]:
+        col_name = coeff_name if len(field_map) == 0 else field_map[coeff_name]
+        df['log_veh'] = df['log_veh'] + df[col_name] * coeffs[coeff_name]
+    df['vehicles'] = df.apply(lambda row: int(round(math.exp(row.log_veh), 0)), axis=1)
+
+    veh_fields = setup['veh_fields']
+    for i, veh_fld in enumerate(veh_fields):
+        df[veh_fld] = 0
+        if not (df.loc[df['vehicles'] == i].empty):
+            if i < len(veh_fields) - 1:
+                df[veh_fld] = df.apply(lambda row: 1 if row.vehicles == i else 0, axis=1)
+            else:
+                df[veh_fld] = df.apply(lambda row: 1 if row.vehicles >= i else 0, axis=1)
+    return df
+
+# function split_hh_to_taz:
+# the household results merged with the block split factors, with the factors applied to the aggregate fields
+# (each household keeps its own taz)
+def split_hh_to_taz(setup, df):
+    df_factors = pd.read_csv(os.path.join(setup['data_file_path'], setup['blk_fct_file']), header=0, index_col=None,
+                             usecols=['block_id', 'area_fct'])
+    df = pd.merge(df, df_factors, left_on='block_id', right_on='block_id')
+    agg_fields = setup['output_agg_fields']
+    for i in range(1, len(agg_fields)):
+        df[agg_fields[i]] = df[agg_fields[i]] * df[setup['split_factor']]
+    return df
+
+# function aggregate_results:
+# the unrounded sums of the split household results by aggregate geography
+def aggregate_results(setup, df):
+    agg_fields = setup['output_agg_fields']
+    return df[agg_fields].groupby(agg_fields[0]).sum()
+
+# function write_model_outputs:
+# run the model as its driver scripts do, writing the disaggregate and aggregate output files
+# to out_file and agg_file; returns the split households and the unrounded sums
+def write_model_outputs(setup, specs, out_file, agg_file):
+    df = split_hh_to_taz(setup, run_model(setup, specs))
+    df.to_csv(out_file, index=False)
+    sums = aggregate_results(setup, df)
+    df_grouped = sums.copy()
+    for field in setup['output_agg_fields'][1:]:
+        df_grouped[field] = round(df_grouped[field], 0)
+    df_grouped.to_csv(agg_file)
+    return df, sums
@@ -0,0 +1,5 @@
+import os
+import sys
+
+#the model modules are run from the code folder, which isn't a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
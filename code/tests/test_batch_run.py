@@ -0,0 +1,73 @@
+# Check that a batch of scenarios gives the results of running each scenario on its own, and that a batch whose
+# scenarios would write the same files is rejected before any scenario is run
+#
+# usage: python -m pytest code/tests
+
+import json
+import os
+import pytest
+import yaml
+from synthetic_data import write_synthetic_inputs
+from va_pipeline import VAPipeline
+from batch_run import BatchRun
+
+N_ZONES = 20
+N_HOUSEHOLDS = 1500
+
+@pytest.fixture(scope='module')
+def setup_files(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp("synthetic_batch"))
+    return dict(write_synthetic_inputs(folder, N_ZONES, N_HOUSEHOLDS), folder=folder)
+
+# function write_batch:
+# write a batch file for the scenarios, returning its name
+def write_batch(setup_files, name, scenarios):
+    batch_file = os.path.join(setup_files['folder'], name + ".yml")
+    batch = {'va_setup': setup_files['va_setup'], 'model_setup': setup_files['model_setup'],
+             'manifest_file': os.path.join(setup_files['folder'], name + "_manifest.json"),
+             'max_workers': 2, 'scenarios': scenarios}
+    with open(batch_file, 'w') as stream:
+        yaml.dump(batch, stream)
+    return batch_file
+
+# function model_overrides:
+# overrides giving a scenario output files of its own
+def model_overrides(name):
+    return {'output_disagg_file': name + "_out.csv", 'output_agg_file': name + "_out_taz.csv"}
+
+def test_batch_matches_single_runs(setup_files):
+    scenarios = [{'name': 'first', 'model_overrides': model_overrides('first')},
+                 {'name': 'second', 'model_overrides': model_overrides('second')}]
+    manifest = BatchRun(write_batch(setup_files, 'batch', scenarios)).run()
+    assert [entry['status'] for entry in manifest['scenarios']] == ['ok', 'ok']
+    with open(os.path.join(setup_files['folder'], "batch_manifest.json"), 'r') as stream:
+        assert [entry['name'] for entry in json.load(stream)['scenarios']] == ['first', 'second']
+
+    pipeline = VAPipeline(setup_files['va_setup'], setup_files['model_setup'], model_overrides=model_overrides('single'))
+    pipeline.run()
+    for entry in manifest['scenarios']:
+        for out_file, name in zip(entry['outputs'], ['single_out.csv', 'single_out_taz.csv']):
+            with open(out_file, 'rb') as stream, open(os.path.join(setup_files['folder'], name), 'rb') as ref_stream:
+                assert stream.read() == ref_stream.read()
+
+# function stage_manifest:
+# va overrides tracking the preprocessing stages in a stage manifest of the synthetic folder
+def stage_manifest(setup_files):
+    return {'stage_manifest': os.path.join(setup_files['folder'], "stage_manifest.json")}
+
+@pytest.mark.parametrize('case', ['default_outputs', 'same_agg_file', 'same_stage_manifest'])
+def test_batch_with_shared_outputs_is_rejected(setup_files, case):
+    if case == 'default_outputs':
+        scenarios = [{'name': 'first'}, {'name': 'second'}]
+    elif case == 'same_agg_file':
+        scenarios = [{'name': 'first', 'model_overrides': model_overrides('first')},
+                     {'name': 'second', 'model_overrides': dict(model_overrides('second'), output_agg_file="first_out_taz.csv")}]
+    else:
+        #the model outputs differ, but both scenarios write the stage output files and the stage manifest
+        scenarios = [{'name': 'first', 'model_overrides': model_overrides('first'), 'va_overrides': stage_manifest(setup_files)},
+                     {'name': 'second', 'model_overrides': model_overrides('second'), 'va_overrides': stage_manifest(setup_files)}]
+
+    batch_file = write_batch(setup_files, 'rejected', scenarios)
+    with pytest.raises(RuntimeError, match='both write'):
+        BatchRun(batch_file).run()
+    assert not os.path.exists(os.path.join(setup_files['folder'], "rejected_manifest.json"))
@@ -0,0 +1,77 @@
+# Check that InputCache returns the table its reader gives, reads the source again when the file changes,
+# and that the preprocessing stages give the baseline results through the cache
+#
+# usage: python -m pytest code/tests
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+from synthetic_data import write_synthetic_inputs
+from input_cache import InputCache
+from va_preprocessors import va_preprocess
+import baseline_reference
+
+pytest.importorskip('pyarrow')
+
+N_ZONES = 20
+N_HOUSEHOLDS = 1500
+
+# function counted_reader:
+# a reader of infile that records each time the file is parsed
+def counted_reader(infile, reads):
+    def reader():
+        reads.append(infile)
+        return pd.read_csv(infile)
+    return reader
+
+def test_cached_table_matches_source(tmp_path):
+    infile = str(tmp_path / "table.csv")
+    cache = InputCache(str(tmp_path / "cache"))
+    reads = []
+
+    df = pd.DataFrame({'id': np.arange(100), 'value': np.linspace(0, 1, 100), 'name': ['a', 'b'] * 50})
+    df.to_csv(infile, index=False)
+    for run in range(2):
+        pd.testing.assert_frame_equal(cache.load(infile, counted_reader(infile, reads), "all"), df)
+    assert len(reads) == 1
+
+    #another tag is another table
+    cache.load(infile, counted_reader(infile, reads), "other")
+    assert len(reads) == 2
+
+    #a changed file is parsed again, even if its size is unchanged
+    df['value'] = df['value'][::-1].to_numpy()
+    df.to_csv(infile, index=False)
+    os.utime(infile, ns=(os.stat(infile).st_atime_ns, os.stat(infile).st_mtime_ns + 10**9))
+    pd.testing.assert_frame_equal(cache.load(infile, counted_reader(infile, reads), "all"), df)
+    assert len(reads) == 3
+
+def test_cache_is_kept_within_its_size_limit(tmp_path):
+    cache = InputCache(str(tmp_path / "cache"), max_mb=0.01)
+    reads = []
+    for name in ["first", "second"]:
+        infile = str(tmp_path / (name + ".csv"))
+        pd.DataFrame({'value': np.arange(1000, dtype=np.float64)}).to_csv(infile, index=False)
+        cache.load(infile, counted_reader(infile, reads), name)
+    assert len([name for name in os.listdir(cache.cache_folder) if name.endswith('.feather')]) == 1
+
+def test_preprocessing_through_cache_matches_baseline(tmp_path):
+    setup_file = write_synthetic_inputs(str(tmp_path), N_ZONES, N_HOUSEHOLDS)['va_setup']
+    with open(setup_file, 'r') as stream:
+        setup = yaml.load(stream, Loader=yaml.FullLoader)
+    overrides = {'cache_folder': str(tmp_path / "cache")}
+    usim_file = os.path.join(setup['in_folder'], setup['urbansim_file'])
+
+    for version in range(3):
+        if version == 2:
+            #the urbansim file changes between runs
+            df_usim = pd.read_csv(usim_file)
+            df_usim['persons'] = df_usim['persons'] + 1
+            df_usim.to_csv(usim_file, index=False)
+        pre = va_preprocess(setup_file, overrides=overrides)
+        pd.testing.assert_frame_equal(pre.activity_den_by_taz(write_output=False), baseline_reference.activity_den_by_taz(setup))
+        #the cache keeps the rows in order but not the row labels of the csv
+        df_hh = pre.load_households().reset_index(drop=True)
+        pd.testing.assert_frame_equal(df_hh, baseline_reference.read_households(setup)[df_hh.columns].reset_index(drop=True))
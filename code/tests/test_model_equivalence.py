@@ -0,0 +1,204 @@
+# Check that the serial, parallel, sparse, chunked and compressed model paths give the baseline results
+#
+# usage: python -m pytest code/tests
+#
+# The inputs are written by synthetic_data.py and preprocessed once. The baseline is the model as first written
+# (see baseline_reference.py): every household scored column by column with math.exp, merged with the area factors
+# of its block, keeping its own taz, and summed by taz with a pandas groupby. The disaggregate output files must be
+# identical on every path. The aggregate fields are counted exactly by taz and block split on every path, so the
+# sums by taz and the aggregate output files must be identical too; only the baseline sums, which add the split
+# factored values household by household, are compared to a relative tolerance
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from synthetic_data import write_synthetic_inputs
+from va_preprocessors import va_preprocess
+from poisson_veh_model import PoissonModel
+import baseline_reference
+
+N_ZONES = 40
+N_HOUSEHOLDS = 4000
+
+#setup overrides of each model path; chunk_rows doesn't divide the number of households, so the last batch is short
+PATHS = {'serial': {},
+         'parallel': {'n_workers': 3},
+         'sparse': {'sparse_aggregate': True},
+         'parallel_sparse': {'sparse_aggregate': True, 'n_workers': 3},
+         'chunked': {'chunk_rows': 1500},
+         'chunked_small': {'chunk_rows': 333},
+         'parallel_chunked': {'n_workers': 2, 'chunk_rows': 1500},
+         'sparse_chunked': {'sparse_aggregate': True, 'chunk_rows': 1500},
+         'compressed': {'compress_patterns': True},
+         'compressed_sparse': {'compress_patterns': True, 'sparse_aggregate': True},
+         'compressed_chunked': {'compress_patterns': True, 'chunk_rows': 1500}}
+
+@pytest.fixture(scope='module')
+def setup_files(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp("synthetic"))
+    setup_files = write_synthetic_inputs(folder, N_ZONES, N_HOUSEHOLDS)
+    pre = va_preprocess(setup_files['va_setup'])
+    pre.emp_accessibility_by_taz()
+    pre.activity_den_by_taz()
+    pre.int_den_by_bg()
+    pre.assemble_va_inputs()
+    return setup_files
+
+# function run_path:
+# run the model on one path, writing its output files under names of its own
+# returns the model, the disaggregate and aggregate output files and, unless households are streamed in
+# batches, the unrounded sums by taz
+def run_path(setup_files, name):
+    overrides = dict(PATHS[name], output_disagg_file=name + "_out.csv", output_agg_file=name + "_out_taz.csv")
+    model = PoissonModel(setup_files['model_setup'], overrides=overrides)
+    sums = None
+    if model.chunk_rows:
+        model.run_chunked()
+    else:
+        model.load_data()
+        model.run_model()
+        if model.sparse_aggregate:
+            sums = model.summarize_sparse()
+        else:
+            model.split_hh_to_taz()
+            sums = model.summarize_results()
+        model.write_aggregates(sums)
+        model.save_results()
+    return (model, os.path.join(model.data_path, model.output_file),
+            os.path.join(model.data_path, model.output_agg_file), sums)
+
+@pytest.fixture(scope='module')
+def serial(setup_files):
+    return run_path(setup_files, 'serial')
+
+def test_serial_matches_baseline(setup_files, serial):
+    model, out_file, agg_file, sums = serial
+    base_out_file = os.path.join(model.data_path, "baseline_out.csv")
+    base_agg_file = os.path.join(model.data_path, "baseline_out_taz.csv")
+    df_base, base_sums = baseline_reference.write_model_outputs(model.setup, model.specs, base_out_file, base_agg_file)
+
+    #each split household keeps its own taz, as in the baseline
+    with open(out_file, 'rb') as stream, open(base_out_file, 'rb') as base_stream:
+        assert stream.read() == base_stream.read()
+    with open(agg_file, 'rb') as stream, open(base_agg_file, 'rb') as base_stream:
+        assert stream.read() == base_stream.read()
+    pd.testing.assert_index_equal(sums.index, base_sums.index)
+    assert np.allclose(sums.to_numpy(dtype=np.float64), base_sums.to_numpy(dtype=np.float64), rtol=1e-9, atol=1e-9)
+
+def test_split_taz(setup_files):
+    #with split_taz, each split household takes the taz of its block split
+    overrides = {'split_taz': True, 'output_disagg_file': "split_taz_out.csv", 'output_agg_file': "split_taz_out_taz.csv"}
+    model = PoissonModel(setup_files['model_setup'], overrides=overrides)
+    model.load_data()
+    model.run_model()
+    model.split_hh_to_taz()
+    sums = model.summarize_results()
+
+    df_hh = baseline_reference.run_model(model.setup, model.specs)
+    df_split = pd.merge(df_hh.drop(columns='taz'), model.load_blk_factors(), on='block_id')
+    for field in model.agg_fields[1:]:
+        df_split[field] = df_split[field] * df_split[model.split_factor]
+    df_base = df_split[model.agg_fields].groupby(model.agg_fields[0]).sum()
+    assert np.array_equal(model.df['taz'].to_numpy(), df_split['taz'].to_numpy())
+    pd.testing.assert_index_equal(sums.index, df_base.index)
+    assert np.allclose(sums.to_numpy(dtype=np.float64), df_base.to_numpy(dtype=np.float64), rtol=1e-9, atol=1e-9)
+
+@pytest.mark.parametrize('name', [name for name in PATHS if name != 'serial'])
+def test_path_matches_serial(setup_files, serial, name):
+    model, out_file, agg_file, sums = run_path(setup_files, name)
+    ref_model, ref_out_file, ref_agg_file, ref_sums = serial
+
+    #household results are identical; with sparse aggregation they are written before they are split
+    if model.sparse_aggregate:
+        ref_out_file = run_path(setup_files, 'sparse')[1]
+    with open(out_file, 'rb') as stream, open(ref_out_file, 'rb') as ref_stream:
+        assert stream.read() == ref_stream.read()
+
+    if sums is not None:
+        pd.testing.assert_frame_equal(sums, ref_sums, check_exact=True)
+    with open(agg_file, 'rb') as stream, open(ref_agg_file, 'rb') as ref_stream:
+        assert stream.read() == ref_stream.read()
+
+# function write_variant_input:
+# write a copy of the model input with workers set to value in the household of the last row, returning the
+# setup overrides reading it in batches of 1500 rows, so the value falls in the last batch
+def write_variant_input(setup_files, name, value):
+    model = PoissonModel(setup_files['model_setup'])
+    df = pd.read_csv(os.path.join(model.data_path, model.input_file))
+    df['workers'] = df['workers'].astype(object)
+    df.loc[df.index[-1], 'workers'] = value
+    df.to_csv(os.path.join(model.data_path, name + "_in.csv"), index=False)
+    return {'input_data_file': name + "_in.csv", 'output_disagg_file': name + "_out.csv",
+            'output_agg_file': name + "_out_taz.csv", 'chunk_rows': 1500}
+
+def test_chunked_batches_keep_first_batch_types(setup_files):
+    #a missing value in a later batch is set to 0 in the type of the first batch
+    model = PoissonModel(setup_files['model_setup'], overrides=write_variant_input(setup_files, 'missing', None))
+    model.run_chunked()
+    df_out = pd.read_csv(os.path.join(model.data_path, model.output_file), dtype=str)
+    assert df_out['workers'].iloc[-1] == '0'
+    assert not df_out['workers'].str.contains(r'\.').any()
+
+def test_chunked_batch_that_does_not_fit_is_rejected(setup_files):
+    model = PoissonModel(setup_files['model_setup'], overrides=write_variant_input(setup_files, 'fraction', 0.5))
+    with pytest.raises(RuntimeError, match='input_dtypes'):
+        model.run_chunked()
+
+def test_parallel_matches_serial_by_household_geography(setup_files):
+    #aggregated by a geography of the households rather than the taz of each split
+    agg_files = []
+    for name, n_workers in [('bg_serial', 1), ('bg_parallel', 3)]:
+        model = PoissonModel(setup_files['model_setup'])
+        overrides = {'n_workers': n_workers, 'output_agg_fields': ['blockgroup_id'] + model.agg_fields[1:],
+                     'output_disagg_file': name + "_out.csv", 'output_agg_file': name + "_out_bg.csv"}
+        model = PoissonModel(setup_files['model_setup'], overrides=overrides)
+        model.load_data()
+        model.run_model()
+        model.split_hh_to_taz()
+        model.aggregate_results()
+        agg_files.append(os.path.join(model.data_path, model.output_agg_file))
+    with open(agg_files[0], 'rb') as stream, open(agg_files[1], 'rb') as ref_stream:
+        assert stream.read() == ref_stream.read()
+
+def test_load_data_rows_in(setup_files):
+    #rows in of load_data are the rows of each batch passed in, not of the table it loads or of the previous batch
+    model = PoissonModel(setup_files['model_setup'], overrides={'chunk_rows': 1500, 'output_disagg_file': "rows_out.csv",
+                                                                'output_agg_file': "rows_out_taz.csv"})
+    model.run_chunked()
+    loads = [entry for entry in model.recorder.records if entry['stage'] == 'load_data']
+    assert [entry['rows_in'] for entry in loads] == [1500, 1500, N_HOUSEHOLDS - 3000]
+    assert [entry['rows_out'] for entry in loads] == [1500, 1500, N_HOUSEHOLDS - 3000]
+
+    model.load_data()
+    assert model.recorder.records[-1]['rows_in'] is None
+    assert model.recorder.records[-1]['rows_out'] == N_HOUSEHOLDS
+
+# function run_simulation:
+# simulate the households of the synthetic inputs with the overrides, returning the model and the simulation results
+def run_simulation(setup_files, **overrides):
+    overrides = dict({'sim_replications': 200, 'output_sim_file': "sim_out_taz.csv"}, **overrides)
+    model = PoissonModel(setup_files['model_setup'], overrides=overrides)
+    model.load_data()
+    model.run_model()
+    return model, model.simulate(write_output=False)
+
+def test_simulation_is_reproducible(setup_files):
+    model, df_sim = run_simulation(setup_files, sim_seed=11, sim_shard_rows=1000)
+    assert list(df_sim.columns) == [field + stat for field in model.veh_fields + ['vehicles'] for stat in ['_mean', '_var']]
+    assert df_sim.index.name == 'taz'
+    assert np.array_equal(df_sim.index.to_numpy(), np.unique(model.df['taz']))
+
+    #the same seed draws the same vehicles, another seed others
+    pd.testing.assert_frame_equal(run_simulation(setup_files, sim_seed=11, sim_shard_rows=1000)[1], df_sim)
+    assert not run_simulation(setup_files, sim_seed=12, sim_shard_rows=1000)[1].equals(df_sim)
+
+    #the mean number of vehicles is close to the expected number, and every household has one vehicle count
+    expected = np.exp(model.plan.evaluate(model.df)).sum()
+    assert abs(df_sim['vehicles_mean'].sum() / expected - 1) < 0.02
+    assert np.isclose(df_sim[[field + '_mean' for field in model.veh_fields]].to_numpy().sum(), len(model.df))
+
+    #with split_taz, the vehicles are counted by the taz of each block split
+    model, df_split = run_simulation(setup_files, sim_seed=11, sim_shard_rows=1000, split_taz=True)
+    assert np.array_equal(df_split.index.to_numpy(), np.unique(model.load_blk_factors()['taz']))
+    assert np.isclose(df_split['vehicles_mean'].sum(), df_sim['vehicles_mean'].sum())
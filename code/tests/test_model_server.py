@@ -0,0 +1,50 @@
+# Check that the model server rejects run requests that could read or write outside the setup's folders
+# or run with unbounded worker counts or batch sizes
+#
+# usage: python -m pytest code/tests
+
+import os
+import pytest
+from model_server import ModelServer, check_overrides, BOUNDED_KEYS
+
+@pytest.mark.parametrize('overrides', [
+    {'out_folder': "other"},
+    {'data_file_path': "other"},
+    {'metrics_file': "metrics.jsonl"},
+    {'stage_manifest': "manifest.json"},
+    {'output_disagg_file': "../veh_own.csv"},
+    {'output_disagg_file': "sub/veh_own.csv"},
+    {'output_disagg_file': "..\\veh_own.csv"},
+    {'output_disagg_file': os.path.abspath("veh_own.csv")},
+    {'output_disagg_file': ".."},
+    {'output_disagg_file': ""},
+    {'output_disagg_file': 3},
+    {'output_columns': ["hid", "../hid"]},
+    {'skim_index': "/tmp"},
+    {'n_workers': 0},
+    {'n_workers': (os.cpu_count() or 1) + 1},
+    {'n_workers': 2.5},
+    {'n_workers': True},
+    {'csv_workers': -1},
+    {'chunk_rows': 10},
+    {'chunk_rows': 10**9},
+    {'chunk_rows': "1000"},
+    ["output_disagg_file", "veh_own.csv"]])
+def test_rejected_overrides(overrides):
+    with pytest.raises(RuntimeError):
+        check_overrides(overrides, 'model_overrides')
+
+def test_accepted_overrides():
+    overrides = {'output_disagg_file': "veh_own_iter2.csv", 'output_columns': ["hid", "vehicles"],
+                 'n_workers': 1, 'csv_workers': None, 'chunk_rows': BOUNDED_KEYS['chunk_rows'][0], 'aggregate': False}
+    assert check_overrides(overrides, 'model_overrides') == overrides
+
+def test_rejected_run_request_is_not_run(tmp_path):
+    server = ModelServer(str(tmp_path / "va_setup.yml"), str(tmp_path / "model_setup.yml"))
+    for request in [{'command': 'run', 'target': 'model', 'model_overrides': {'stage_manifest': "/tmp/manifest.json"}},
+                    {'command': 'run', 'target': 'pipeline', 'va_overrides': {'out_folder': "/tmp"}},
+                    {'command': 'run', 'target': 'pipeline', 'max_workers': 10**6}]:
+        response = server.handle(request)
+        assert response['status'] == 'failed'
+        assert 'Setting' in response['error']
+    assert server.handle({'command': 'unknown'})['status'] == 'failed'
@@ -0,0 +1,89 @@
+# Check that TableWriter writes the csv DataFrame.to_csv writes, with and without csv worker processes and
+# when a table is written in batches, that Parquet and Feather files hold the rows written, and that the model
+# writes its aggregate output as csv whatever the output format of the disaggregate output
+#
+# usage: python -m pytest code/tests
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from synthetic_data import write_synthetic_inputs
+from output_writers import TableWriter, write_table
+from va_preprocessors import va_preprocess
+from poisson_veh_model import PoissonModel
+
+N_ROWS = 250
+
+@pytest.fixture(scope='module')
+def df():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'hid': np.arange(N_ROWS), 'value': rng.random(N_ROWS) * 1e3,
+                       'count': rng.integers(0, 5, N_ROWS),
+                       'name': rng.choice(['plain', 'with, comma', 'with "quotes"', 'café'], N_ROWS),
+                       'flag': rng.random(N_ROWS) > 0.5})
+    df.loc[df.index[::9], 'value'] = np.nan
+    df['cat'] = pd.Categorical(rng.choice(['a', 'b'], N_ROWS))
+    return df.set_index(pd.Index(np.arange(N_ROWS) * 3, name='row'))
+
+# function read_bytes:
+# the contents of a file
+def read_bytes(path):
+    with open(path, 'rb') as stream:
+        return stream.read()
+
+@pytest.mark.parametrize('csv_workers, block_rows', [(1, 100000), (1, 7), (3, 7), (3, 100), (2, N_ROWS)])
+@pytest.mark.parametrize('index', [False, True])
+def test_csv_matches_to_csv(tmp_path, df, csv_workers, block_rows, index):
+    out_file = str(tmp_path / "out.csv")
+    write_table(df, out_file, index=index, csv_workers=csv_workers, block_rows=block_rows)
+    assert read_bytes(out_file) == df.to_csv(index=index).encode('utf-8')
+
+    #batches are appended after a single header, with the selected columns in order
+    columns = ['value', 'hid', 'name']
+    with TableWriter(out_file, columns=columns, index=index, csv_workers=csv_workers, block_rows=block_rows) as writer:
+        for row_start in range(0, N_ROWS, 60):
+            writer.write(df.iloc[row_start:row_start + 60])
+    assert read_bytes(out_file) == df[columns].to_csv(index=index).encode('utf-8')
+
+def test_missing_column_and_unknown_format_are_rejected(tmp_path, df):
+    with pytest.raises(RuntimeError, match='not in the results'):
+        write_table(df, str(tmp_path / "out.csv"), columns=['hid', 'missing'])
+    with pytest.raises(RuntimeError, match='Unknown output format'):
+        TableWriter(str(tmp_path / "out.txt"), output_format='txt')
+
+@pytest.mark.parametrize('output_format, compression', [('parquet', None), ('parquet', 'zstd'), ('feather', None), ('feather', 'lz4')])
+def test_arrow_files_hold_the_rows(tmp_path, df, output_format, compression):
+    pytest.importorskip('pyarrow')
+    out_file = str(tmp_path / ("out." + output_format))
+    with TableWriter(out_file, output_format=output_format, compression=compression) as writer:
+        for row_start in range(0, N_ROWS, 60):
+            writer.write(df.iloc[row_start:row_start + 60])
+    df_read = pd.read_parquet(out_file) if output_format == 'parquet' else pd.read_feather(out_file)
+    #categorical columns are written as their values
+    pd.testing.assert_frame_equal(df_read, df.reset_index(drop=True).assign(cat=df['cat'].astype(str).to_numpy()))
+
+def test_model_aggregates_stay_csv(tmp_path):
+    pytest.importorskip('pyarrow')
+    setup_files = write_synthetic_inputs(str(tmp_path), 20, 1500)
+    pre = va_preprocess(setup_files['va_setup'])
+    pre.assemble_va_inputs(emp_access_df=pre.emp_accessibility_by_taz(write_output=False),
+                           act_den_df=pre.activity_den_by_taz(write_output=False),
+                           int_den_df=pre.int_den_by_bg(write_output=False))
+
+    models = {}
+    for name, overrides in [('csv', {}), ('parquet', {'output_format': 'parquet', 'csv_workers': 2})]:
+        overrides = dict(overrides, output_disagg_file=name + "_out." + name, output_agg_file=name + "_out_taz.csv")
+        model = PoissonModel(setup_files['model_setup'], overrides=overrides)
+        model.load_data()
+        model.run_model()
+        model.save_results()
+        model.split_hh_to_taz()
+        model.aggregate_results()
+        models[name] = model
+
+    agg_files = [os.path.join(model.data_path, model.output_agg_file) for model in models.values()]
+    assert read_bytes(agg_files[0]) == read_bytes(agg_files[1])
+    disagg_files = [os.path.join(model.data_path, model.output_file) for model in models.values()]
+    df_csv = pd.read_csv(disagg_files[0], float_precision='round_trip')
+    pd.testing.assert_frame_equal(pd.read_parquet(disagg_files[1]), df_csv, check_dtype=False)
@@ -0,0 +1,128 @@
+# Check that the preprocessing stages write the same files as the stages as first written
+#
+# usage: python -m pytest code/tests
+#
+# The inputs are written by synthetic_data.py. Each stage's output file must be byte for byte the file the
+# baseline (see baseline_reference.py) writes from the same inputs.
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+from synthetic_data import write_synthetic_inputs
+from va_preprocessors import va_preprocess
+import baseline_reference
+
+N_ZONES = 30
+N_HOUSEHOLDS = 3000
+
+@pytest.fixture(scope='module')
+def va_setup(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp("synthetic_pre"))
+    setup_file = write_synthetic_inputs(folder, N_ZONES, N_HOUSEHOLDS)['va_setup']
+    with open(setup_file, 'r') as stream:
+        setup = yaml.load(stream, Loader=yaml.FullLoader)
+    return setup_file, setup
+
+# function assert_same_csv:
+# check that the file written by a stage is the csv of the baseline's dataframe
+def assert_same_csv(out_file, df_base):
+    base_file = out_file + ".baseline.csv"
+    df_base.to_csv(base_file, index=False)
+    with open(out_file, 'rb') as stream, open(base_file, 'rb') as base_stream:
+        assert stream.read() == base_stream.read()
+
+def test_activity_density_matches_baseline(va_setup):
+    setup_file, setup = va_setup
+    va_preprocess(setup_file).activity_den_by_taz()
+    assert_same_csv(os.path.join(setup['out_folder'], setup['act_den_file']), baseline_reference.activity_den_by_taz(setup))
+
+def test_activity_density_skips_missing_persons(va_setup):
+    #households without a person count are left out of the population sums, as by a groupby sum
+    setup_file, setup = va_setup
+    df_usim = pd.read_csv(os.path.join(setup['in_folder'], setup['urbansim_file']))
+    df_usim.loc[df_usim.index[::7], 'persons'] = np.nan
+    df_usim.to_csv(os.path.join(setup['in_folder'], "usim_missing.csv"), index=False)
+    overrides = {'urbansim_file': "usim_missing.csv", 'act_den_file': "act_den_missing.csv"}
+
+    df_act_den = va_preprocess(setup_file, overrides=overrides).activity_den_by_taz()
+    assert not df_act_den.isna().any().any()
+    assert_same_csv(os.path.join(setup['out_folder'], overrides['act_den_file']),
+                    baseline_reference.activity_den_by_taz(dict(setup, **overrides)))
+
+def test_va_inputs_match_baseline(va_setup):
+    #the baseline reads the other stages' output files, which are checked against the baseline by their own tests
+    setup_file, setup = va_setup
+    pre = va_preprocess(setup_file)
+    pre.emp_accessibility_by_taz()
+    pre.activity_den_by_taz()
+    pre.int_den_by_bg()
+    pre.assemble_va_inputs()
+    assert_same_csv(os.path.join(setup['out_folder'], setup['va_input_file']), baseline_reference.assemble_va_inputs(setup))
+
+@pytest.mark.parametrize('overrides', [{}, {'access_block_rows': 1}, {'access_block_rows': 7}, {'access_block_rows': 100000},
+                                       {'skim_cache_folder': 'skim_cache'}])
+def test_emp_accessibility_matches_baseline(va_setup, overrides):
+    #the result doesn't depend on the number of skim rows read at a time or on the memory-mapped skim copies
+    setup_file, setup = va_setup
+    overrides = dict(overrides, emp_access_file="emp_access_" + "_".join(str(value) for value in overrides.values()) + ".csv")
+    if 'skim_cache_folder' in overrides:
+        overrides['skim_cache_folder'] = os.path.join(setup['out_folder'], overrides['skim_cache_folder'])
+    for run in range(2 if 'skim_cache_folder' in overrides else 1):
+        #with a cache folder, the second run reads the copies made by the first
+        va_preprocess(setup_file, overrides=overrides).emp_accessibility_by_taz()
+        assert_same_csv(os.path.join(setup['out_folder'], overrides['emp_access_file']),
+                        baseline_reference.emp_accessibility_by_taz(setup))
+
+def test_emp_accessibility_columns_match_baseline(va_setup):
+    #one column per threshold, in the order of the setup lists, for other threshold lists
+    setup_file, setup = va_setup
+    overrides = {'sov_times': [45, 5, 90], 'transit_times': [20], 'emp_access_file': "emp_access_thresholds.csv"}
+    df_access = va_preprocess(setup_file, overrides=overrides).emp_accessibility_by_taz()
+    assert list(df_access.columns) == ['taz', 'pctemp45a', 'pctemp5a', 'pctemp90a', 'pctemp20t']
+    assert_same_csv(os.path.join(setup['out_folder'], overrides['emp_access_file']),
+                    baseline_reference.emp_accessibility_by_taz(dict(setup, **overrides)))
+
+@pytest.mark.parametrize('usim_chunksize', [None, 333])
+def test_households_match_baseline(va_setup, usim_chunksize):
+    setup_file, setup = va_setup
+    overrides = {'usim_chunksize': usim_chunksize} if usim_chunksize else None
+    df_hh = va_preprocess(setup_file, overrides=overrides).load_households()
+    df_base = baseline_reference.read_households(setup)
+    pd.testing.assert_frame_equal(df_hh, df_base[df_hh.columns])
+
+def test_households_are_read_once(va_setup, monkeypatch):
+    #activity_den_by_taz and assemble_va_inputs share one scan of the urbansim file
+    setup_file, setup = va_setup
+    usim_file = os.path.join(setup['in_folder'], setup['urbansim_file'])
+    reads = []
+    read_csv = pd.read_csv
+    def counted_read_csv(*args, **kwargs):
+        if (args[0] if args else kwargs.get('filepath_or_buffer')) == usim_file:
+            reads.append(usim_file)
+        return read_csv(*args, **kwargs)
+    monkeypatch.setattr(pd, 'read_csv', counted_read_csv)
+
+    pre = va_preprocess(setup_file)
+    pre.assemble_va_inputs(emp_access_df=pre.emp_accessibility_by_taz(write_output=False),
+                           act_den_df=pre.activity_den_by_taz(write_output=False),
+                           int_den_df=pre.int_den_by_bg(write_output=False), write_output=False)
+    assert len(reads) == 1
+
+@pytest.mark.parametrize('state_fips', [25, 33])
+def test_int_density_extract_matches_baseline(va_setup, state_fips):
+    #the intersection density read from the state extract is the one a scan of the smart location file gives,
+    #and the extract is rebuilt when the smart location file changes
+    setup_file, setup = va_setup
+    df_sld = pd.read_csv(os.path.join(setup['in_folder'], setup['smart_loc_file']))
+    sld_file = "sld_" + str(state_fips) + ".csv"
+    overrides = {'smart_loc_file': sld_file, 'state_fips': state_fips, 'int_den_file': "int_den_" + str(state_fips) + ".csv",
+                 'sld_extract_folder': os.path.join(setup['out_folder'], "sld_extract_" + str(state_fips))}
+    for version in range(2):
+        df_sld['D3bao'] = df_sld['D3bao'] + version
+        df_sld.to_csv(os.path.join(setup['in_folder'], sld_file), index=False)
+        va_preprocess(setup_file, overrides=overrides).int_den_by_bg()
+        assert os.path.isdir(os.path.join(overrides['sld_extract_folder'], "SFIPS=" + str(state_fips)))
+        assert_same_csv(os.path.join(setup['out_folder'], overrides['int_den_file']),
+                        baseline_reference.int_den_by_bg(dict(setup, **overrides), state_fips=state_fips))
@@ -0,0 +1,81 @@
+# Check that SkimAccessor reads a skim core as openmatrix does, with and without its memory-mapped cache,
+# and that the OMX file is closed when the accessor can't be created
+#
+# usage: python -m pytest code/tests
+
+import os
+import numpy as np
+import openmatrix as omx
+import pytest
+from skim_access import SkimAccessor
+
+N_ZONES = 300
+
+# function write_skim:
+# write an OMX file with one core of travel times and a zone mapping, returning the times
+def write_skim(skim_file, seed=0, fractional=False):
+    rng = np.random.default_rng(seed)
+    times = rng.integers(0, 120, size=(N_ZONES, N_ZONES)).astype(np.float64)
+    if fractional:
+        times += 0.1
+    with omx.open_file(skim_file, 'w') as stream:
+        stream['time'] = times
+        stream.create_mapping('taz', np.arange(1, N_ZONES + 1))
+    return times
+
+# function is_closed:
+# True if no handle keeps the OMX file open (PyTables refuses to open a file for writing while it is open for reading)
+def is_closed(skim_file):
+    try:
+        omx.open_file(skim_file, 'a').close()
+    except ValueError:
+        return False
+    return True
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_rows_match_the_core(tmp_path, cached):
+    skim_file = str(tmp_path / "skim.omx")
+    times = write_skim(skim_file)
+    cache_folder = str(tmp_path / "cache") if cached else None
+    with SkimAccessor(skim_file, 'time', 'taz', cache_folder=cache_folder) as skim:
+        assert skim.shape == times.shape
+        assert np.array_equal(skim.zones, np.arange(1, N_ZONES + 1))
+        assert np.array_equal(np.asarray(skim[10:20]), times[10:20])
+        blocks = list(skim.row_blocks(7))
+        assert blocks[0][0] == 0 and blocks[-1][1] == N_ZONES
+        assert all(row_start % skim.chunk_rows == 0 for row_start, row_end, rows in blocks)
+        assert np.array_equal(np.concatenate([rows for row_start, row_end, rows in blocks]), times)
+        assert (skim.cached is not None) == cached
+    assert is_closed(skim_file)
+
+def test_cache_type_and_rebuild(tmp_path):
+    skim_file = str(tmp_path / "skim.omx")
+    cache_folder = str(tmp_path / "cache")
+
+    #whole minutes are cached as float32
+    write_skim(skim_file)
+    with SkimAccessor(skim_file, 'time', 'taz', cache_folder=cache_folder) as skim:
+        assert skim.cached.dtype == np.float32
+
+    #a changed file is cached again, in its own type if float32 can't hold its values, and the old copy is removed
+    times = write_skim(skim_file, seed=1, fractional=True)
+    with SkimAccessor(skim_file, 'time', 'taz', cache_folder=cache_folder) as skim:
+        assert skim.cached.dtype == np.float64
+        assert np.array_equal(np.asarray(skim[0:N_ZONES]), times)
+    assert len([name for name in os.listdir(cache_folder) if name.endswith('.npy')]) == 1
+
+def test_file_is_closed_when_the_accessor_fails(tmp_path):
+    skim_file = str(tmp_path / "skim.omx")
+    write_skim(skim_file)
+
+    with pytest.raises(Exception):
+        SkimAccessor(skim_file, 'missing', 'taz')
+    assert is_closed(skim_file)
+
+    #the cache folder can't be created where a file of that name exists
+    cache_folder = str(tmp_path / "not_a_folder")
+    with open(cache_folder, 'w') as stream:
+        stream.write("")
+    with pytest.raises(RuntimeError):
+        SkimAccessor(skim_file, 'time', 'taz', cache_folder=cache_folder)
+    assert is_closed(skim_file)
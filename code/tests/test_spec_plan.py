@@ -0,0 +1,91 @@
+# Check that model term expressions evaluate as the NumPy expressions they stand for, that the linear predictor
+# is the sum of the coefficient x term products in coefficient order, and that unsupported expressions are rejected
+#
+# usage: python -m pytest code/tests
+
+import numpy as np
+import pandas as pd
+import pytest
+from spec_plan import EvaluationPlan, ModelTerm, compile_spec
+
+N_ROWS = 1000
+
+@pytest.fixture(scope='module')
+def df():
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({'actden': rng.random(N_ROWS) * 50, 'intden': rng.random(N_ROWS) * 800,
+                         'workers': rng.integers(0, 4, N_ROWS), 'pct4way': rng.random(N_ROWS),
+                         'hh size': rng.integers(1, 6, N_ROWS)})
+
+# function term_values:
+# the values of an expression for the rows of df
+def term_values(expr, df):
+    term = ModelTerm(expr)
+    return term.values({col: df[col].to_numpy(dtype=np.float64) for col in term.columns}, len(df))
+
+@pytest.mark.parametrize('expr, expected', [
+    ("actden", lambda df: df['actden']),
+    ("hh size", lambda df: df['hh size']),
+    ("log1p(actden)", lambda df: np.log1p(df['actden'])),
+    ("clip(intden, 0, 500)", lambda df: np.clip(df['intden'], 0, 500)),
+    ("(workers > 1) * pct4way", lambda df: (df['workers'] > 1) * df['pct4way']),
+    ("-actden ** 2 / 4 + 1", lambda df: -df['actden'] ** 2 / 4 + 1),
+    ("where(workers == 0, 1, sqrt(intden))", lambda df: np.where(df['workers'] == 0, 1, np.sqrt(df['intden']))),
+    ("2.5", lambda df: np.full(len(df), 2.5))])
+def test_term_values(df, expr, expected):
+    values = term_values(expr, df)
+    assert values.dtype == np.float64 and values.shape == (len(df),)
+    assert np.array_equal(values, np.asarray(expected(df), dtype=np.float64))
+
+@pytest.mark.parametrize('expr', [
+    "np.log(actden)",
+    "__import__('os')",
+    "actden.sum()",
+    "actden[0]",
+    "actden if workers else pct4way",
+    "0 < workers < 2",
+    "workers and pct4way",
+    "clip(intden, a_min=0, a_max=500)",
+    "lambda x: x",
+    "actden + 'text'",
+    "actden * True",
+    "actden // 2",
+    #names of functions can't be used as columns in an expression
+    "log + 1",
+    "log1p(exp)"])
+def test_unsupported_expressions_are_rejected(expr):
+    with pytest.raises(ValueError):
+        ModelTerm(expr)
+    with pytest.raises(RuntimeError, match="coefficient 'coeff'"):
+        EvaluationPlan({'intercept': 0.5, 'coeff': 1.0}, {'coeff': expr})
+
+def test_predictor_is_sum_of_products(df):
+    coeffs = {'intercept': 0.3, 'b_act': 0.01, 'b_int': -0.002, 'b_wrk': 0.4}
+    field_map = {'b_act': "log1p(actden)", 'b_int': "clip(intden, 0, 500)", 'b_wrk': "workers"}
+    plan = EvaluationPlan(coeffs, field_map)
+    assert plan.columns == ['actden', 'intden', 'workers']
+    assert plan.plain_columns == ['workers']
+
+    #the products are added one coefficient at a time, as with the columns of a design matrix
+    x_arr = plan.design_matrix(df)
+    expected = np.full(len(df), coeffs['intercept'])
+    for i, value in enumerate(list(coeffs.values())[1:]):
+        expected += x_arr[:, i] * value
+    for block_rows in [1, 7, N_ROWS, 65536]:
+        assert np.array_equal(plan.evaluate(df, block_rows=block_rows), expected)
+
+    assert plan.missing_columns(['actden', 'workers']) == [('b_int', "clip(intden, 0, 500)", 'intden')]
+
+def test_field_map(df):
+    #without a field map the coefficient names are the terms
+    plan = EvaluationPlan({'intercept': 1.0, 'actden': 2.0}, {})
+    assert np.array_equal(plan.evaluate(df), 1.0 + df['actden'].to_numpy() * 2.0)
+    with pytest.raises(RuntimeError, match="not found in field map"):
+        EvaluationPlan({'intercept': 1.0, 'actden': 2.0, 'intden': 1.0}, {'actden': "actden"})
+
+def test_plans_are_compiled_once():
+    coeffs = {'intercept': 1.0, 'b_act': 2.0}
+    plan = compile_spec(coeffs, {'b_act': "log1p(actden)"})
+    assert compile_spec(dict(coeffs), {'b_act': "log1p(actden)"}) is plan
+    assert compile_spec(coeffs, {'b_act': "sqrt(actden)"}) is not plan
+    assert compile_spec(dict(coeffs, b_act=3.0), {'b_act': "log1p(actden)"}) is not plan
@@ -0,0 +1,103 @@
+# Check that a pipeline run with a stage manifest skips the stages that are up to date, reruns those whose
+# input files, setup values or output files changed, and writes the files a run without a manifest writes
+#
+# usage: python -m pytest code/tests
+
+import os
+import pandas as pd
+import pytest
+from synthetic_data import write_synthetic_inputs
+from va_pipeline import VAPipeline, PREPROCESS_STAGES
+
+N_ZONES = 20
+N_HOUSEHOLDS = 1500
+
+ALL_STAGES = list(PREPROCESS_STAGES) + ['model']
+
+@pytest.fixture
+def setup_files(tmp_path):
+    folder = str(tmp_path)
+    return dict(write_synthetic_inputs(folder, N_ZONES, N_HOUSEHOLDS), folder=folder)
+
+# function run_pipeline:
+# run the pipeline with a stage manifest, returning it
+def run_pipeline(setup_files, model_overrides=None):
+    va_overrides = {'stage_manifest': os.path.join(setup_files['folder'], "stage_manifest.json")}
+    pipeline = VAPipeline(setup_files['va_setup'], setup_files['model_setup'],
+                          va_overrides=va_overrides, model_overrides=model_overrides)
+    pipeline.run()
+    return pipeline
+
+# function run_reference:
+# run the pipeline without a stage manifest, writing the model outputs under names of their own
+def run_reference(setup_files):
+    pipeline = VAPipeline(setup_files['va_setup'], setup_files['model_setup'],
+                          model_overrides={'output_disagg_file': "reference_out.csv", 'output_agg_file': "reference_out_taz.csv"})
+    pipeline.run()
+    return pipeline
+
+# function read_outputs:
+# the contents of the files written by a pipeline run, other than the stage manifest
+def read_outputs(pipeline):
+    contents = {}
+    for out_file in pipeline.output_files():
+        if out_file != pipeline.tracker.manifest_file:
+            with open(out_file, 'rb') as stream:
+                contents[out_file] = stream.read()
+    return contents
+
+def test_up_to_date_stages_are_skipped(setup_files):
+    pipeline = run_pipeline(setup_files)
+    assert pipeline.skipped == []
+    first_outputs = read_outputs(pipeline)
+
+    pipeline = run_pipeline(setup_files)
+    assert pipeline.skipped == ALL_STAGES
+    assert read_outputs(pipeline) == first_outputs
+
+    #the model outputs are those of a run without a manifest
+    for out_file, ref_file in zip(pipeline.stage_files('model')[2], run_reference(setup_files).stage_files('model')[2]):
+        with open(ref_file, 'rb') as stream:
+            assert first_outputs[out_file] == stream.read()
+
+def test_changed_input_file_reruns_stages(setup_files):
+    pipeline = run_pipeline(setup_files)
+    sld_file = os.path.join(pipeline.preprocess.in_folder, pipeline.preprocess.smart_loc_file)
+    df_sld = pd.read_csv(sld_file)
+    df_sld['D3bao'] = df_sld['D3bao'] * 2
+    df_sld.to_csv(sld_file, index=False)
+
+    #the intersection density changes, and with it the va model inputs and the model outputs
+    pipeline = run_pipeline(setup_files)
+    assert pipeline.skipped == ['emp_accessibility_by_taz', 'activity_den_by_taz']
+    assert run_pipeline(setup_files).skipped == ALL_STAGES
+
+    #the stages that were run read the outputs of the skipped ones exactly
+    outputs = read_outputs(pipeline)
+    for out_file, ref_file in zip(pipeline.stage_files('model')[2], run_reference(setup_files).stage_files('model')[2]):
+        with open(ref_file, 'rb') as stream:
+            assert outputs[out_file] == stream.read()
+
+def test_changed_setup_value_reruns_stages(setup_files):
+    run_pipeline(setup_files)
+    assert run_pipeline(setup_files, model_overrides={'sim_seed': 7}).skipped == list(PREPROCESS_STAGES)
+    #settings that don't change the outputs don't rerun the model
+    assert run_pipeline(setup_files, model_overrides={'sim_seed': 7, 'csv_workers': 2}).skipped == ALL_STAGES
+
+def test_removed_output_file_reruns_stage(setup_files):
+    pipeline = run_pipeline(setup_files)
+    first_outputs = read_outputs(pipeline)
+    os.remove(pipeline.stage_output_file('activity_den_by_taz'))
+
+    #the stage writes the same file again, so the stages after it are up to date
+    pipeline = run_pipeline(setup_files)
+    assert pipeline.skipped == [stage for stage in ALL_STAGES if stage != 'activity_den_by_taz']
+    assert read_outputs(pipeline) == first_outputs
+
+    #a model output file that was changed is written again
+    model_file = pipeline.stage_files('model')[2][0]
+    with open(model_file, 'a') as stream:
+        stream.write("changed\n")
+    pipeline = run_pipeline(setup_files)
+    assert pipeline.skipped == list(PREPROCESS_STAGES)
+    assert read_outputs(pipeline) == first_outputs
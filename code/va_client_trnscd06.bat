@@ -0,0 +1,14 @@
+rem va_client_trnscd06.bat
+rem
+rem send a request to the warm VA model server started by start_model_server_trnscd06.bat, passing on the arguments, e.g.
+rem   va_client_trnscd06.bat run model
+rem   va_client_trnscd06.bat run preprocess --parallel
+rem   va_client_trnscd06.bat run model --model output_disagg_file=veh_own_iter2.csv
+rem   va_client_trnscd06.bat shutdown
+rem The script returns when the run is complete, with its exit code (0: success, 1: failed,
+rem 2: stages slower than slow_stage_seconds), which is passed back to the calling macro
+
+rem trnscd06
+set va_python=c:\ProgramData\Anaconda3\envs\va_model\python.exe
+%va_python% D:\Projects\veh_ownership_model_app\code\model_client.py %*
+exit %errorlevel%
@@ -0,0 +1,380 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import localtime, strftime, perf_counter
+import pandas as pd
+from va_preprocessors import va_preprocess
+from poisson_veh_model import PoissonModel
+from instrumentation import exit_code
+from stage_tracker import StageTracker
+
+#preprocessing stages in the order they are run serially
+#after: stages whose outputs the stage uses
+#result_arg: name of the assemble_va_inputs argument that receives the stage output
+#in_pool: True if the stage can run in a separate worker process. activity_den_by_taz stays in the
+#main process because it loads the urbansim household table that assemble_va_inputs reuses
+#inputs: setup parameters naming the stage's input files (in in_folder), besides the outputs of the stages it comes after
+#config: setup parameters (va_preprocess attributes) that change the stage output
+#output: setup parameter naming the stage's output file (in out_folder)
+PREPROCESS_STAGES = {
+    'emp_accessibility_by_taz': {'after': [], 'result_arg': 'emp_access_df', 'in_pool': True,
+                                 'inputs': ['sov_skim_file', 'transit_skim_file', 'taz_emp_file'],
+                                 'config': ['sov_skim_name', 'transit_skim_name', 'skim_index', 'emp_cols',
+                                            'sov_times', 'transit_times'],
+                                 'output': 'emp_access_file',
+                                 'message': "Calculating employment accessibility"},
+    'activity_den_by_taz':      {'after': [], 'result_arg': 'act_den_df', 'in_pool': False,
+                                 'inputs': ['urbansim_file', 'blk_fct_file', 'gq_pop_file', 'taz_emp_file', 'landarea_file'],
+                                 'config': [],
+                                 'output': 'act_den_file',
+                                 'message': "Calculating activity density"},
+    'int_den_by_bg':            {'after': [], 'result_arg': 'int_den_df', 'in_pool': True,
+                                 'inputs': ['smart_loc_file'],
+                                 'config': ['state_fips'],
+                                 'output': 'int_den_file',
+                                 'message': "Calculating intersection density"},
+    'assemble_va_inputs':       {'after': ['emp_accessibility_by_taz', 'activity_den_by_taz', 'int_den_by_bg'],
+                                 'result_arg': None, 'in_pool': False,
+                                 'inputs': ['urbansim_file', 'blk_lut_file'],
+                                 'config': ['usim_fields', 'hhsize_fields', 'numwrk_fields', 'hhinc_fields', 'hhinc_breaks',
+                                            'inc_col', 'dum_income_field', 'dum_income_break'],
+                                 'output': 'va_input_file',
+                                 'message': "Assembling VA model inputs"}
+    }
+
+#model setup parameters that don't change the model outputs
+UNTRACKED_KEYS = ['metrics_file', 'profile_folder', 'slow_stage_seconds', 'n_workers', 'chunk_rows', 'compress_patterns',
+                  'csv_workers']
+
+class VAPipeline:
+    """
+    Runs the preprocessing stages and the vehicle ownership model as a single pipeline,
+    passing the output of each stage to the next in memory rather than through csv files.
+    Only the model results (disaggregate and, if requested, aggregate) are always written.
+
+    Args:
+        va_setup_file (str): name of the YAML setup file for the va_preprocess stages
+        model_setup_file (str): name of the YAML setup file for the vehicle ownership model,
+        or None to run the preprocessing stages only
+        write_intermediates (bool): if True, each preprocessing stage also writes its output file
+        (emp_access_file, act_den_file, int_den_file and va_input_file)
+        va_overrides (dict): optional settings that replace those read from the va setup file
+        model_overrides (dict): optional settings that replace those read from the model setup file
+        specs (dict): optional, already parsed contents of the model specification file
+
+    If the va setup file names a stage_manifest, the pipeline runs incrementally: each stage writes its output
+    file, and a stage whose input files, setup values and output file are unchanged since it last ran (see
+    StageTracker) is skipped, downstream stages reading its output file instead. The model is tracked as one
+    stage, depending on the va model input file, the block split factor file, the model setup and coefficients.
+    """
+
+    def __init__(self,
+                 va_setup_file: str,
+                 model_setup_file: str = None,
+                 write_intermediates: bool = False,
+                 va_overrides: dict = None,
+                 model_overrides: dict = None,
+                 specs: dict = None):
+        self.va_setup_file = va_setup_file
+        self.va_overrides = va_overrides
+        self.preprocess = va_preprocess(va_setup_file, overrides=va_overrides)
+        if model_setup_file is not None:
+            self.model = PoissonModel(model_setup_file, overrides=model_overrides, specs=specs)
+        else:
+            self.model = None
+        self.write_intermediates = write_intermediates
+
+        #optional: manifest of the stages' inputs and outputs, used to skip stages that are up to date
+        manifest_file = self.preprocess.setup.get('stage_manifest')
+        self.tracker = StageTracker(manifest_file) if manifest_file is not None else None
+        #stages that were not run because their outputs were up to date
+        self.skipped = []
+        #stages whose output isn't tracked: precomputed stages and those that depend on them
+        self.untracked = set()
+
+        #wall time in seconds of each preprocessing and model stage, filled in as the stages are run
+        self.stage_times = {}
+
+    # method run_preprocess:
+    # run the preprocessing stages, returning the assembled va model input dataframe
+    # if parallel is True, stages that don't depend on each other run at the same time: stages marked
+    # in_pool run in a pool of max_workers processes while the main process runs the others
+    # precomputed is an optional dict of stage outputs (e.g. scenario-invariant ones); those stages are not run
+    # with a stage manifest, returns None if assemble_va_inputs was up to date (its output is in va_input_file)
+    def run_preprocess(self, parallel=False, max_workers=None, precomputed=None):
+        self.stage_times = {}
+        self.skipped = []
+        results = dict(precomputed) if precomputed else {}
+        self.untracked = set(results)
+        for stage in PREPROCESS_STAGES:
+            if any(dep in self.untracked for dep in PREPROCESS_STAGES[stage]['after']):
+                self.untracked.add(stage)
+
+        if not parallel:
+            for stage in PREPROCESS_STAGES:
+                if stage not in results:
+                    state, current = self.check_stage(stage)
+                    if current:
+                        self.skip_stage(stage, results)
+                        continue
+                    log_stage(PREPROCESS_STAGES[stage]['message'])
+                    results[stage], self.stage_times[stage] = self.run_stage(stage, results)
+                    self.record_stage(stage, state)
+            return results['assemble_va_inputs']
+
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            return self.run_stage_graph(pool, results)
+
+    # method run_stage_graph:
+    # run the preprocessing stages in dependency order, submitting in_pool stages to the process pool
+    # as soon as the stages they depend on are complete
+    def run_stage_graph(self, pool, results):
+        pending = [stage for stage in PREPROCESS_STAGES if stage not in results]
+        futures = {}
+        states = {}
+
+        while pending or futures:
+            ready = [stage for stage in pending if all(dep in results for dep in PREPROCESS_STAGES[stage]['after'])]
+
+            #stages that are up to date are skipped, which may make further stages ready
+            up_to_date = False
+            for stage in ready:
+                states[stage], current = self.check_stage(stage)
+                if current:
+                    self.skip_stage(stage, results)
+                    pending.remove(stage)
+                    up_to_date = True
+            if up_to_date:
+                continue
+
+            for stage in ready:
+                if PREPROCESS_STAGES[stage]['in_pool']:
+                    log_stage(PREPROCESS_STAGES[stage]['message'] + " (worker)")
+                    futures[pool.submit(run_pool_stage, self.va_setup_file, self.va_overrides, stage, self.write_stage_output(stage))] = stage
+                    pending.remove(stage)
+
+            local_ready = [stage for stage in ready if not PREPROCESS_STAGES[stage]['in_pool']]
+            if local_ready:
+                #run one main process stage, then look for newly ready stages
+                stage = local_ready[0]
+                log_stage(PREPROCESS_STAGES[stage]['message'])
+                results[stage], self.stage_times[stage] = self.run_stage(stage, results)
+                self.record_stage(stage, states[stage])
+                pending.remove(stage)
+            elif futures:
+                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = futures.pop(future)
+                    try:
+                        results[stage], self.stage_times[stage], records = future.result()
+                        #keep the worker's stage records with those of the main process
+                        self.preprocess.recorder.records.extend(records)
+                    except Exception as err:
+                        msg = "Error running preprocessing stage " + stage + ".\n" + str(err)
+                        raise RuntimeError(msg) from err
+                    self.record_stage(stage, states[stage])
+            else:
+                msg = "Preprocessing stages " + str(pending) + " depend on stages that can't be run."
+                raise RuntimeError(msg)
+
+        return results['assemble_va_inputs']
+
+    # method run_stage:
+    # run one preprocessing stage in the main process, passing it the outputs of the stages it depends on
+    # returns the stage output and its wall time in seconds
+    # the outputs of skipped stages are read from their output files
+    def run_stage(self, stage, results):
+        kwargs = {}
+        for dep in PREPROCESS_STAGES[stage]['after']:
+            if results[dep] is None:
+                results[dep] = self.read_stage_output(dep)
+            kwargs[PREPROCESS_STAGES[dep]['result_arg']] = results[dep]
+        start = perf_counter()
+        result = getattr(self.preprocess, stage)(write_output=self.write_stage_output(stage), **kwargs)
+        return result, perf_counter() - start
+
+    # method stage_files:
+    # return the input files, the setup values and the output files of a preprocessing stage or of the model
+    def stage_files(self, stage):
+        pre = self.preprocess
+        if stage == 'model':
+            config = {'setup': {key: value for key, value in self.model.setup.items() if key not in UNTRACKED_KEYS},
+                      'coeffs': self.model.coeffs, 'field_map': self.model.field_map}
+            input_files = [self.stage_output_file('assemble_va_inputs'),
+                           os.path.join(self.model.data_path, self.model.blk_fct_file)]
+            output_files = [os.path.join(self.model.data_path, self.model.output_file)]
+            if self.model.aggregate:
+                output_files.append(os.path.join(self.model.data_path, self.model.output_agg_file))
+            if self.model.sim_replications:
+                output_files.append(os.path.join(self.model.data_path, self.model.output_sim_file))
+            return input_files, config, output_files
+
+        input_files = [os.path.join(pre.in_folder, getattr(pre, key)) for key in PREPROCESS_STAGES[stage]['inputs']]
+        input_files += [self.stage_output_file(dep) for dep in PREPROCESS_STAGES[stage]['after']]
+        config = {key: getattr(pre, key) for key in PREPROCESS_STAGES[stage]['config']}
+        return input_files, config, [self.stage_output_file(stage)]
+
+    # method output_files:
+    # the paths of the files a run of the pipeline writes: the model output files and, if the preprocessing stages
+    # write their outputs (write_intermediates or a stage manifest), their output files and the stage manifest
+    def output_files(self):
+        files = []
+        if self.write_intermediates or self.tracker is not None:
+            files += [self.stage_output_file(stage) for stage in PREPROCESS_STAGES]
+        if self.tracker is not None:
+            files.append(self.tracker.manifest_file)
+        if self.model is not None:
+            files += self.stage_files('model')[2]
+        return files
+
+    # method stage_output_file:
+    # the path of the output file of a preprocessing stage
+    def stage_output_file(self, stage):
+        return os.path.join(self.preprocess.out_folder, getattr(self.preprocess, PREPROCESS_STAGES[stage]['output']))
+
+    # method read_stage_output:
+    # read the output of a preprocessing stage that was skipped because it was up to date
+    # floats are parsed exactly, so the stages after it get the values the stage returned when it was run
+    def read_stage_output(self, stage):
+        infile = self.stage_output_file(stage)
+        try:
+            return pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None, float_precision='round_trip')
+        except Exception as err:
+            msg = "Error reading output file " + infile + " of stage " + stage + ".\n" + str(err)
+            raise RuntimeError(msg) from err
+
+    # method write_stage_output:
+    # True if a stage writes its output file: always if intermediates are written, and for tracked stages
+    def write_stage_output(self, stage):
+        return self.write_intermediates or (self.tracker is not None and stage not in self.untracked)
+
+    # method check_stage:
+    # return the current state of a tracked stage (None if the stage isn't tracked) and whether it is up to date
+    def check_stage(self, stage):
+        if self.tracker is None or stage in self.untracked:
+            return None, False
+        input_files, config, output_files = self.stage_files(stage)
+        state = self.tracker.stage_state(stage, input_files, config)
+        return state, self.tracker.is_current(stage, state, output_files)
+
+    # method skip_stage:
+    # mark a stage that is up to date as done, without loading its output (results[stage] is None)
+    def skip_stage(self, stage, results):
+        message = PREPROCESS_STAGES[stage]['message'] if stage in PREPROCESS_STAGES else "Running model"
+        log_stage(message + " (up to date)")
+        self.skipped.append(stage)
+        self.stage_times[stage] = 0.0
+        results[stage] = None
+
+    # method record_stage:
+    # record the state a tracked stage was run with in the manifest
+    def record_stage(self, stage, state):
+        if state is not None:
+            self.tracker.record(stage, state, self.stage_files(stage)[2])
+
+    # method run_model:
+    # apply the vehicle ownership model to the va model input dataframe and write its results
+    # with a stage manifest, the model isn't run if its inputs and outputs are unchanged since it last ran;
+    # if df_va_inputs is None (assemble_va_inputs was up to date), the va model input file is read
+    def run_model(self, df_va_inputs):
+        if 'assemble_va_inputs' in self.untracked:
+            self.untracked.add('model')
+        state, current = self.check_stage('model')
+        if current:
+            self.skip_stage('model', {})
+            return
+        if df_va_inputs is None:
+            df_va_inputs = self.read_stage_output('assemble_va_inputs')
+
+        self.run_model_stages(df_va_inputs)
+        self.record_stage('model', state)
+
+    # method run_model_stages:
+    # run the model stages on the va model input dataframe
+    def run_model_stages(self, df_va_inputs):
+        log_stage("Loading data")
+        self.time_stage('load_data', self.model.load_data, df=df_va_inputs)
+
+        log_stage("Running model")
+        self.time_stage('run_model', self.model.run_model)
+        if self.model.pattern_stats is not None:
+            print("  {0} covariate patterns for {1} households ({2:.1f} households per pattern)".format(
+                self.model.pattern_stats['patterns'], self.model.pattern_stats['households'], self.model.pattern_stats['ratio'] or 0))
+
+        if self.model.sim_replications:
+            log_stage("Simulating vehicles")
+            self.time_stage('simulate', self.model.simulate)
+
+        if self.model.sparse_aggregate:
+            #aggregate the household results directly, splitting them only if the split output is wanted
+            if self.model.aggregate:
+                log_stage("Aggregating results")
+                self.time_stage('aggregate_sparse', self.model.aggregate_sparse)
+
+            if self.model.split_output:
+                log_stage("Factoring block data to taz")
+                self.time_stage('split_hh_to_taz', self.model.split_hh_to_taz)
+
+            log_stage("Saving disaggregate data")
+            self.time_stage('save_results', self.model.save_results)
+            return
+
+        log_stage("Factoring block data to taz")
+        self.time_stage('split_hh_to_taz', self.model.split_hh_to_taz)
+
+        log_stage("Saving disaggregate data")
+        self.time_stage('save_results', self.model.save_results)
+
+        if self.model.aggregate:
+            log_stage("Aggregating results")
+            self.time_stage('aggregate_results', self.model.aggregate_results)
+
+    # method time_stage:
+    # call a stage method, recording its wall time in stage_times
+    def time_stage(self, stage, method, **kwargs):
+        start = perf_counter()
+        result = method(**kwargs)
+        self.stage_times[stage] = perf_counter() - start
+        return result
+
+    # method run:
+    # run the preprocessing stages followed by the model, then report the stage times
+    def run(self, parallel=False, max_workers=None, precomputed=None):
+        df_va_inputs = self.run_preprocess(parallel=parallel, max_workers=max_workers, precomputed=precomputed)
+        if self.model is not None:
+            self.run_model(df_va_inputs)
+        log_stage("End model" if self.model is not None else "End pre-processor")
+        self.report_stage_times()
+
+    # method exit_code:
+    # the exit code for the run (see instrumentation.exit_code), from the stage records of the preprocessing
+    # stages, including those run in worker processes, and of the model
+    def exit_code(self):
+        return exit_code([self.preprocess.recorder, self.model.recorder if self.model is not None else None])
+
+    # method report_stage_times:
+    # print the wall time of each stage and list any stages flagged as slow
+    def report_stage_times(self):
+        for stage in self.stage_times:
+            print("  {0:<28}{1:10.2f} s".format(stage, self.stage_times[stage]))
+        if self.skipped:
+            print("Stages up to date (not run): " + ", ".join(self.skipped))
+
+        slow = self.preprocess.recorder.slow_stages() + (self.model.recorder.slow_stages() if self.model is not None else [])
+        if slow:
+            print("Stages slower than slow_stage_seconds: " + ", ".join(slow))
+
+
+# function run_pool_stage:
+# run one preprocessing stage in a worker process, returning the stage output, its wall time in seconds
+# and the stage records of the worker's recorder
+# the worker builds its own va_preprocess instance from the setup file and overrides
+def run_pool_stage(va_setup_file, va_overrides, stage, write_output):
+    start = perf_counter()
+    preprocess = va_preprocess(va_setup_file, overrides=va_overrides)
+    result = getattr(preprocess, stage)(write_output=write_output)
+    return result, perf_counter() - start, preprocess.recorder.records
+
+# function log_stage:
+# print the name of a pipeline stage with the time it started
+def log_stage(stage):
+    print(stage + ": " + strftime("%H:%M:%S", localtime()))
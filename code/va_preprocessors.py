@@ -1,8 +1,12 @@
-import openmatrix as omx
 import pandas as pd
 import numpy as np
 import os
 import yaml
+from input_cache import InputCache
+from skim_access import SkimAccessor
+import sld_extract
+from block_split import BlockSplitIndex
+from instrumentation import StageRecorder, instrumented, row_count
 
 class va_preprocess:
     """
@@ -13,10 +17,12 @@ class va_preprocess:
     Args:
         setup file (str): name of YAML file listing the folder paths, file
         names and other settings
+        overrides (dict): optional settings that replace those read from the setup file
     """
 
     def __init__(self,
-                 setup_file: str):
+                 setup_file: str,
+                 overrides: dict = None):
 
         try:
             with open(setup_file, 'r') as stream:
@@ -26,6 +32,8 @@ class va_preprocess:
             raise RuntimeError(msg) from err
 
         self.setup = setup if setup is not None else {}
+        if overrides:
+            self.setup.update(overrides)
 
         try:
             self.in_folder = self.setup['in_folder']
@@ -41,6 +49,10 @@ class va_preprocess:
             self.transit_times = self.setup['transit_times']
             self.transit_skim_name = self.setup['transit_skim_name']
             self.skim_index = self.setup['skim_index']
+            #optional: number of skim rows processed at a time by the accessibility calculation
+            self.access_block_rows = self.setup.get('access_block_rows', 500)
+            #optional: folder for memory-mapped copies of the skim cores (see skim_access.py)
+            self.skim_cache_folder = self.setup.get('skim_cache_folder')
             
             self.urbansim_file = self.setup['urbansim_file']
             self.gq_pop_file = self.setup['gq_pop_file']
@@ -50,55 +62,142 @@ class va_preprocess:
 
             self.smart_loc_file = self.setup['smart_loc_file']
             self.int_den_file = self.setup['int_den_file']
+            #optional: state whose block groups are kept (default Massachusetts), and the folder of
+            #the state-partitioned smart location extract built by sld_extract.py
+            self.state_fips = self.setup.get('state_fips', 25)
+            self.sld_extract_folder = self.setup.get('sld_extract_folder')
 
             self.blk_lut_file = self.setup['blk_lut_file']
             self.va_input_file = self.setup['va_input_file']
             self.usim_fields = self.setup['usim_fields']
+            #optional: number of urbansim records parsed at a time
+            self.usim_chunksize = self.setup.get('usim_chunksize', 500000)
             self.hhsize_fields = self.setup['hhsize_fields']
             self.numwrk_fields = self.setup['numwrk_fields']
             self.hhinc_fields = self.setup['hhinc_fields']
             self.hhinc_breaks = self.setup['hhinc_breaks']
 
+            #optional settings for the household income dummy variables
+            self.inc_col = self.setup.get('inc_col', 'hh_inc')
+            self.dum_income_field = self.setup.get('dum_income_field', 'dum_income')
+            self.dum_income_break = self.setup.get('dum_income_break', 35000)
+
         except Exception as err:
             msg = "Required setup parameter(s) were not found in file '" + setup_file + "'.\n" + str(err)
             raise RuntimeError(msg) from err
 
+        #urbansim household table, read on first use by load_households
+        self.df_hh = None
+        #block / taz split factor table, read on first use by load_blk_factors
+        self.df_blk_fct = None
+        #block -> (taz, split factor) index, built on first use by load_split_index
+        self.split_index = None
+
+        #records the time, memory, rows and bytes of each stage method (see instrumentation.py)
+        self.recorder = StageRecorder.from_setup(self.setup)
+
+        #optional columnar cache of parsed input files
+        if self.setup.get('cache_folder') is not None:
+            self.input_cache = InputCache(self.setup['cache_folder'], self.setup.get('cache_max_mb'))
+        else:
+            self.input_cache = None
+
     #--------------------------------------------------------------------------------------------------
+    def read_input(self, infile, reader, tag):
+        #return the dataframe produced by reader(), reading infile through the input cache if one is configured
+        #tag describes the columns and filters applied by reader, so differently filtered reads are cached separately
+        if self.input_cache is None:
+            return reader()
+        return self.input_cache.load(infile, reader, tag)
 
-    def emp_accessibility_by_taz(self):
-        #read the sov congested time matrix into an array
+    #--------------------------------------------------------------------------------------------------
+    def load_households(self):
+        #read the urbansim household data into a pandas dataframe, keeping one record (person_num 1) per household
+        #the file is scanned once, in large chunks, reading only the columns required by the preprocessing stages
+        #the result is cached on the instance so that activity_den_by_taz and assemble_va_inputs share it
+        if self.df_hh is not None:
+            return self.df_hh
+
+        #the income column (inc_col) is read even if it isn't one of the usim_fields, as encode_hh_categories uses it
+        #the columns are part of the cache tag, so a different inc_col reads the file again
+        usecols = list(dict.fromkeys(self.usim_fields + ['block_id', 'persons', 'person_num', self.inc_col]))
         try:
-            sov_file = omx.open_file(self.in_folder + "\\" + self.sov_skim_file, 'r')
-            sov_mtx = sov_file[self.sov_skim_name]
-            sov_arr = np.array(sov_mtx)
-
-            #capture the zone mappings in a dict
-            taz_map = sov_file.mapping(self.skim_index)
-            taz_keys = list(taz_map.keys())
-            taz_vals = list(taz_map.values())
-            
+            infile = os.path.join(self.in_folder, self.urbansim_file)
+            reader = lambda: pd.concat([chunk[chunk['person_num']==1] for chunk in \
+                                        pd.read_csv(infile, iterator=True, chunksize=self.usim_chunksize, usecols=usecols)])
+            df_usim = self.read_input(infile, reader, "person_num==1|" + ",".join(usecols))
+        except Exception as err:
+            msg = "Error reading urbansim file " + self.urbansim_file + " into dataframe.\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        self.df_hh = df_usim.drop(columns='person_num')
+        return self.df_hh
+
+    #--------------------------------------------------------------------------------------------------
+    def load_blk_factors(self):
+        #read the taz / block split lookup into a dataframe with block_id, taz and area_fct columns
+        #the table is cached on the instance (and may be set by the caller to share one copy between scenarios)
+        if self.df_blk_fct is not None:
+            return self.df_blk_fct
+
+        try:
+            infile = os.path.join(self.in_folder, self.blk_fct_file)
+            reader = lambda: pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None, usecols=['block_id', 'taz', 'area_fct'])
+            self.df_blk_fct = self.read_input(infile, reader, "block_id,taz,area_fct")
+        except Exception as err:
+            msg = "Error reading block / taz lookup file " + self.blk_fct_file + " into dataframe.\n" + str(err)
+            raise RuntimeError(msg) from err
+        return self.df_blk_fct
+
+    #--------------------------------------------------------------------------------------------------
+    def load_split_index(self):
+        #build the block -> (taz, split factor) index from the taz / block split lookup
+        #the index is built once and cached on the instance
+        if self.split_index is None:
+            try:
+                self.split_index = BlockSplitIndex(self.load_blk_factors(), 'area_fct')
+            except Exception as err:
+                msg = "Error building block split index\n" + str(err)
+                raise RuntimeError(msg) from err
+        return self.split_index
+
+    #--------------------------------------------------------------------------------------------------
+
+    @instrumented()
+    def emp_accessibility_by_taz(self, write_output=True):
+        #calculate the share of regional employment within each sov and transit travel time threshold by taz
+        #returns the accessibility metrics as a dataframe. If write_output is False, the emp_access_file is not written
+        #open the sov congested time matrix. Rows are read from the file in blocks by emp_within_times
+        try:
+            sov_skim = SkimAccessor(os.path.join(self.in_folder, self.sov_skim_file), self.sov_skim_name,
+                                    self.skim_index, self.skim_cache_folder)
         except Exception as err:
             msg = "Error reading SOV skim matrix " + self.sov_skim_file + ".\n" + str(err)
             raise RuntimeError(msg) from err
 
-        #read the transit travel time matrix into an arr
+        #open the transit travel time matrix
         try:
-            transit_file = omx.open_file(self.in_folder + "\\" + self.transit_skim_file, 'r')
-            transit_mtx = transit_file[self.transit_skim_name]
-            transit_arr = np.array(transit_mtx)
+            transit_skim = SkimAccessor(os.path.join(self.in_folder, self.transit_skim_file), self.transit_skim_name,
+                                        self.skim_index, self.skim_cache_folder)
         except Exception as err:
+            sov_skim.close()
             msg = "Error reading transit skim matrix " + self.transit_skim_file + ".\n" + str(err)
             raise RuntimeError(msg) from err
+
+        #zone numbers in skim order
+        taz_keys = sov_skim.zones
         
-        #create a dataframe from the taz mapping keys, with the taz mapping values as the index
-        taz_map_df = pd.DataFrame(taz_keys, index = taz_vals, columns = ['ID'])
+        #create a dataframe from the zone numbers, with the skim positions as the index
+        taz_map_df = pd.DataFrame(taz_keys, index = np.arange(len(taz_keys)), columns = ['ID'])
         
         #read the employment data from a csv file
         #first column should be TAZ# and second column should be total employment
         try:
-            infile = self.in_folder + "\\" + self.taz_emp_file
+            infile = os.path.join(self.in_folder, self.taz_emp_file)
             emp_df = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None, usecols=[0,1])
         except Exception as err:
+            sov_skim.close()
+            transit_skim.close()
             msg = "Error reading input file " + self.taz_emp_file + " into dataframe.\n" + str(err)
             raise RuntimeError(msg) from err
 
@@ -116,89 +215,90 @@ class va_preprocess:
         tot_emp = np.sum(emp_arr)
         #print(tot_emp)
 
-        #initialize the output dataframe as a copy of the taz mapping keys dataframe
-        emp_access_df = taz_map_df
-        
-        #iterate over the sov travel time thresholds
-        for time in self.sov_times:
-            #create an array of 0/1 flags based on whether o-d travel time is within threshold
-            flag_arr = np.where(sov_arr==0,0,(np.where(sov_arr<=time,1,0)))
-            #multiply the flags by the destination zone employment
-            #we need to transpose the flag array first, then transpose the result
-            od_emp_arr = ((flag_arr.T) * emp_arr).T
-            #sum the employment within the travel time threshold by origin zone
-            o_emp_arr = np.sum(od_emp_arr,0)
-            #calculate the percentage of regional employment within travel time threshold
-            o_emp_arr2 = o_emp_arr / tot_emp            
-            #add the TAZ #s to the array of employment within time threshold by origin taz
-            o_emp_arr3 = np.array([taz_keys,o_emp_arr2])
-            #transpose the array
-            o_emp_arr4 = o_emp_arr3.T
-            #convert the array to a dataframe
-            o_emp_df = pd.DataFrame(o_emp_arr4, columns=['ID', 'pctemp'+str(time)+'a'])
-            #merge the dataframe into the emp_access_df dataframe
-            emp_access_df = pd.merge(emp_access_df, o_emp_df, how="left", left_on="ID", right_on="ID")
-
-        #iterate over the transit travel time thresholds
-        for time in self.transit_times:
-            #create an array of 0/1 flags based on whether o-d travel time is within threshold
-            flag_arr = np.where(transit_arr==0,0,(np.where(transit_arr<=time,1,0)))
-            #multiply the flags by the destination zone employment
-            #we need to transpose the flag array first, then transpose the result
-            od_emp_arr = ((flag_arr.T) * emp_arr).T
-            #sum the employment within the travel time threshold by origin zone
-            o_emp_arr = np.sum(od_emp_arr,0)
-            #calculate the percentage of regional employment within travel time threshold
-            o_emp_arr2 = o_emp_arr / tot_emp           
-            #add the TAZ #s to the array of employment within time threshold by origin taz
-            o_emp_arr3 = np.array([taz_keys,o_emp_arr2])
-            #transpose the array
-            o_emp_arr4 = o_emp_arr3.T
-            #convert the array to a dataframe
-            o_emp_df = pd.DataFrame(o_emp_arr4, columns=['ID', 'pctemp'+str(time)+'t'])
-            #merge the dataframe into the emp_access_df dataframe
-            emp_access_df = pd.merge(emp_access_df, o_emp_df, how="left", left_on="ID", right_on="ID")
-
-        #rename the 'ID' column to 'taz'
-        emp_access_df.rename(columns = {"ID":"taz"},
-                             inplace = True)
+        #preallocate the accessibility metrics as a single block, one column per travel time threshold
+        #and one row per zone in skim order
+        access_cols = ['pctemp'+str(time)+'a' for time in self.sov_times] + \
+                      ['pctemp'+str(time)+'t' for time in self.transit_times]
+        access_arr = np.zeros((len(taz_keys), len(access_cols)))
+        n_sov = len(self.sov_times)
+
+        #calculate the employment within every travel time threshold in a single pass over each skim
+        try:
+            self.emp_within_times(sov_skim, emp_arr, self.sov_times, out=access_arr[:, :n_sov])
+            self.emp_within_times(transit_skim, emp_arr, self.transit_times, out=access_arr[:, n_sov:])
+        except Exception as err:
+            msg = "Error calculating employment accessibility.\n" + str(err)
+            raise RuntimeError(msg) from err
+        finally:
+            sov_skim.close()
+            transit_skim.close()
+
+        #calculate the percentage of regional employment within each travel time threshold
+        access_arr /= tot_emp
+
+        #build the output dataframe once, keeping the integer TAZ #s from the skim mapping
+        emp_access_df = pd.DataFrame(access_arr, columns=access_cols)
+        emp_access_df.insert(0, 'taz', taz_keys)
 
         #write the employment accessibility metrics to a csv file
-        out_file_path = self.out_folder + "\\" + self.emp_access_file
-        emp_access_df.to_csv(path_or_buf=out_file_path, index = False)
+        if write_output:
+            out_file_path = os.path.join(self.out_folder, self.emp_access_file)
+            emp_access_df.to_csv(path_or_buf=out_file_path, index = False)
+
+        return emp_access_df
 
     #-------------------------------------------------------------------------------------------------
+    def emp_within_times(self, skim, emp_arr, times, out=None):
+        #returns an (n zones x n times) array. Column k holds, for each skim column zone, the total employment
+        #in the skim row zones whose travel time to it is non-zero and within times[k]
+        #if out is given, the employment is accumulated into it (typically a column slice of a larger block)
+        #skim is a SkimAccessor. Rows are read in blocks of about access_block_rows rows (aligned with the
+        #file's chunks), so peak memory is set by the block size rather than by the number of zones or
+        #thresholds. Each block is read once for all thresholds and the 0/1 threshold flags are reduced with
+        #a boolean matrix-vector product
+        n_zones = skim.shape[1]
+        emp_within = np.zeros((n_zones, len(times))) if out is None else out
+        for row_start, row_end, time_blk in skim.row_blocks(self.access_block_rows):
+            emp_blk = emp_arr[row_start:row_end]
+            nonzero_blk = time_blk != 0
+            for k in range(len(times)):
+                emp_within[:, k] += emp_blk @ (nonzero_blk & (time_blk <= times[k]))
+        return emp_within
 
-    def activity_den_by_taz(self):
-        #read the urbansim household data into a pandas dataframe. Use an iterator to filter on input
-        try:
-            infile = self.in_folder + "\\" + self.urbansim_file
-            iter_csv = pd.read_csv(infile, iterator=True, chunksize=1000)
-            df_usim = pd.concat([chunk[chunk['person_num']==1] for chunk in iter_csv])
-            #get rid of unnecessary columns
-            df_usim = df_usim[['block_id','persons']]
-        except Exception as err:
-            msg = "Error reading urbansim file " + self.urbansim_file + "into dataframe.\n" + str(err)
-            raise RuntimeError(msg) from err
+    #-------------------------------------------------------------------------------------------------
 
-        #read the taz / block split lookup into a dataframe
+    @instrumented(rows_in=lambda self, *args, **kwargs: row_count(self.df_hh))
+    def activity_den_by_taz(self, write_output=True):
+        #calculate activity density and job / population balance by taz
+        #returns the metrics as a dataframe. If write_output is False, the act_den_file is not written
+        #all metrics are computed on arrays aligned with one sorted taz index: the taz that households
+        #are split to and that appear in the group quarters, employment and land area files
+        #get the urbansim household data
+        df_usim = self.load_households()
+
+        #split each household over the taz of its block (households in blocks missing from the
+        #taz / block split lookup are dropped) and sum household pop by taz
+        split_index = self.load_split_index()
         try:
-            infile = self.in_folder + "\\" + self.blk_fct_file
-            df_blk_taz_lut = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None)
-            df_blk_taz_lut = df_blk_taz_lut[['block_id', 'taz', 'area_fct']]
+            hh_rows, split_rows = split_index.expand(df_usim['block_id'])
+            persons = df_usim['persons'].to_numpy(dtype=np.float64)[hh_rows]
+            #number the taz of the split table once rather than the (many more) household splits
+            taz_ids, split_taz_codes = np.unique(split_index.taz, return_inverse=True)
+            taz_codes = split_taz_codes[split_rows]
+            #missing persons count as 0, as a groupby sum skips them
+            split_pop = np.nan_to_num(persons * split_index.factors[split_rows])
+            #summed by a groupby on the taz codes, which adds the household splits in the order of the original merge
+            #and with the same (compensated) summation, so the sums are identical to those of the original groupby
+            hh_pop = pd.Series(split_pop).groupby(taz_codes).sum().reindex(np.arange(len(taz_ids)), fill_value=0.0).to_numpy()
+            #as with a groupby, only the taz that households are split to are kept
+            taz_used = np.bincount(taz_codes, minlength=len(taz_ids)) > 0
         except Exception as err:
-            msg = "Error reading block / taz lookup file " + self.blk_fct_file + "into dataframe.\n" + str(err)
+            msg = "Error calculating household population by taz.\n" + str(err)
             raise RuntimeError(msg) from err
 
-        #Merge the urbansim and taz lookup dataframes and calculate household pop by taz
-        df_usim = pd.merge(df_usim, df_blk_taz_lut, left_on="block_id", right_on="block_id")
-        df_usim['hh_pop'] = df_usim['persons'] * df_usim['area_fct']
-        df_usim = df_usim[['taz','hh_pop']]
-        df_hh_pop_taz = df_usim.groupby('taz').sum()
-
         #read the group quarters population file into a dataframe
         try:
-            infile = self.in_folder + "\\" + self.gq_pop_file
+            infile = os.path.join(self.in_folder, self.gq_pop_file)
             df_gq_pop_taz = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None, usecols=[0,1])
             df_gq_pop_taz.columns = ['taz','gq_pop']
         except Exception as err:
@@ -207,7 +307,7 @@ class va_preprocess:
         
         #read the employment by taz file into a dataframe
         try:
-            infile = self.in_folder + "\\" + self.taz_emp_file
+            infile = os.path.join(self.in_folder, self.taz_emp_file)
             df_emp_taz = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None, usecols=[0,1])
             df_emp_taz.columns = ['taz','emp']
         except Exception as err:
@@ -216,85 +316,104 @@ class va_preprocess:
 
         #read the land area by taz file into a dataframe
         try:
-            infile = self.in_folder + "\\" + self.landarea_file
+            infile = os.path.join(self.in_folder, self.landarea_file)
             df_area_taz = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None, usecols=[0,1])
             df_area_taz.columns = ['taz', 'land_area']
         except Exception as err:
             msg = "Error reading land area file " + self.landarea_file + " into dataframe.\n" + str(err)
             raise RuntimeError(msg) from err
 
-        #merge the population, employment and land area dataframes
-        df_act_den_taz = pd.merge(df_hh_pop_taz, df_gq_pop_taz, left_on="taz", right_on="taz")
-        df_act_den_taz = pd.merge(df_act_den_taz, df_emp_taz, left_on="taz", right_on="taz")
-        df_act_den_taz = pd.merge(df_act_den_taz, df_area_taz, left_on="taz", right_on="taz")
-        df_act_den_taz["actden"] = \
-            ((df_act_den_taz["hh_pop"] + df_act_den_taz["gq_pop"] + df_act_den_taz["emp"]) / 1000) / df_act_den_taz["land_area"]
-        df_act_den_taz["jobpop"] = \
-            df_act_den_taz.apply(lambda row: self.jp_bal(row['emp'], row['hh_pop'], row['gq_pop']), axis=1)
-        
-        #drop unnecessary columns
-        df_act_den_taz = df_act_den_taz[['taz','actden','jobpop']]
+        #keep the taz found in every table, as inner merges on taz would, and align the tables with them
+        try:
+            keep = taz_used & np.isin(taz_ids, df_gq_pop_taz['taz']) & np.isin(taz_ids, df_emp_taz['taz']) & \
+                   np.isin(taz_ids, df_area_taz['taz'])
+            taz_ids = taz_ids[keep]
+            hh_pop = hh_pop[keep]
+            gq_pop = df_gq_pop_taz.set_index('taz')['gq_pop'].reindex(taz_ids).to_numpy(dtype=np.float64)
+            emp = df_emp_taz.set_index('taz')['emp'].reindex(taz_ids).to_numpy(dtype=np.float64)
+            land_area = df_area_taz.set_index('taz')['land_area'].reindex(taz_ids).to_numpy(dtype=np.float64)
+        except Exception as err:
+            msg = "Error aligning population, employment and land area by taz.\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            actden = ((hh_pop + gq_pop + emp) / 1000) / land_area
+        df_act_den_taz = pd.DataFrame({'taz': taz_ids, 'actden': actden, 'jobpop': self.jp_bal_arrays(emp, hh_pop, gq_pop)})
 
         #write the activity density data to a csv file
-        out_file_path = self.out_folder + "\\" + self.act_den_file
-        df_act_den_taz.to_csv(path_or_buf=out_file_path, index = False)
+        if write_output:
+            out_file_path = os.path.join(self.out_folder, self.act_den_file)
+            df_act_den_taz.to_csv(path_or_buf=out_file_path, index = False)
+
+        return df_act_den_taz
     
     #-------------------------------------------------------------------------------------
-    def jp_bal(self, emp, hhpop, gqpop):
-        #calculate job / population balance metric
-        if emp==0 and hhpop==0 and gqpop==0:
-            jpb = 0
-        else:
-            jpb = 1 - (abs(emp - 0.2 * (hhpop + gqpop)) / (emp + 0.2 * (hhpop + gqpop)))
-
-        return jpb
+    def jp_bal_arrays(self, emp, hhpop, gqpop):
+        #calculate job / population balance metric for arrays of taz values:
+        #1 - |emp - 0.2 * pop| / (emp + 0.2 * pop), or 0 for taz without employment or population
+        pop = 0.2 * (hhpop + gqpop)
+        empty = (emp == 0) & (hhpop == 0) & (gqpop == 0)
+        jpb = np.zeros(len(emp))
+        np.divide(np.abs(emp - pop), emp + pop, out=jpb, where=~empty)
+        return np.where(empty, 0.0, 1 - jpb)
 
     #--------------------------------------------------------------------------------------------
-    def int_den_by_bg(self):
-        #read the EPA smart location data into a pandas dataframe
-        try:
-            infile = self.in_folder + "\\" + self.smart_loc_file
-            #use a filter to grab only Massachusetts records
-            iter_csv = pd.read_csv(infile, iterator=True, chunksize=1000, \
-                                   usecols=['SFIPS','GEOID10','D3b','D3bao','D3bmm3','D3bmm4','D3bpo3','D3bpo4'])
-            df_int_den_bg = pd.concat([chunk[chunk['SFIPS']==25] for chunk in iter_csv])
-            
-        except Exception as err:
-            msg = "Error reading EPA smart location file " + self.smart_loc_file + " into dataframe.\n" + str(err)
-            raise RuntimeError(msg) from err
-        df_int_den_bg['intden'] = df_int_den_bg['D3bao'] + df_int_den_bg['D3bmm3'] + \
-                                    df_int_den_bg['D3bmm4'] + df_int_den_bg['D3bpo3'] + df_int_den_bg['D3bpo4']
-        df_int_den_bg['pct4way'] = df_int_den_bg['D3bmm4'] + df_int_den_bg['D3bpo4']
+    @instrumented()
+    def int_den_by_bg(self, write_output=True):
+        #calculate intersection density and the percentage of 4-way intersections by block group
+        #returns the metrics as a dataframe. If write_output is False, the int_den_file is not written
+        #if sld_extract_folder is set, the metrics are read from the state's partition of the smart location
+        #extract, which is (re)built first if it is missing or the smart location file has changed
+        infile = os.path.join(self.in_folder, self.smart_loc_file)
+        if self.sld_extract_folder is not None and sld_extract.pq is not None:
+            try:
+                if not sld_extract.extract_is_current(infile, self.sld_extract_folder):
+                    sld_extract.extract_sld(infile, self.sld_extract_folder)
+                df_int_den_bg = sld_extract.read_state(self.sld_extract_folder, self.state_fips)
+            except Exception as err:
+                msg = "Error reading smart location extract " + self.sld_extract_folder + ".\n" + str(err)
+                raise RuntimeError(msg) from err
+        else:
+            #read the EPA smart location data into a pandas dataframe
+            try:
+                #use a filter to grab only the records of the state
+                usecols = sld_extract.SLD_COLUMNS
+                reader = lambda: pd.concat([chunk[chunk['SFIPS']==self.state_fips] for chunk in \
+                                            pd.read_csv(infile, iterator=True, chunksize=1000, usecols=usecols)])
+                df_sld = self.read_input(infile, reader, "SFIPS==" + str(self.state_fips) + "|" + ",".join(usecols))
+
+            except Exception as err:
+                msg = "Error reading EPA smart location file " + self.smart_loc_file + " into dataframe.\n" + str(err)
+                raise RuntimeError(msg) from err
 
-        #drop unnecessary columns and rename the block group id column to match UrbanSim
-        df_int_den_bg = df_int_den_bg[['GEOID10','intden','pct4way']]
-        df_int_den_bg.columns = ['blockgroup_id','intden','pct4way']
+            #derive the metrics, keeping the block group id column renamed to match UrbanSim
+            df_int_den_bg = sld_extract.intersection_density(df_sld)
 
         #write the intersection density data to a csv file
-        out_file_path = self.out_folder + "\\" + self.int_den_file
-        df_int_den_bg.to_csv(path_or_buf=out_file_path, index = False)
+        if write_output:
+            out_file_path = os.path.join(self.out_folder, self.int_den_file)
+            df_int_den_bg.to_csv(path_or_buf=out_file_path, index = False)
+
+        return df_int_den_bg
 
     #--------------------------------------------------------------------------------------------------
-    def assemble_va_inputs(self):
+    @instrumented(rows_in=lambda self, *args, **kwargs: row_count(self.df_hh))
+    def assemble_va_inputs(self, emp_access_df=None, act_den_df=None, int_den_df=None, write_output=True):
         #Assign a taz to UrbanSim households
         #Then merge selected UrbanSim fields with employment accessibility, activity density and employment
         #density data
+        #The outputs of the other preprocessing stages may be passed in as dataframes; any that are not
+        #are read from the files written by those stages
+        #returns the va model input data as a dataframe. If write_output is False, the va_input_file is not written
 
-        #read the UrbanSim data into a pandas dataframe
-        try:
-            infile = self.in_folder + "\\" + self.urbansim_file
-            iter_csv = pd.read_csv(infile, iterator=True, chunksize=1000)
-            df_usim = pd.concat([chunk[chunk['person_num']==1] for chunk in iter_csv])
-            #slice off the desired columns
-            df_usim = df_usim[self.usim_fields]
-        except Exception as err:
-            msg = "Error reading urbansim file " + self.urbansim_file + " into dataframe.\n" + str(err)
-            raise RuntimeError(msg) from err
+        #slice the desired columns off the UrbanSim household table
+        df_usim = self.load_households()[self.usim_fields]
 
         #read the block / taz lookup into a dataframe
         try:
-            infile = self.in_folder + "\\" + self.blk_lut_file
-            blk_taz_lut = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None, usecols=['block_id','taz'])
+            infile = os.path.join(self.in_folder, self.blk_lut_file)
+            reader = lambda: pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None, usecols=['block_id','taz'])
+            blk_taz_lut = self.read_input(infile, reader, "block_id,taz")
         except Exception as err:
             msg = "Error reading taz lookup file " + infile + " into dataframe.\n" + str(err)
             raise RuntimeError(msg) from err
@@ -302,60 +421,20 @@ class va_preprocess:
         #merge the block / taz lookup into the urbansim dataframe
         df_usim = pd.merge(df_usim, blk_taz_lut, how='left', left_on='block_id', right_on='block_id')
 
-        #add and populate household size columns
+        #add and populate the household size, number of workers, low income and income category columns
         try:
-            for i in range(len(self.hhsize_fields)):
-                hhsiz_fld = self.hhsize_fields[i]
-                #check to make sure at least one household has a person count of i+1
-                #python is apparently unhappy when asked to run lambda functions on an empty dataframe
-                if not(df_usim.loc[df_usim['persons'] == i+1].empty):
-                    if i < len(self.hhsize_fields) - 1:
-                        df_usim[hhsiz_fld] = df_usim.apply(lambda row: 1 if row.persons == i+1 else 0, axis = 1)
-                    else:
-                        df_usim[hhsiz_fld] = df_usim.apply(lambda row: 1 if row.persons >= i+1 else 0, axis = 1)
+            df_usim = pd.concat([df_usim, self.encode_hh_categories(df_usim)], axis=1)
         except Exception as err:
-            msg = "Error setting household size flags.\n" + str(err)
+            msg = "Error setting household category fields.\n" + str(err)
             raise RuntimeError(msg) from err
 
-        #add and populate number of workers columns
-        try:
-            for i in range(len(self.numwrk_fields)):
-                numwrk_fld = self.numwrk_fields[i]
-                #check to see if at least one household has a worker count of i
-                if not(df_usim.loc[df_usim['workers'] == i].empty):
-                    if i < len(self.numwrk_fields) - 1:
-                        df_usim[numwrk_fld] = df_usim.apply(lambda row: 1 if row.workers == i else 0, axis = 1)
-                    else:
-                        df_usim[numwrk_fld] = df_usim.apply(lambda row: 1 if row.workers >= i else 0, axis = 1)
-        except Exception as err:
-            msg = "Error setting worker count fields.\n" + str(err)
-            raise RuntimeError(msg) from err
-
-        #dummy variable for low income households
-        try:
-            df_usim['dum_income'] = df_usim.apply(lambda row: 1 if row.hh_inc < 35000 else 0, axis = 1)
-        except Exception as err:
-            msg = "Error setting hh income dummy variable.\n" + str(err)
-            raise RuntimeError(msg) from err
-
-        #add and populate income category columns
-        try:
-            for i in range(len(self.hhinc_fields)):
-                inc_fld = self.hhinc_fields[i]
-                high=self.hhinc_breaks[i]
-                if i==0:
-                    low=0
-                else:
-                    low=self.hhinc_breaks[i-1]
-                df_usim[inc_fld] = df_usim.apply(lambda row: self.inc_flag(row.hh_inc, low, high), axis = 1)
-        except Exception as err:
-            msg = "Error setting household income fields.\n" + str(err)
-            raise RuntimeError(msg) from err
-                    
         #merge the intersection density data into the urbansim dataframe
         try:
-            infile = self.in_folder + "\\" + self.int_den_file
-            df_intden = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None)
+            if int_den_df is None:
+                infile = os.path.join(self.in_folder, self.int_den_file)
+                df_intden = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None)
+            else:
+                df_intden = int_den_df
         except Exception as err:
             msg = "error reading intersection density file.\n" + str(err)
             raise RuntimeError(msg) from err
@@ -364,8 +443,11 @@ class va_preprocess:
         
         #merge the employment accessibility data into the urbansim dataframe
         try:
-            infile = self.in_folder + "\\" + self.emp_access_file
-            df_empden = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None)
+            if emp_access_df is None:
+                infile = os.path.join(self.in_folder, self.emp_access_file)
+                df_empden = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None)
+            else:
+                df_empden = emp_access_df
         except Exception as err:
             msg = "error reading employment accessibility file.\n" + str(err)
             raise RuntimeError(msg) from err
@@ -384,8 +466,11 @@ class va_preprocess:
         #merge the activity density data into the urbansim dataframe
          #merge the employment accessibility data into the urbansim dataframe
         try:
-            infile = self.in_folder + "\\" + self.act_den_file
-            df_actden = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None)
+            if act_den_df is None:
+                infile = os.path.join(self.in_folder, self.act_den_file)
+                df_actden = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None)
+            else:
+                df_actden = act_den_df
         except Exception as err:
             msg = "error reading activity density file.\n" + str(err)
             raise RuntimeError(msg) from err
@@ -394,13 +479,41 @@ class va_preprocess:
 
         #write the va model input data to a csv file
         #write the intersection density data to a csv file
-        out_file_path = self.out_folder + "\\" + self.va_input_file
-        df_usim.to_csv(path_or_buf=out_file_path, index = False)
+        if write_output:
+            out_file_path = os.path.join(self.out_folder, self.va_input_file)
+            df_usim.to_csv(path_or_buf=out_file_path, index = False)
 
-    def inc_flag(self, inc, lo, hi):
-        #returns 1 if inc is between lo and hi, 0 otherwise
-        if inc >= lo and inc < hi:
-            flag = 1
-        else:
-            flag = 0
-        return flag
+        return df_usim
+
+    #--------------------------------------------------------------------------------------------------
+    def encode_hh_categories(self, df_usim):
+        #build all household dummy variable columns in one vectorized pass over the household table
+        #the number of columns in each group is driven by the field lists in the setup file:
+        #hhsize_fields start at 1 person, numwrk_fields start at 0 workers and the final field in each
+        #list flags that count or more. hhinc_fields are banded by hhinc_breaks, with the first band starting at 0
+        if len(self.hhinc_breaks) < len(self.hhinc_fields):
+            msg = "Setup parameter hhinc_breaks must have an entry for each of the hhinc_fields."
+            raise RuntimeError(msg)
+
+        inc_arr = df_usim[self.inc_col].to_numpy(dtype=np.float64)
+
+        dummy_arrs = [self.count_dummies(df_usim['persons'].to_numpy(dtype=np.float64), len(self.hhsize_fields), 1),
+                      self.count_dummies(df_usim['workers'].to_numpy(dtype=np.float64), len(self.numwrk_fields), 0),
+                      (inc_arr < self.dum_income_break).astype(np.int64)[:, np.newaxis],
+                      self.band_dummies(inc_arr, self.hhinc_breaks[:len(self.hhinc_fields)])]
+        dummy_cols = self.hhsize_fields + self.numwrk_fields + [self.dum_income_field] + self.hhinc_fields
+
+        return pd.DataFrame(np.hstack(dummy_arrs), columns=dummy_cols, index=df_usim.index)
+
+    def count_dummies(self, counts, n_fields, start):
+        #returns an (n rows x n_fields) array of 0/1 flags
+        #column i flags counts equal to start+i; the final column flags counts of start+n_fields-1 or more
+        codes = np.minimum(counts - start, n_fields - 1)
+        return (codes[:, np.newaxis] == np.arange(n_fields)).astype(np.int64)
+
+    def band_dummies(self, values, breaks):
+        #returns an (n rows x len(breaks)) array of 0/1 flags
+        #column i flags values that are >= breaks[i-1] (or 0 for the first band) and < breaks[i]
+        codes = np.searchsorted(np.asarray(breaks, dtype=np.float64), values, side='right')
+        codes = np.where(values >= 0, codes, -1)
+        return (codes[:, np.newaxis] == np.arange(len(breaks))).astype(np.int64)
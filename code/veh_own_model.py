@@ -1,6 +1,10 @@
 import pandas as pd
+import numpy as np
 import yaml
 import os
+from block_split import BlockSplitIndex, count_values, group_splits, add_split_counts
+from instrumentation import StageRecorder, instrumented
+from output_writers import TableWriter
 
 class VehModel:
     """
@@ -12,10 +16,12 @@ class VehModel:
         setup_file (str): name of YAML file listing the folder path of the code directory,
         names of input and output files,the name of the model specification file,
         lists of required fields for output files and the name of the model specification yaml file 
+        overrides (dict): optional setup parameters that replace those read from the setup file
     """
 
     def __init__(self,
-                 setup_file: str):
+                 setup_file: str,
+                 overrides: dict = None):
         try:
             with open(setup_file, 'r') as stream:    
                 setup = yaml.load(stream, Loader=yaml.FullLoader)
@@ -24,6 +30,8 @@ class VehModel:
             raise RuntimeError(msg) from err
         
         self.setup = setup if setup is not None else {}
+        if overrides:
+            self.setup.update(overrides)
 
         try:
             self.code_path      = self.setup['code_path']
@@ -34,15 +42,43 @@ class VehModel:
             if self.aggregate:
                 self.output_agg_file = self.setup['output_agg_file']
                 self.agg_fields      = self.setup['output_agg_fields']
-            self.model_spec_file = self.code_path + "\\" + self.setup['model_spec_file']
+            self.model_spec_file = os.path.join(self.code_path, self.setup['model_spec_file'])
             self.veh_fields      = self.setup['veh_fields']
             self.blk_fct_file   = self.setup['blk_fct_file']
             self.split_factor   = self.setup['split_factor']
+            #optional: if set, households are streamed through the model in batches of this many rows by run_chunked
+            self.chunk_rows     = self.setup.get('chunk_rows')
+            #optional: if set, aggregate totals are computed from the household results with a sparse
+            #household -> (taz, block split) matrix, and the household x block split table is only built if split_output is set
+            self.sparse_aggregate = self.setup.get('sparse_aggregate', False)
+            self.split_output   = self.setup.get('split_output', False)
+            #optional: if set, each row of the split households takes the taz of its block split instead of the
+            #household's own taz, and taz totals are summed by those tazs
+            self.split_taz      = self.setup.get('split_taz', False)
+            #optional: column types of the model input (applied by load_data) and of the columns added by run_model
+            self.input_dtypes   = self.setup.get('input_dtypes') or {}
+            self.output_dtypes  = self.setup.get('output_dtypes') or {}
+            #optional: format of the output files (csv, parquet or feather) and compression of parquet / feather files,
+            #the columns written to the disaggregate output file (all by default) and the number of processes formatting csv output
+            self.output_format  = self.setup.get('output_format', 'csv')
+            self.output_compression = self.setup.get('output_compression')
+            self.output_columns = self.setup.get('output_columns')
+            self.csv_workers    = self.setup.get('csv_workers') or 1
             
         except Exception as err:
             msg = "Required setup parameter(s) were not found in file '" + setup_file + ".\n" + str(err)
             raise RuntimeError(msg) from err
 
+        #block / taz split factor table and index, built on first use by load_blk_factors and load_split_index
+        self.df_factors = None
+        self.split_index = None
+        #sums of the output_agg_fields of the households by geography and block split (see BlockSplitIndex.split_counts),
+        #kept by split_hh_to_taz or computed while scoring (see PoissonModel.score_patterns and score_parallel), or None
+        self.split_counts = None
+
+        #records the time, memory, rows and bytes of each stage method (see instrumentation.py)
+        self.recorder = StageRecorder.from_setup(self.setup)
+
     # Method load_data should be defined by subclasses of veh_model
     # The base class method functionality is limited to raising a NotImplementedError with a helpful message
     # and will only be executed if the developer of the sublcass failed to define the method there.
@@ -60,65 +96,312 @@ class VehModel:
         msg = "Error: Method run_model is undefined."
         raise NotImplementedError(msg)
 
+    # Method read_dtypes
+    # return the dtype argument for reading the model input with pd.read_csv: integer columns of input_dtypes
+    # are read as the matching nullable types, so that missing values are kept until load_data sets them to 0
+    # and values that don't fit the type (e.g. 1.5 or 300 for a uint8 flag) are reported when the file is read
+    # category columns are read with the types pandas infers and converted after the missing values are filled
+    def read_dtypes(self):
+        read_types = {}
+        for col, dtype in self.input_dtypes.items():
+            if dtype != 'category':
+                read_types[col] = nullable_dtype(dtype)
+        return read_types
+
+    # Method output_writer
+    # return a TableWriter for the output file file_name in the output format of the setup file
+    # the output format and the output_columns projection apply to the disaggregate output file only;
+    # the aggregate and simulation files are always written as csv
+    def output_writer(self, file_name, index=False):
+        disagg = file_name == self.output_file
+        return TableWriter(os.path.join(self.data_path, file_name),
+                           output_format=self.output_format if disagg else 'csv',
+                           columns=self.output_columns if disagg else None,
+                           index=index,
+                           compression=self.output_compression,
+                           csv_workers=self.csv_workers)
+
     # Method save_results
-    # write dataframe of processed household / zonal data to a csv file
+    # write dataframe of processed household / zonal data to the disaggregate output file
+    @instrumented()
     def save_results(self):
         #print("writing dataframe to file...")
         try:
-            out_file_path = self.data_path + "\\" + self.output_file
-            self.df.to_csv(path_or_buf=out_file_path,index=False)
+            with self.output_writer(self.output_file) as writer:
+                writer.write(self.df)
         except Exception as err:
             msg = "Error writing dataframe to file.\n" + str(err)
             raise RuntimeError(msg) from err
 
+    # Method load_blk_factors
+    # read the block / taz split factor file into a dataframe with block_id, taz and split factor columns
+    # the table is cached on the instance (and may be set by the caller to share one copy between model runs)
+    def load_blk_factors(self):
+        if self.df_factors is None:
+            try:
+                infile = os.path.join(self.data_path, self.blk_fct_file)
+                self.df_factors = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None,
+                                              usecols=['block_id','taz',self.split_factor])
+            except Exception as err:
+                msg = "Error reading block split factor file\n" + str(err)
+                raise RuntimeError(msg) from err
+        return self.df_factors
+
+    # Method load_split_index
+    # build the block -> (taz, split factor) index from the block split factor table
+    # the index is built once and cached on the instance
+    def load_split_index(self):
+        if self.split_index is None:
+            try:
+                self.split_index = BlockSplitIndex(self.load_blk_factors(), self.split_factor)
+            except Exception as err:
+                msg = "Error building block split index\n" + str(err)
+                raise RuntimeError(msg) from err
+        return self.split_index
+
+    # Method household_geo
+    # return the aggregate geography of each household of df for BlockSplitIndex.split_counts: None (the taz
+    # of each block split) when taz is the aggregate geography and split_taz is set, otherwise the household's
+    # own geography
+    def household_geo(self, df):
+        if self.split_taz and self.agg_fields[0] == 'taz':
+            return None
+        return df[self.agg_fields[0]].to_numpy()
+
     # Method split_hh_to_taz
-    # Merge disaggregate model results dataframe with block to taz split table
-    # Apply split factors to 0 / 1 flag columns
+    # Expand each household of the disaggregate model results into one row per block to taz split of its block
+    # The split factor is applied to the 0 / 1 flag columns; each row keeps the household's taz, as the model was
+    # first written, unless split_taz is set, in which case it takes the taz of its split
+    # Households in blocks that are missing from the split table are dropped, as with an inner merge on block_id
+    # With aggregate output, the unfactored aggregate fields are also summed by geography and split (split_counts)
+    # unless scoring already did
+    @instrumented()
     def split_hh_to_taz(self):
-        #read block / taz factor file into a dataframe
-        try:
-            infile = self.data_path + "\\" + self.blk_fct_file
-            df_factors = pd.read_csv(filepath_or_buffer=infile, header=0, index_col=None, usecols=['block_id','area_fct'])
-        except Exception as err:
-            msg = "Error reading block split factor file\n" + str(err)
-            raise RuntimeError(msg) from err
+        split_index = self.load_split_index()
 
-        #drop taz column from VA model output
         try:
-            self.df.drop('taz')
-        except KeyError:
-            #no big deal if the column doesn't exist
-            pass
+            hh_rows, split_rows = split_index.expand(self.df['block_id'])
+            factors = split_index.factors[split_rows]
+
+            if self.aggregate and self.split_counts is None:
+                geo = self.household_geo(self.df)
+                split_geo = split_index.taz[split_rows] if geo is None else geo[hh_rows]
+                values = count_values(self.df[self.agg_fields[1:]])[hh_rows]
+                self.split_counts = group_splits(split_geo, split_rows, values, self.agg_fields[1:])
+
+            #repeat each household row once per split of its block
+            df_split = self.df.take(hh_rows)
+            df_split.reset_index(drop=True, inplace=True)
+
+            if self.split_taz:
+                #replace the household's taz with the taz of the split
+                df_split['taz'] = split_index.taz[split_rows]
+
+            #apply the split factors to all of the flags at once
+            flag_fields = self.agg_fields[1:]
+            df_split[flag_fields] = df_split[flag_fields].to_numpy(dtype=np.float64) * factors[:, np.newaxis]
+            df_split[self.split_factor] = factors
         except Exception as err:
-            msg = "Error dropping taz column.\n" + str(err)
+            msg = "Error applying block split factors.\n" + str(err)
             raise RuntimeError(msg) from err
 
-        #merge the split factors into the va output
-        self.df = pd.merge(self.df, df_factors, left_on='block_id', right_on='block_id')
-
-        #apply the split factors to the flags
-        for i in range(1,len(self.agg_fields)):
-            self.df[self.agg_fields[i]] = self.df[self.agg_fields[i]] * self.df[self.split_factor]
+        self.df = df_split
  
     # Method aggregate_results
     # Summarize dataframe of processed household / zonal data by aggregate geography
     # Include fields in output_agg_fields list
+    @instrumented()
     def aggregate_results(self):
         #print("aggregating results...")
+        self.write_aggregates(self.summarize_results())
+
+    # Method summarize_results
+    # return the sums of the split factored output_agg_fields by aggregate geography for the households in the dataframe
+    # the sums are the split_totals of the split_counts kept by split_hh_to_taz or by scoring (see counts_frame)
+    def summarize_results(self):
+        return self.counts_frame(self.aggregate_counts())
+
+    # Method aggregate_counts
+    # return the split_counts of the households in the dataframe: those kept by split_hh_to_taz or by scoring,
+    # otherwise those of the (unsplit) household model results
+    def aggregate_counts(self):
+        if self.split_counts is not None:
+            return self.split_counts
+        split_index = self.load_split_index()
+        try:
+            return split_index.split_counts(self.df['block_id'], self.df[self.agg_fields[1:]], self.agg_fields[1:],
+                                            self.household_geo(self.df))
+        except Exception as err:
+            msg = "Error aggregating results.\n" + str(err)
+            raise RuntimeError(msg) from err
+
+    # Method summarize_sparse
+    # return the same sums as summarize_results, computed from the household model results before they are split
+    # a sparse (geography, split) x household matrix of ones is multiplied by the household fields in one product,
+    # so the household x block split table is never built
+    def summarize_sparse(self):
+        return self.counts_frame(self.sparse_counts())
+
+    # Method sparse_counts
+    # return the split_counts of the household model results, computed with a sparse product (see summarize_sparse)
+    def sparse_counts(self):
+        if self.split_counts is not None:
+            return self.split_counts
+        split_index = self.load_split_index()
+        try:
+            matrix, keys = split_index.count_matrix(self.df['block_id'], self.household_geo(self.df))
+            counts = matrix @ count_values(self.df[self.agg_fields[1:]])
+            return pd.DataFrame(counts, index=keys, columns=self.agg_fields[1:])
+        except Exception as err:
+            msg = "Error aggregating results.\n" + str(err)
+            raise RuntimeError(msg) from err
+
+    # Method counts_frame
+    # return the split factored sums by aggregate geography of split counts (see BlockSplitIndex.split_totals)
+    # whole number fields are counted exactly, so the sums are bit-identical however the households were
+    # scored, split or batched; fields with fractional values are summed as floats, in an order that may vary
+    def counts_frame(self, counts):
+        try:
+            sums, geo_ids = self.load_split_index().split_totals(counts)
+        except Exception as err:
+            msg = "Error aggregating results.\n" + str(err)
+            raise RuntimeError(msg) from err
+        return self.sums_frame(sums, geo_ids)
+
+    # Method sums_frame
+    # arrange (geography, field) sums of the output_agg_fields as a dataframe indexed by aggregate geography,
+    # in the layout of summarize_results
+    def sums_frame(self, sums, geo_ids):
+        index = pd.Index(geo_ids, name=self.agg_fields[0])
+        return pd.DataFrame(sums, index=index, columns=self.agg_fields[1:])
+
+    # Method aggregate_sparse
+    # write the aggregate output file from the household model results, without splitting them (see summarize_sparse)
+    @instrumented()
+    def aggregate_sparse(self):
+        self.write_aggregates(self.summarize_sparse())
+
+    # Method write_aggregates
+    # round the sums by aggregate geography to integers and write them to the aggregate output file
+    def write_aggregates(self, df2_grouped):
         try:
-            df2         = self.df[self.agg_fields]
-            df2_grouped = df2.groupby(self.agg_fields[0]).sum()
             #round all values to integers
-            for i in range(1,len(self.agg_fields)):
-                df2_grouped[self.agg_fields[i]] = round(df2_grouped[self.agg_fields[i]],0)
+            df2_grouped = df2_grouped.round(0)
         except Exception as err:
             msg = "Error aggregating results.\n" + str(err)
             raise RuntimeError(msg) from err
 
         #write the results to a text file
         try:
-            out_file_path = self.data_path + "\\" + self.output_agg_file
-            df2_grouped.to_csv(path_or_buf=out_file_path)
+            with self.output_writer(self.output_agg_file, index=True) as writer:
+                writer.write(df2_grouped)
         except Exception as err:
             msg = "Error writing aggregated output to file.\n" + str(err)
             raise RuntimeError(msg) from err
+
+    # Method run_chunked
+    # stream households from the input data file through load_data, run_model, split_hh_to_taz and
+    # save_results in batches of chunk_rows rows, appending each batch to the disaggregate output file
+    # with sparse_aggregate, each batch is summarized by sparse_counts and only split if split_output is set
+    # the split_counts of the batches are added as they are done and the sums by aggregate geography are written
+    # once all batches are done, so peak memory depends on chunk_rows rather than on the size of the input file;
+    # the counts are exact, so the sums are the same for any chunk_rows
+    @instrumented()
+    def run_chunked(self, chunk_rows=None):
+        chunk_rows = chunk_rows if chunk_rows is not None else self.chunk_rows
+        if not chunk_rows:
+            msg = "Error: run_chunked requires chunk_rows, either as an argument or in the setup file."
+            raise RuntimeError(msg)
+
+        infile = os.path.join(self.data_path, self.input_file)
+        try:
+            iter_csv = pd.read_csv(infile, iterator=True, chunksize=chunk_rows, dtype=self.read_dtypes())
+        except Exception as err:
+            msg = "Error reading input file " + self.input_file + " into dataframe.\n" + str(err)
+            raise RuntimeError(msg) from err
+
+        agg_counts = None
+        batch_dtypes = None
+        try:
+            writer = self.output_writer(self.output_file)
+        except Exception as err:
+            msg = "Error writing dataframe to file.\n" + str(err)
+            raise RuntimeError(msg) from err
+        with writer:
+            for chunk in iter_csv:
+                #every batch is written in the same format: the columns that input_dtypes doesn't list keep the
+                #types pandas infers for the first batch
+                if batch_dtypes is None:
+                    batch_dtypes = {col: dtype for col, dtype in chunk.dtypes.items() if col not in self.input_dtypes}
+                else:
+                    chunk = self.match_dtypes(chunk, batch_dtypes)
+                self.load_data(df=chunk)
+                self.run_model()
+
+                #with sparse aggregation the batch is summarized before (and without) splitting it
+                if self.aggregate and self.sparse_aggregate:
+                    chunk_counts = self.sparse_counts()
+                if self.split_output or not self.sparse_aggregate:
+                    self.split_hh_to_taz()
+
+                try:
+                    writer.write(self.df)
+                except Exception as err:
+                    msg = "Error writing dataframe to file.\n" + str(err)
+                    raise RuntimeError(msg) from err
+
+                if self.aggregate:
+                    if not self.sparse_aggregate:
+                        chunk_counts = self.aggregate_counts()
+                    agg_counts = add_split_counts(agg_counts, chunk_counts)
+
+        if self.aggregate and agg_counts is not None:
+            self.write_aggregates(self.counts_frame(agg_counts))
+
+    # Method match_dtypes
+    # convert the columns of a batch of the input file to the types of the first batch (batch_dtypes), for run_chunked
+    # missing values are set to 0 first, as load_data does. A value that the type of the first batch can't hold
+    # (e.g. 1.5 or a name in a column of whole numbers) is an error: such columns must be listed in input_dtypes
+    def match_dtypes(self, chunk, batch_dtypes):
+        changed = [col for col, dtype in batch_dtypes.items() if col in chunk.columns and chunk[col].dtype != dtype]
+        if not changed:
+            return chunk
+        chunk = chunk.copy()
+        chunk[changed] = chunk[changed].fillna(0)
+        try:
+            return apply_dtypes(chunk, {col: batch_dtypes[col] for col in changed})
+        except Exception as err:
+            msg = ("Error reading input file " + self.input_file + " in batches: a later batch doesn't fit the column "
+                   "types of the first batch. List the column types in input_dtypes.\n" + str(err))
+            raise RuntimeError(msg) from err
+
+
+# function nullable_dtype:
+# the pandas nullable type matching a numpy integer type (e.g. uint8 -> UInt8); other types are returned unchanged
+def nullable_dtype(dtype):
+    np_dtype = np.dtype(dtype)
+    if np_dtype.kind in 'iu':
+        return ('UInt' if np_dtype.kind == 'u' else 'Int') + str(8 * np_dtype.itemsize)
+    return dtype
+
+# function apply_dtypes:
+# convert the columns of df listed in dtypes (column name: type name) to their types, in place
+# columns that df doesn't have are skipped. Integer conversions go through the nullable types, so a value
+# that can't be represented exactly raises an error rather than being truncated. Geography codes converted
+# to category keep integer categories when all of their values are whole numbers
+def apply_dtypes(df, dtypes):
+    for col, dtype in dtypes.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        try:
+            if dtype == 'category':
+                values = df[col]
+                if pd.api.types.is_float_dtype(values.dtype) and np.array_equal(values, np.floor(values)):
+                    values = values.astype(np.int64)
+                df[col] = values.astype('category')
+            else:
+                df[col] = df[col].astype(nullable_dtype(dtype)).astype(dtype)
+        except Exception as err:
+            msg = "Error converting column " + col + " to " + str(dtype) + ".\n" + str(err)
+            raise RuntimeError(msg) from err
+    return df